@@ -0,0 +1,227 @@
+"""Minimal stand-in for the Telegram Bot API, for offline testing and benchmarks.
+
+Serves /bot<token>/<method> like api.telegram.org: getUpdates long polling,
+setWebhook/deleteWebhook (updates are then POSTed to the registered URL with
+the secret-token header), and the send/edit/react methods the gateway uses,
+which just echo back a plausible Message. Updates are injected with
+FakeBotAPI.inject() or POST /_inject; GET /_stats reports per-update
+latencies (injected -> webhook ack, injected -> first bot call for that chat).
+
+    python bench/fake_bot_api.py --port 8081
+    TELEGRAM_API_BASE=http://127.0.0.1:8081 TELEGRAM_BOT_TOKEN=123:fake python scripts/telegram_gateway.py
+    curl -X POST 'http://127.0.0.1:8081/_inject?chat_id=42&text=hello'
+"""
+
+import json
+import time
+import asyncio
+import argparse
+from collections import Counter
+
+import aiohttp
+from aiohttp import web
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+WEBHOOK_MAX_CONNECTIONS = 40
+
+
+def _percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))] if samples else 0.0
+
+
+class FakeBotAPI:
+    def __init__(self, rtt=0.0):
+        self.rtt = rtt               # simulated network round trip per request, seconds
+        self.updates = []            # not yet confirmed by getUpdates
+        self.next_update_id = 1
+        self.next_message_id = 1000
+        self.webhook_url = None
+        self.webhook_secret = None
+        self.calls = Counter()
+        self.webhook_errors = 0
+        self.records = {}            # update_id -> {"chat_id", "injected", "acked", "replied"}
+        self._awaiting_reply = {}    # chat_id -> [update_id]
+        self._new_update = asyncio.Event()
+        self._webhook_slots = asyncio.Semaphore(WEBHOOK_MAX_CONNECTIONS)
+        self._deliveries = set()
+        self._http = None
+        self._runner = None
+
+    # --- Lifecycle ---
+
+    async def start(self, host="127.0.0.1", port=8081):
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self._handle_method)
+        app.router.add_post("/_inject", self._handle_inject)
+        app.router.add_get("/_stats", self._handle_stats)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        self._http = aiohttp.ClientSession()
+
+    async def stop(self):
+        if self._http:
+            await self._http.close()
+        if self._runner:
+            await self._runner.cleanup()
+
+    def reset(self):
+        self.updates.clear()
+        self.calls.clear()
+        self.records.clear()
+        self._awaiting_reply.clear()
+        self.webhook_errors = 0
+
+    # --- Updates ---
+
+    def inject(self, chat_id, text="hello"):
+        """Queues a private text message from `chat_id`; returns its update_id."""
+        update_id = self.next_update_id
+        self.next_update_id += 1
+        self.next_message_id += 1
+        update = {
+            "update_id": update_id,
+            "message": {
+                "message_id": self.next_message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private", "first_name": "Bench"},
+                "from": {"id": chat_id, "is_bot": False, "first_name": "Bench"},
+                "text": text,
+            },
+        }
+        self.records[update_id] = {"chat_id": chat_id, "injected": time.monotonic(), "acked": None, "replied": None}
+        self._awaiting_reply.setdefault(chat_id, []).append(update_id)
+        if self.webhook_url:
+            task = asyncio.create_task(self._post_update(update))
+            self._deliveries.add(task)
+            task.add_done_callback(self._deliveries.discard)
+        else:
+            self.updates.append(update)
+            self._new_update.set()
+        return update_id
+
+    async def _post_update(self, update):
+        headers = {SECRET_HEADER: self.webhook_secret} if self.webhook_secret else {}
+        async with self._webhook_slots:
+            await asyncio.sleep(self.rtt / 2)
+            try:
+                async with self._http.post(self.webhook_url, json=update, headers=headers) as resp:
+                    await resp.read()
+                    ok = resp.status == 200
+            except aiohttp.ClientError:
+                ok = False
+        if ok:
+            self.records[update["update_id"]]["acked"] = time.monotonic()
+        else:
+            self.webhook_errors += 1
+
+    async def _get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        timeout = float(params.get("timeout") or 0)
+        limit = int(params.get("limit") or 100)
+        self.updates = [u for u in self.updates if u["update_id"] >= offset]
+        if not self.updates and timeout:
+            self._new_update.clear()
+            try:
+                await asyncio.wait_for(self._new_update.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:limit]
+
+    # --- Bot API methods ---
+
+    def _message(self, chat_id, params):
+        self.next_message_id += 1
+        message = {
+            "message_id": self.next_message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "group"},
+            "from": {"id": 1, "is_bot": True, "first_name": "Fake"},
+        }
+        if "text" in params:
+            message["text"] = params["text"]
+        return message
+
+    def _note_reply(self, chat_id):
+        waiting = self._awaiting_reply.get(chat_id)
+        if waiting:
+            self.records[waiting.pop(0)]["replied"] = time.monotonic()
+
+    async def _call(self, method, params):
+        self.calls[method] += 1
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+        if method == "getUpdates":
+            if self.webhook_url:
+                raise web.HTTPConflict(text=json.dumps({
+                    "ok": False, "error_code": 409,
+                    "description": "Conflict: can't use getUpdates method while webhook is active",
+                }), content_type="application/json")
+            return await self._get_updates(params)
+        if method == "setWebhook":
+            self.webhook_url = params.get("url") or None
+            self.webhook_secret = params.get("secret_token") or None
+            return True
+        if method == "deleteWebhook":
+            self.webhook_url = self.webhook_secret = None
+            return True
+        if method == "getWebhookInfo":
+            return {"url": self.webhook_url or "", "has_custom_certificate": False, "pending_update_count": 0}
+
+        chat_id = params.get("chat_id")
+        if chat_id is not None:
+            chat_id = int(chat_id)
+            self._note_reply(chat_id)
+        if method.startswith("send") or method in ("editMessageText", "editMessageMedia", "editMessageReplyMarkup"):
+            return self._message(chat_id or 0, params)
+        return True
+
+    async def _handle_method(self, request):
+        await asyncio.sleep(self.rtt / 2)
+        params = dict(await request.post()) if request.can_read_body else {}
+        params.update(request.query)
+        if request.content_type == "application/json":
+            params.update(await request.json())
+        result = await self._call(request.match_info["method"], params)
+        await asyncio.sleep(self.rtt / 2)
+        return web.json_response({"ok": True, "result": result})
+
+    async def _handle_inject(self, request):
+        update_id = self.inject(int(request.query.get("chat_id", 42)), request.query.get("text", "hello"))
+        return web.json_response({"ok": True, "update_id": update_id})
+
+    async def _handle_stats(self, request):
+        return web.json_response(self.stats())
+
+    def stats(self):
+        records = self.records.values()
+        ack = [r["acked"] - r["injected"] for r in records if r["acked"]]
+        reply = [r["replied"] - r["injected"] for r in records if r["replied"]]
+        return {
+            "injected": len(self.records),
+            "replied": len(reply),
+            "ack_p50": _percentile(ack, 0.5),
+            "ack_p95": _percentile(ack, 0.95),
+            "reply_p50": _percentile(reply, 0.5),
+            "reply_p95": _percentile(reply, 0.95),
+            "reply_max": max(reply, default=0.0),
+            "webhook_errors": self.webhook_errors,
+            "calls": dict(self.calls),
+        }
+
+
+async def _main(host, port, rtt):
+    api = FakeBotAPI(rtt=rtt)
+    await api.start(host, port)
+    print(f"Fake Bot API on http://{host}:{port}", flush=True)
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--rtt", type=float, default=0.0, help="simulated round trip per request, seconds")
+    args = parser.parse_args()
+    asyncio.run(_main(args.host, args.port, args.rtt))
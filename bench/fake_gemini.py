@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""Stand-in for the Gemini CLI, for benchmarks that must not spend quota.
+
+Called like the real CLI by task_runner (`GEMINI_BIN=bench/fake_gemini.py`):
+`--model <m> [-y]`, prompt on stdin. It recognizes the runner's three
+prompts and answers in the shape the runner expects: a checklist for plan
+prompts, plain text for steps, <thought>/<answer> for the final answer.
+
+Behaviour is set through the environment (inherited from the runner):
+
+    FAKE_GEMINI_LATENCY     fixed:S | uniform:LO,HI | lognormal:MEDIAN,SIGMA  (seconds, default lognormal:1,0.5)
+    FAKE_GEMINI_OUTPUT      bytes of text per step result (default 2000)
+    FAKE_GEMINI_STEPS       plan length, N or LO-HI (default 3-5)
+    FAKE_GEMINI_QUOTA_RATE  probability of a quota error on stderr (default 0)
+    FAKE_GEMINI_QUOTA_RESET reset time in the quota message (default 30s)
+    FAKE_GEMINI_HANG_RATE   probability of never answering, so the runner times out (default 0)
+    FAKE_GEMINI_ERROR_RATE  probability of exiting 1 without output (default 0)
+    FAKE_GEMINI_LOG         append one JSON line per call (kind, model, outcome, seconds) to this file
+"""
+
+import os
+import sys
+import json
+import time
+import fcntl
+import random
+
+WORDS = "search analyze summarize calendar email draft compare weather budget report notes meeting".split()
+
+
+def env_float(name, default):
+    return float(os.getenv(name, default))
+
+
+def latency(rng):
+    kind, _, params = os.getenv("FAKE_GEMINI_LATENCY", "lognormal:1,0.5").partition(":")
+    values = [float(v) for v in params.split(",") if v]
+    if kind == "fixed":
+        return values[0]
+    if kind == "uniform":
+        return rng.uniform(*values)
+    median, sigma = values
+    return rng.lognormvariate(0, sigma) * median
+
+
+def text(rng, size):
+    words = []
+    while sum(len(w) + 1 for w in words) < size:
+        words.append(rng.choice(WORDS))
+    return " ".join(words)
+
+
+def answer(kind, rng):
+    if kind == "plan":
+        lo, _, hi = os.getenv("FAKE_GEMINI_STEPS", "3-5").partition("-")
+        steps = rng.randint(int(lo), int(hi or lo))
+        return "".join(f"- [ ] {text(rng, 30).capitalize()}\n" for _ in range(steps))
+    size = int(env_float("FAKE_GEMINI_OUTPUT", "2000"))
+    if kind == "final":
+        return f"<thought>{text(rng, 200)}</thought><answer>{text(rng, size)}</answer>"
+    return text(rng, size)
+
+
+def log_call(record):
+    path = os.getenv("FAKE_GEMINI_LOG")
+    if not path:
+        return
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.write(json.dumps(record) + "\n")
+
+
+def main():
+    args = sys.argv[1:]
+    model = args[args.index("--model") + 1] if "--model" in args else "default"
+    prompt = sys.stdin.read()
+    kind = "plan" if "Create a checklist plan" in prompt else "final" if "FINAL ANSWER" in prompt else "step"
+    rng = random.Random()
+    started = time.monotonic()
+    record = {"kind": kind, "model": model, "prompt_bytes": len(prompt.encode())}
+
+    roll = rng.random()
+    quota, hang, error = (env_float(f"FAKE_GEMINI_{name}_RATE", "0") for name in ("QUOTA", "HANG", "ERROR"))
+    if roll < hang:
+        log_call(dict(record, outcome="hang"))
+        time.sleep(10 ** 6)  # killed by the runner's timeout
+    time.sleep(latency(rng))
+    if roll < hang + quota:
+        log_call(dict(record, outcome="quota", seconds=time.monotonic() - started))
+        reset = os.getenv("FAKE_GEMINI_QUOTA_RESET", "30s")
+        sys.stderr.write(f"QuotaError: You have exhausted your capacity on this model. Your quota will reset after {reset}.\n")
+        sys.exit(1)
+    if roll < hang + quota + error:
+        log_call(dict(record, outcome="error", seconds=time.monotonic() - started))
+        sys.exit(1)
+    sys.stdout.write(answer(kind, rng) + "\n")
+    log_call(dict(record, outcome="ok", seconds=time.monotonic() - started))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""A minimal stdio MCP server for the benchmarks.
+
+Newline-delimited JSON-RPC on stdin/stdout, like the servers users put in
+.gemini/settings.json. --startup-delay stands in for a Node/Python server's
+import and connect time; tools:
+
+- echo(text): returns text;
+- slow(seconds): sleeps, then returns;
+- counter(): returns how many tools/call this process has served, which
+  shows whether calls reached a fresh or a warm process;
+- list_events(day) / create_event(day, title): a small calendar, read-only
+  and write tools for the mcp_cache tests. --latency delays every
+  tools/call like a round-trip to the external service.
+
+    python bench/fake_mcp_server.py --startup-delay 1.5 --latency 0.3
+"""
+
+import sys
+import json
+import time
+import argparse
+
+TOOLS = [
+    {"name": "echo", "description": "Returns its input.",
+     "inputSchema": {"type": "object", "properties": {"text": {"type": "string"}}}},
+    {"name": "slow", "description": "Sleeps for the given number of seconds.",
+     "inputSchema": {"type": "object", "properties": {"seconds": {"type": "number"}}}},
+    {"name": "counter", "description": "Calls served by this server process.",
+     "inputSchema": {"type": "object", "properties": {}}},
+    {"name": "list_events", "description": "Calendar events of a day.",
+     "inputSchema": {"type": "object", "properties": {"day": {"type": "string"}}}},
+    {"name": "create_event", "description": "Adds a calendar event.",
+     "inputSchema": {"type": "object", "properties": {"day": {"type": "string"}, "title": {"type": "string"}}}},
+]
+
+
+def reply(request_id, result=None, error=None):
+    message = {"jsonrpc": "2.0", "id": request_id}
+    if error:
+        message["error"] = {"code": error[0], "message": error[1]}
+    else:
+        message["result"] = result
+    sys.stdout.write(json.dumps(message) + "\n")
+    sys.stdout.flush()
+
+
+def text_result(text):
+    return {"content": [{"type": "text", "text": text}], "isError": False}
+
+
+def main(args):
+    time.sleep(args.startup_delay)
+    calls = 0
+    events = {}
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        message = json.loads(line)
+        method, request_id = message.get("method"), message.get("id")
+        if request_id is None:
+            continue  # notifications
+        params = message.get("params") or {}
+        if method == "initialize":
+            reply(request_id, {"protocolVersion": params.get("protocolVersion", "2025-06-18"),
+                               "capabilities": {"tools": {}},
+                               "serverInfo": {"name": args.name, "version": "1.0"}})
+        elif method == "ping":
+            reply(request_id, {})
+        elif method == "tools/list":
+            reply(request_id, {"tools": TOOLS})
+        elif method == "tools/call":
+            calls += 1
+            time.sleep(args.latency)
+            name, arguments = params.get("name"), params.get("arguments") or {}
+            if name == "echo":
+                reply(request_id, text_result(str(arguments.get("text", ""))))
+            elif name == "slow":
+                time.sleep(float(arguments.get("seconds", 1)))
+                reply(request_id, text_result("done"))
+            elif name == "counter":
+                reply(request_id, text_result(str(calls)))
+            elif name == "list_events":
+                reply(request_id, text_result(json.dumps(events.get(arguments.get("day"), []))))
+            elif name == "create_event":
+                events.setdefault(arguments.get("day"), []).append(arguments.get("title"))
+                reply(request_id, text_result("created"))
+            else:
+                reply(request_id, error=(-32602, f"unknown tool {name}"))
+        else:
+            reply(request_id, error=(-32601, f"method {method} not found"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--startup-delay", type=float, default=1.0, help="seconds before the server reads stdin")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every tools/call")
+    parser.add_argument("--name", default="fake-mcp")
+    main(parser.parse_args())
@@ -0,0 +1,247 @@
+"""Replays recorded Gemini calls through the current runner code and checks prompt sizes.
+
+Record fixtures in production or on a test account by starting the runner
+with GEMINI_RECORD_DIR set (see scripts/gemini_recorder.py). Then, after changing
+prompt construction (get_context, load_parent_context, the plan, step and
+final prompts):
+
+    python bench/gemini_replay.py /app/data/gemini_fixtures --max-growth 10
+
+Each fixture task is restored into a temp users/ tree with the context it
+was recorded with. task_runner.process_task is then run on it until it is
+archived, with _call_gemini answering from the recording in order. Quota
+deferrals are resumed at once, as the heartbeat would. No Gemini CLI is
+started, so a replay is fast and deterministic.
+
+Reported per task:
+- prompt bytes sent by the current code against the recording, per call kind
+  (plan, step, final);
+- calls the current code made beyond the recording, and recorded calls it no
+  longer made;
+- simulated wall time: the recorded Gemini durations plus the runner's own
+  time in the replay.
+
+The check fails (exit 1) when the prompt bytes of a task, or of all tasks
+together, grew by more than --max-growth percent. --baseline compares with
+an earlier --json report instead of the recording, e.g. after an accepted
+prompt change.
+"""
+
+import os
+import sys
+import json
+import time
+import glob
+import shutil
+import argparse
+import tempfile
+import subprocess
+from collections import Counter
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "scripts"))
+sys.path.insert(0, HERE)
+
+MAX_PASSES = 200
+
+
+def prompt_kind(prompt):
+    return "plan" if "Create a checklist plan" in prompt else "final" if "FINAL ANSWER" in prompt else "step"
+
+
+def load_fixtures(root):
+    """Fixture directories (user_<id>/<task>/ with a calls.jsonl) under root, sorted."""
+    return sorted(os.path.dirname(p) for p in glob.glob(os.path.join(root, "user_*", "*", "calls.jsonl")))
+
+
+def restore(fixture, workdir):
+    """Rebuilds the fixture's user dir and core instructions; returns (user_dir, user_id, filename)."""
+    import task_parser, task_store
+    user_id = os.path.basename(os.path.dirname(fixture))[len("user_"):]
+    user_dir = os.path.join(workdir, "users", f"user_{user_id}")
+    tasks_dir = os.path.join(user_dir, "tasks")
+    for sub in ("archive", "recurrent"):
+        os.makedirs(os.path.join(tasks_dir, sub), exist_ok=True)
+    context = os.path.join(fixture, "context")
+    for name in ("instructions", "memories", "skills"):
+        if os.path.isdir(os.path.join(context, name)):
+            shutil.copytree(os.path.join(context, name), os.path.join(user_dir, name))
+    if os.path.isdir(os.path.join(context, "core_instructions")):
+        shutil.copytree(os.path.join(context, "core_instructions"), os.path.join(workdir, "core_instructions"))
+
+    filename = os.path.basename(fixture) + ".md"
+    path = os.path.join(tasks_dir, filename)
+    shutil.copyfile(os.path.join(fixture, "task.md"), path)
+    # Recorded mid-burst or while deferred: replay it right away
+    def ready(meta, body):
+        meta = {k: v for k, v in meta.items() if k not in ("coalesce_until", "run_after")}
+        if str(meta.get("status")).startswith("deferred_"):
+            meta["status"] = "planning"
+        return meta, body
+    task_store.modify(path, ready)
+    parent = task_parser.load(path).metadata.get("parent_task_id")
+    if parent and os.path.exists(os.path.join(fixture, "parent.md")):
+        shutil.copyfile(os.path.join(fixture, "parent.md"), os.path.join(tasks_dir, "archive", parent))
+    return user_dir, user_id, filename
+
+
+class Replayer:
+    """Stands in for task_runner._call_gemini, answering from a recording in order."""
+
+    def __init__(self, calls):
+        self.calls = calls
+        self.used = 0
+        self.sent = []          # (kind, prompt bytes, recorded prompt bytes or None)
+        self.gemini_seconds = 0.0
+
+    def __call__(self, prompt, user_dir, model, yolo=True, timeout=120, system_settings=None):
+        import task_runner
+        size = len(prompt.encode())
+        if self.used >= len(self.calls):
+            self.sent.append((prompt_kind(prompt), size, None))
+            return "", "replay: no recorded call left", 1
+        call = self.calls[self.used]
+        self.used += 1
+        self.sent.append((prompt_kind(prompt), size, len(call["prompt"].encode())))
+        self.gemini_seconds += call.get("seconds") or 0.0
+        if call["outcome"] == "timeout":
+            raise subprocess.TimeoutExpired(["gemini"], timeout)
+        if call["outcome"] == "cancelled":
+            raise task_runner.TaskCancelled()
+        return call["stdout"], call["stderr"], call["rc"]
+
+
+def resume_deferred(tasks_dir, filename):
+    """What the heartbeat does once run_after has passed."""
+    import task_store
+    path = os.path.join(tasks_dir, "recurrent", filename)
+    task_store.modify(path, lambda meta, body: (
+        {**{k: v for k, v in meta.items() if k != "run_after"}, "status": "planning"}, body))
+    task_store.move(path, os.path.join(tasks_dir, filename))
+
+
+def replay(fixture):
+    """Replays one fixture in a temp tree; returns its report entry."""
+    from throughput import use_paths
+    with open(os.path.join(fixture, "calls.jsonl"), 'r') as f:
+        calls = [json.loads(line) for line in f if line.strip()]
+    workdir = tempfile.mkdtemp(prefix="gemini_replay_")
+    try:
+        use_paths(workdir)
+        import task_runner, task_lease
+        os.makedirs(task_lease.RUNNERS_DIR, exist_ok=True)  # the runner's status file
+        user_dir, user_id, filename = restore(fixture, workdir)
+        tasks_dir = os.path.join(user_dir, "tasks")
+        replayer = Replayer(calls)
+        task_runner._call_gemini = replayer
+        task_runner.sanitize_gemini_config = lambda user_dir: None  # no MCP settings in the replay
+
+        state, deferrals, started = "stalled", 0, time.perf_counter()
+        for _ in range(MAX_PASSES):
+            if os.path.exists(os.path.join(tasks_dir, "archive", filename)):
+                state = "archived"
+                break
+            if os.path.exists(os.path.join(tasks_dir, "recurrent", filename)):
+                resume_deferred(tasks_dir, filename)
+                deferrals += 1
+            before = (replayer.used, len(replayer.sent), os.stat(os.path.join(tasks_dir, filename)).st_mtime_ns)
+            task_runner.process_task(user_dir, user_id, filename, task_runner.get_context(user_dir))
+            path = os.path.join(tasks_dir, filename)
+            if os.path.exists(path) and before == (replayer.used, len(replayer.sent), os.stat(path).st_mtime_ns):
+                break  # waiting for the user (confirmation, input)
+        runner_seconds = time.perf_counter() - started
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    by_kind = {}
+    for kind, size, recorded in replayer.sent:
+        entry = by_kind.setdefault(kind, {"calls": 0, "bytes": 0, "recorded_bytes": 0})
+        entry["calls"] += 1
+        entry["bytes"] += size
+        entry["recorded_bytes"] += recorded or 0
+    return {
+        "task": os.path.relpath(fixture, os.path.dirname(os.path.dirname(fixture))),
+        "state": state,
+        "calls": len(replayer.sent),
+        "recorded_calls": len(calls),
+        "extra_calls": sum(1 for _, _, recorded in replayer.sent if recorded is None),
+        "unused_calls": len(calls) - replayer.used,
+        "deferrals": deferrals,
+        "prompt_bytes": sum(size for _, size, _ in replayer.sent),
+        "recorded_prompt_bytes": sum(len(c["prompt"].encode()) for c in calls[:replayer.used]),
+        "by_kind": by_kind,
+        "gemini_seconds": round(replayer.gemini_seconds, 3),
+        "simulated_seconds": round(replayer.gemini_seconds + runner_seconds, 3),
+    }
+
+
+def growth(new, old):
+    return (new - old) / old * 100 if old else 0.0
+
+
+def set_reference(tasks, baseline):
+    """Sets each task's reference_bytes: the baseline report's prompt bytes, else the recording's."""
+    old_bytes = {t["task"]: t["prompt_bytes"] for t in baseline["tasks"]} if baseline else {}
+    for t in tasks:
+        t["reference_bytes"] = old_bytes.get(t["task"]) if baseline else t["recorded_prompt_bytes"]
+
+
+def check(tasks, max_growth):
+    """Tasks (and the total) whose prompt bytes grew by more than max_growth percent: [(name, new, old, %)]."""
+    failures, new_total, old_total = [], 0, 0
+    for t in tasks:
+        old = t["reference_bytes"]
+        if old is None:
+            continue  # not in the baseline
+        new_total += t["prompt_bytes"]
+        old_total += old
+        if growth(t["prompt_bytes"], old) > max_growth:
+            failures.append((t["task"], t["prompt_bytes"], old, growth(t["prompt_bytes"], old)))
+    if growth(new_total, old_total) > max_growth:
+        failures.append(("(all tasks)", new_total, old_total, growth(new_total, old_total)))
+    return failures
+
+
+def print_report(tasks, failures, reference):
+    print(f"{'Task':<48} {'state':>8} {'calls':>6} {'prompt KB':>10} {'vs ' + reference:>12} {'sim s':>8}")
+    for t in tasks:
+        print(f"{t['task'][:48]:<48} {t['state']:>8} {t['calls']:>6} {t['prompt_bytes'] / 1024:>10.1f} "
+              f"{growth(t['prompt_bytes'], t['reference_bytes'] or t['prompt_bytes']):>+11.1f}% "
+              f"{t['simulated_seconds']:>8.1f}")
+        for kind, k in sorted(t["by_kind"].items()):
+            print(f"  {kind:<46} {'':>8} {k['calls']:>6} {k['bytes'] / 1024:>10.1f} "
+                  f"{growth(k['bytes'], k['recorded_bytes']):>+11.1f}%")
+        notes = [f"{t[n]} {n.replace('_', ' ')}" for n in ("extra_calls", "unused_calls", "deferrals") if t[n]]
+        if notes:
+            print(f"  ({', '.join(notes)})")
+    states = Counter(t["state"] for t in tasks)
+    print(f"\n{len(tasks)} tasks ({', '.join(f'{n} {s}' for s, n in states.items())}), "
+          f"simulated {sum(t['simulated_seconds'] for t in tasks):.1f}s, "
+          f"of which Gemini {sum(t['gemini_seconds'] for t in tasks):.1f}s")
+    for name, new, old, pct in failures:
+        print(f"FAIL {name}: prompt bytes {old} -> {new} ({pct:+.1f}%)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("fixtures", help="GEMINI_RECORD_DIR of the recording")
+    parser.add_argument("--max-growth", type=float, default=10, help="allowed prompt byte growth, percent")
+    parser.add_argument("--baseline", help="earlier --json report to compare with instead of the recording")
+    parser.add_argument("--json", help="write the report to this file")
+    args = parser.parse_args()
+
+    fixtures = load_fixtures(args.fixtures)
+    if not fixtures:
+        sys.exit(f"No fixtures under {args.fixtures}")
+    tasks = [replay(fixture) for fixture in fixtures]
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+    set_reference(tasks, baseline)
+    failures = check(tasks, args.max_growth)
+    print_report(tasks, failures, "baseline" if baseline else "recorded")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({"tasks": tasks, "max_growth": args.max_growth}, f, indent=1)
+    sys.exit(1 if failures else 0)
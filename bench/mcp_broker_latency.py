@@ -0,0 +1,157 @@
+"""Per-step MCP overhead of a Gemini call, with and without mcp_broker.
+
+Each "step" does what Gemini CLI does with every configured MCP server at
+the start of a call: connect, initialize, tools/list, then one tools/call,
+and disconnect at the end. The servers are bench/fake_mcp_server.py with
+--startup-delay standing in for real startup time.
+
+- direct: the server is spawned over stdio and killed after the step, as
+  Gemini does on its own;
+- broker: an in-process mcp_broker serves a synthetic user whose
+  settings.json lists the same servers; the step connects over SSE. The
+  first step pays the server start, later ones reuse the warm process.
+
+    python bench/mcp_broker_latency.py --steps 10 --servers 3 --startup-delay 1.5
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+import statistics
+
+import aiohttp
+from aiohttp import web
+from yarl import URL
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "scripts"))
+
+import mcp_broker
+
+FAKE_SERVER = os.path.join(HERE, "fake_mcp_server.py")
+INIT_PARAMS = {"protocolVersion": "2025-06-18", "capabilities": {},
+               "clientInfo": {"name": "bench", "version": "1.0"}}
+STEP_REQUESTS = [("tools/list", {}), ("tools/call", {"name": "echo", "arguments": {"text": "hi"}})]
+
+
+def server_spec(args, name):
+    return {"command": sys.executable, "args": [FAKE_SERVER, "--startup-delay", str(args.startup_delay), "--name", name]}
+
+
+async def direct_session(spec):
+    proc = await asyncio.create_subprocess_exec(
+        spec["command"], *spec["args"], stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE)
+
+    async def call(request_id, method, params):
+        proc.stdin.write(json.dumps({"jsonrpc": "2.0", "id": request_id, "method": method, "params": params}).encode() + b"\n")
+        await proc.stdin.drain()
+        while True:
+            message = json.loads(await proc.stdout.readline())
+            if message.get("id") == request_id:
+                return message
+
+    try:
+        await call(1, "initialize", INIT_PARAMS)
+        proc.stdin.write(b'{"jsonrpc": "2.0", "method": "notifications/initialized"}\n')
+        for n, (method, params) in enumerate(STEP_REQUESTS, 2):
+            assert "result" in await call(n, method, params)
+    finally:
+        proc.kill()
+        await proc.wait()
+
+
+async def broker_session(http, url):
+    async with http.get(url) as resp:
+        events = sse_events(resp.content)
+        kind, data = await anext(events)
+        assert kind == "endpoint", kind
+        post_url = str(resp.url.join(URL(data)))
+
+        async def call(request_id, method, params):
+            await http.post(post_url, json={"jsonrpc": "2.0", "id": request_id, "method": method, "params": params})
+            async for kind, data in events:
+                message = json.loads(data)
+                if kind == "message" and message.get("id") == request_id:
+                    return message
+
+        await call(1, "initialize", INIT_PARAMS)
+        await http.post(post_url, json={"jsonrpc": "2.0", "method": "notifications/initialized"})
+        for n, (method, params) in enumerate(STEP_REQUESTS, 2):
+            message = await call(n, method, params)
+            assert "result" in message, message
+
+
+async def sse_events(stream):
+    kind, data = "message", []
+    async for raw in stream:
+        line = raw.decode().rstrip("\r\n")
+        if not line:
+            if data:
+                yield kind, "\n".join(data)
+            kind, data = "message", []
+        elif line.startswith("event:"):
+            kind = line[6:].strip()
+        elif line.startswith("data:"):
+            data.append(line[5:].strip())
+
+
+async def timed_steps(args, step):
+    times = []
+    for _ in range(args.steps):
+        started = time.perf_counter()
+        await asyncio.gather(*(step(f"srv{i}") for i in range(args.servers)))
+        times.append(time.perf_counter() - started)
+    return times
+
+
+def report(label, times):
+    rest = times[1:] or times
+    print(f"{label:<8} first {times[0] * 1000:8.1f} ms   then median {statistics.median(rest) * 1000:8.1f} ms   "
+          f"total {sum(times):6.2f} s")
+
+
+async def main(args):
+    workdir = tempfile.mkdtemp(prefix="mcp_broker_bench_")
+    specs = {f"srv{i}": server_spec(args, f"srv{i}") for i in range(args.servers)}
+    user_dir = os.path.join(workdir, "user_1", ".gemini")
+    os.makedirs(user_dir)
+    with open(os.path.join(user_dir, "settings.json"), 'w') as f:
+        json.dump({"mcpServers": specs}, f)
+
+    mcp_broker.LOG_DIR = workdir
+    mcp_broker.SETTINGS_DIR = workdir  # the user's broker token
+    broker = mcp_broker.Broker(users_root=workdir)
+    runner = web.AppRunner(broker.make_app())
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    print(f"{args.steps} steps, {args.servers} MCP servers per step, {args.startup_delay}s server startup\n")
+    try:
+        direct = await timed_steps(args, lambda name: direct_session(specs[name]))
+        async with aiohttp.ClientSession(headers=mcp_broker.auth_headers("1")) as http:
+            brokered = await timed_steps(
+                args, lambda name: broker_session(http, f"http://127.0.0.1:{port}/u/1/{name}/sse"))
+        report("direct", direct)
+        report("broker", brokered)
+        print(f"\nMCP overhead per step: {statistics.median(direct) * 1000:.0f} ms -> "
+              f"{statistics.median(brokered[1:] or brokered) * 1000:.0f} ms once warm; "
+              f"server starts: {sum(s.starts for s in broker.servers.values())} "
+              f"(direct: {args.steps * args.servers})")
+    finally:
+        await runner.cleanup()
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--servers", type=int, default=2, help="MCP servers configured for the user")
+    parser.add_argument("--startup-delay", type=float, default=1.0, help="fake server startup time, seconds")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,137 @@
+"""MCP tool time of a digest-like workload with and without the mcp_cache TTL cache.
+
+An in-process mcp_broker serves one user with bench/fake_mcp_server.py as a
+"calendar" server whose tool calls take --latency seconds. Every step, like
+one Gemini call, opens a session and lists the events of a few days, some
+of them twice; every --write-every steps it creates an event and lists that
+day again, which must show the new event (a stale cache would not).
+
+The workload runs once without .gemini/mcp_cache.json and once with
+list_events cached for --ttl seconds.
+
+    python bench/mcp_cache_bench.py --steps 30 --latency 0.2
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import asyncio
+import argparse
+import tempfile
+
+import aiohttp
+from aiohttp import web
+from yarl import URL
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "scripts"))
+sys.path.insert(0, HERE)
+
+import mcp_broker
+from mcp_broker_latency import FAKE_SERVER, INIT_PARAMS, sse_events
+
+DAYS = ["mon", "tue", "wed", "thu", "fri"]
+
+
+class Client:
+    """One SSE session, the way a Gemini call talks to the broker."""
+
+    def __init__(self, http, url):
+        self.http, self.url, self.next_id = http, url, 0
+
+    async def __aenter__(self):
+        self.resp = await self.http.get(self.url)
+        self.events = sse_events(self.resp.content)
+        kind, data = await anext(self.events)
+        self.post_url = str(self.resp.url.join(URL(data)))
+        await self.request("initialize", INIT_PARAMS)
+        return self
+
+    async def __aexit__(self, *exc):
+        self.resp.close()
+
+    async def request(self, method, params):
+        self.next_id += 1
+        await self.http.post(self.post_url, json={"jsonrpc": "2.0", "id": self.next_id, "method": method, "params": params})
+        async for kind, data in self.events:
+            message = json.loads(data)
+            if message.get("id") == self.next_id:
+                return message["result"]
+
+    async def tool(self, name, **arguments):
+        result = await self.request("tools/call", {"name": name, "arguments": arguments})
+        return result["content"][0]["text"]
+
+
+async def workload(args, http, url):
+    rng = random.Random(args.seed)
+    created = {}
+    stale = 0
+    tool_time = 0.0
+    for step in range(1, args.steps + 1):
+        async with Client(http, url) as client:
+            started = time.perf_counter()
+            for day in rng.sample(DAYS, 3) + [rng.choice(DAYS)]:
+                events = json.loads(await client.tool("list_events", day=day))
+                stale += events != created.get(day, [])
+            if step % args.write_every == 0:
+                day = rng.choice(DAYS)
+                await client.tool("create_event", day=day, title=f"event {step}")
+                created.setdefault(day, []).append(f"event {step}")
+                stale += json.loads(await client.tool("list_events", day=day)) != created[day]
+            tool_time += time.perf_counter() - started
+    return tool_time, stale
+
+
+async def run(args, cached):
+    workdir = tempfile.mkdtemp(prefix="mcp_cache_bench_")
+    gemini_dir = os.path.join(workdir, "user_1", ".gemini")
+    os.makedirs(gemini_dir)
+    spec = {"command": sys.executable,
+            "args": [FAKE_SERVER, "--startup-delay", "0", "--latency", str(args.latency), "--name", "calendar"]}
+    with open(os.path.join(gemini_dir, "settings.json"), 'w') as f:
+        json.dump({"mcpServers": {"calendar": spec}}, f)
+    if cached:
+        with open(os.path.join(gemini_dir, "mcp_cache.json"), 'w') as f:
+            json.dump({"calendar": {"ttl": {"list_events": args.ttl}}}, f)
+
+    mcp_broker.LOG_DIR = workdir
+    mcp_broker.SETTINGS_DIR = workdir  # the user's broker token
+    broker = mcp_broker.Broker(users_root=workdir)
+    runner = web.AppRunner(broker.make_app())
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    try:
+        async with aiohttp.ClientSession(headers=mcp_broker.auth_headers("1")) as http:
+            tool_time, stale = await workload(args, http, f"http://127.0.0.1:{port}/u/1/calendar/sse")
+        return tool_time, stale, broker.servers[("1", "calendar")].stats().get("cache")
+    finally:
+        await runner.cleanup()
+        shutil.rmtree(workdir)
+
+
+async def main(args):
+    print(f"{args.steps} steps, {args.latency * 1000:.0f} ms per tool call, a write every {args.write_every} steps\n")
+    for cached in (False, True):
+        tool_time, stale, cache = await run(args, cached)
+        label = f"cache (ttl {args.ttl:.0f}s)" if cached else "no cache"
+        print(f"{label:<16} tool time {tool_time:6.2f} s   {tool_time / args.steps * 1000:7.1f} ms/step   stale reads {stale}")
+        if cache:
+            for tool, counts in cache["tools"].items():
+                print(f"{'':<16} {tool}: {counts['hits']} hits, {counts['misses']} misses "
+                      f"(hit rate {counts['hit_rate']:.0%}), {cache['invalidations']} invalidations")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--steps", type=int, default=30)
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds per tool call on the fake server")
+    parser.add_argument("--write-every", type=int, default=5)
+    parser.add_argument("--ttl", type=float, default=300)
+    parser.add_argument("--seed", type=int, default=1)
+    asyncio.run(main(parser.parse_args()))
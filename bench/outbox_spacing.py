@@ -0,0 +1,60 @@
+"""Checks that outbound.Outbox keeps its per-chat spacing for sparse sends.
+
+Sends --count messages to one chat, --gap seconds apart, so the chat's queue
+drains between them. A stub bot records when each one went out. Every pair
+of consecutive sends must be at least 1/rate apart (PRIVATE_CHAT_RATE, or
+GROUP_CHAT_RATE for a negative --chat). Exits 1 on a violation.
+
+    python bench/outbox_spacing.py --count 6 --gap 0.1
+"""
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+
+import outbound
+
+TOLERANCE = 0.02     # seconds of timer slack
+
+
+class StubBot:
+    def __init__(self):
+        self.sent_at = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent_at.append(time.monotonic())
+        return text
+
+
+async def run(chat_id, count, gap):
+    bot = StubBot()
+    outbox = outbound.Outbox(bot)
+    futures = []
+    for i in range(count):
+        futures.append(outbox.send(chat_id, text=f"message {i}"))
+        await asyncio.sleep(gap)
+    await asyncio.gather(*futures)
+    return bot.sent_at
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chat", type=int, default=1001, help="chat id (negative: group rate)")
+    parser.add_argument("--count", type=int, default=6)
+    parser.add_argument("--gap", type=float, default=0.1, help="seconds between submissions")
+    args = parser.parse_args()
+
+    rate = outbound.GROUP_CHAT_RATE if args.chat < 0 else outbound.PRIVATE_CHAT_RATE
+    sent_at = asyncio.run(run(args.chat, args.count, args.gap))
+    offsets = [t - sent_at[0] for t in sent_at]
+    print("Sent at: " + " ".join(f"{o:.2f}s" for o in offsets))
+    spacing = [b - a for a, b in zip(sent_at, sent_at[1:])]
+    too_close = [s for s in spacing if s < 1 / rate - TOLERANCE]
+    if too_close:
+        print(f"FAIL: {len(too_close)} of {len(spacing)} gaps below {1 / rate:.2f}s (min {min(spacing):.2f}s)")
+        sys.exit(1)
+    print(f"OK: all {len(spacing)} gaps >= {1 / rate:.2f}s")
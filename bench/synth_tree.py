@@ -0,0 +1,97 @@
+"""Generates a synthetic users/ tree for the offline benchmarks.
+
+For each of --users users (ids 100001, 100002, ...):
+- --queued tasks in tasks/, as the gateway creates them (request only, status planning);
+- --archived finished tasks in tasks/archive/ with plans, step results and an
+  answer, already delivered (status_message_id set, a day old);
+- --recurrent templates in tasks/recurrent/ scheduled for the current minute,
+  so the heartbeat spawns each once;
+- a few memories and instructions (read into every prompt) and an empty
+  .gemini/settings.json.
+
+    python bench/synth_tree.py /tmp/users --users 20 --queued 5 --archived 200 --recurrent 2
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+from datetime import datetime
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "scripts"))
+sys.path.insert(0, HERE)
+
+import task_store
+from task_parse_bench import make_task, sentence
+
+FIRST_USER_ID = 100001
+DAY = 86400
+
+
+def user_ids(users):
+    return [str(FIRST_USER_ID + i) for i in range(users)]
+
+
+def _new_task(rng, user_id, text, **extra):
+    metadata = {
+        "task_id": None, "user_id": user_id, "chat_id": int(user_id), "trigger_message_id": rng.randint(1, 10 ** 6),
+        "parent_task_id": None, "status": "planning", "created_at": datetime.now().isoformat(),
+        "trace_id": "%016x" % rng.getrandbits(64),
+    }
+    metadata.update(extra)
+    return metadata, f"\n\n# Request\n{text}\n\n# Plan\n\n# History\n"
+
+
+def generate(root, users, queued, archived, recurrent, seed=1):
+    """Writes the tree under root; returns {"users", "queued", "archived", "recurrent"} totals."""
+    rng = random.Random(seed)
+    now = datetime.now()
+    old = time.time() - DAY
+    for user_id in user_ids(users):
+        user_dir = os.path.join(root, f"user_{user_id}")
+        tasks_dir = os.path.join(user_dir, "tasks")
+        for sub in ("tasks/archive", "tasks/recurrent", "memories", "instructions", ".gemini"):
+            os.makedirs(os.path.join(user_dir, sub), exist_ok=True)
+        with open(os.path.join(user_dir, ".gemini", "settings.json"), 'w') as f:
+            json.dump({"mcpServers": {}}, f)
+        for n in range(3):
+            with open(os.path.join(user_dir, "memories", f"fact_{n}.md"), 'w') as f:
+                f.write(sentence(rng, 150) + "\n")
+        with open(os.path.join(user_dir, "instructions", "style.md"), 'w') as f:
+            f.write(sentence(rng, 100) + "\n")
+
+        for i in range(queued):
+            name = f"task_{now:%Y%m%d_%H%M%S}_{i:04d}.md"
+            metadata, body = _new_task(rng, user_id, sentence(rng, 20))
+            task_store.create(os.path.join(tasks_dir, name), dict(metadata, task_id=name), body)
+
+        for i in range(archived):
+            name = f"task_20260101_000000_{i:05d}.md"
+            metadata, body = make_task(rng, i)
+            metadata.update(task_id=name, user_id=user_id, chat_id=int(user_id), status="done")
+            path = os.path.join(tasks_dir, "archive", name)
+            task_store.create(path, metadata, body)
+            os.utime(path, (old, old))
+
+        for i in range(recurrent):
+            name = f"digest_{i}.md"
+            metadata, body = _new_task(rng, user_id, f"Daily digest {i}: {sentence(rng, 12)}",
+                                       regular=True, schedule={"times": [now.strftime("%H:%M")]})
+            task_store.create(os.path.join(tasks_dir, "recurrent", name), dict(metadata, task_id=name), body)
+
+    return {"users": users, "queued": users * queued, "archived": users * archived, "recurrent": users * recurrent}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("root", help="users directory to create (like /app/users)")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--queued", type=int, default=5, help="queued tasks per user")
+    parser.add_argument("--archived", type=int, default=200, help="archived tasks per user")
+    parser.add_argument("--recurrent", type=int, default=2, help="recurrent templates per user")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    print(generate(args.root, args.users, args.queued, args.archived, args.recurrent, args.seed))
@@ -0,0 +1,119 @@
+"""Parse cost per task file: the old per-caller parsing vs task_parser, cold and cached.
+
+Generates a synthetic archive of --tasks task files (plans of 3-12 steps,
+step results of a few KB, some confirmations and USER INPUT sections), then
+times for each file:
+
+- legacy: what each caller did on its own before task_parser, i.e.
+  split('---') + yaml.safe_load + the section regexes, repeated for the
+  --consumers callers that read the same file (runner, notifier, gateway);
+- parse: task_parser.parse() of the text with every derived field accessed
+  (libyaml C loader when available);
+- load (cold): task_parser.load() with an empty cache, including the read;
+- load (cached): task_parser.load() again, the file unchanged.
+
+    python bench/task_parse_bench.py --tasks 5000
+"""
+
+import os
+import re
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+
+import task_parser
+import task_store
+
+WORDS = "search analyze summarize calendar email draft compare weather budget report notes".split()
+
+
+def sentence(rng, n):
+    return " ".join(rng.choice(WORDS) for _ in range(n))
+
+
+def make_task(rng, i):
+    steps = [sentence(rng, rng.randint(3, 8)) for _ in range(rng.randint(3, 12))]
+    plan = "".join(f"- [x] {s}\n" for s in steps)
+    history = "".join(f"\n\n## {s}\n{sentence(rng, rng.randint(50, 600))}\n" for s in steps)
+    if rng.random() < 0.2:
+        history += f"\n<confirm>{sentence(rng, 6)}?</confirm>\n\n--- USER DECISION ---\n✅ Да\n"
+    if rng.random() < 0.2:
+        history += f"\n\n--- USER INPUT ---\n{sentence(rng, 12)}\n"
+    history += f"\n\n--- RESULT (12:00) ---\n<thought>{sentence(rng, 30)}</thought><answer>{sentence(rng, 80)}</answer>\n"
+    metadata = {
+        "task_id": f"task_{i:06d}.md", "user_id": "1", "chat_id": 1, "trigger_message_id": i,
+        "parent_task_id": None, "status": "planning", "created_at": "2026-01-01T12:00:00",
+        "status_message_id": 100000 + i, "last_status_hash": f"{rng.getrandbits(128):032x}",
+    }
+    body = f"\n\n# Request\n{sentence(rng, 20)}\n\n# Plan\n{plan}\n# History\n{history}"
+    return metadata, body
+
+
+def legacy_parse(content):
+    parts = content.split('---', 2)
+    metadata = yaml.safe_load(parts[1]) or {}
+    body = parts[2]
+    re.search(r'# Request\n(.*?)\n#', body, re.DOTALL)
+    re.search(r'# Plan\n(.*?)\n#', body, re.DOTALL)
+    re.search(r'# History\n(.*)', body, re.DOTALL)
+    re.search(r'<answer>(.*?)</answer>', body, re.DOTALL | re.IGNORECASE)
+    re.search(r'<confirm>(.*?)</confirm>', body, re.DOTALL)
+    "<confirm>" in content and "--- USER DECISION ---" not in content.split("<confirm>")[-1]
+    return metadata
+
+
+def touch_all(task):
+    return (task.metadata, task.request, task.plan, task.next_step, task.history, task.decisions,
+            task.answer, task.confirm, task.awaiting_confirmation, task.cancelled)
+
+
+def timed(label, paths, fn, total_label_width=16):
+    started = time.perf_counter()
+    for path in paths:
+        fn(path)
+    elapsed = time.perf_counter() - started
+    print(f"{label:<{total_label_width}}{elapsed * 1e6 / len(paths):>10.1f} µs/task{elapsed:>10.2f} s total")
+    return elapsed
+
+
+def main(args):
+    rng = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix="task_parse_bench_")
+    paths = []
+    for i in range(args.tasks):
+        path = os.path.join(workdir, f"task_{i:06d}.md")
+        task_store.create(path, *make_task(rng, i))
+        paths.append(path)
+    texts = {}
+    for path in paths:
+        with open(path, 'r') as f:
+            texts[path] = f.read()
+    size = sum(len(t) for t in texts.values())
+    task_parser.CACHE_SIZE = max(task_parser.CACHE_SIZE, args.tasks)
+
+    print(f"{args.tasks} tasks, {size / args.tasks / 1024:.1f} KiB average, "
+          f"YAML loader: {task_parser._YamlLoader.__name__}\n")
+    legacy = timed(f"legacy x{args.consumers}", paths,
+                   lambda p: [legacy_parse(texts[p]) for _ in range(args.consumers)])
+    timed("parse", paths, lambda p: touch_all(task_parser.parse(texts[p])))
+    task_parser.clear_cache()
+    cold = timed("load (cold)", paths, lambda p: touch_all(task_parser.load(p)))
+    warm = sum(timed("load (cached)", paths, lambda p: touch_all(task_parser.load(p))) for _ in range(args.consumers - 1))
+    print(f"\n{args.consumers} readers per file: {legacy:.2f}s before, {cold + warm:.2f}s with the shared parser "
+          f"({legacy / (cold + warm):.1f}x)")
+    shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tasks", type=int, default=2000)
+    parser.add_argument("--consumers", type=int, default=3, help="callers reading each file")
+    parser.add_argument("--seed", type=int, default=1)
+    main(parser.parse_args())
@@ -0,0 +1,157 @@
+"""Concurrent writers on one task file: checks that task_store loses no updates.
+
+Runs, as separate processes against the same task .md file:
+- one runner that, like task_runner, reads the task, "calls Gemini" (sleeps
+  --work seconds), ticks the next plan step and rewrites # History;
+- --appenders processes appending USER INPUT sections, like the gateway;
+- --metadata-writers processes incrementing a frontmatter counter, like
+  notify_results storing status_message_id / last_status_hash.
+
+Afterwards every appended section, every counter increment and every plan
+step must be in the file. --naive does the same with plain read-modify-write
+(what the code did before task_store) to show the lost updates.
+
+    python bench/task_store_stress.py --appenders 4 --metadata-writers 2 --steps 20
+"""
+
+import os
+import re
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+
+import task_store
+
+
+def naive_modify(path, fn):
+    doc = task_store.read(path)
+    if doc is None:
+        raise ValueError("torn read (file caught half-written)")
+    metadata, body = fn(dict(doc.metadata), doc.body)
+    with open(path, 'w') as f:
+        f.write(task_store.render(metadata, body))
+
+
+def naive_save(path, base, metadata, body):
+    with open(path, 'w') as f:
+        f.write(task_store.render(metadata, body))
+    return task_store.TaskDoc(metadata, body, base.version + 1)
+
+
+def _attempt(fn, *args):
+    """1 if the write raised (torn read, conflict), else 0."""
+    try:
+        fn(*args)
+        return 0
+    except Exception:
+        return 1
+
+
+def runner(path, steps, work, naive, results):
+    save = naive_save if naive else task_store.save
+    errors = 0
+    for step in range(1, steps + 1):
+        try:
+            doc = task_store.read(path)
+            if doc is None:
+                raise ValueError("torn read (file caught half-written)")
+            body = doc.body.replace(f"- [ ] step {step}\n", f"- [/] step {step}\n")
+            doc = save(path, doc, doc.metadata, body)
+            time.sleep(random.uniform(0, 2 * work))  # Gemini
+            history = re.search(r'# History\n(.*)', doc.body, re.DOTALL).group(1)
+            body = doc.body.replace(f"- [/] step {step}\n", f"- [x] step {step}\n")
+            body = re.sub(r'# History\n(.*)', lambda _: f"# History\n{history}\n## step {step}\nresult {step}\n", body, flags=re.DOTALL)
+            save(path, doc, doc.metadata, body)
+        except Exception as e:
+            errors += 1
+            if not naive:
+                print(f"runner: step {step}: {e}", flush=True)
+    results.put(("runner", errors, dict(task_store.stats)))
+
+
+def appender(path, index, count, interval, naive, results):
+    modify = naive_modify if naive else task_store.modify
+    errors = 0
+    for n in range(count):
+        section = f"\n\n--- USER INPUT ---\nappender {index} message {n}\n"
+        errors += _attempt(modify, path, lambda metadata, body: (metadata, body + section))
+        time.sleep(random.uniform(0, 2 * interval))
+    results.put(("appender", errors, dict(task_store.stats)))
+
+
+def metadata_writer(path, count, interval, naive, results):
+    modify = naive_modify if naive else task_store.modify
+    errors = 0
+    for _ in range(count):
+        errors += _attempt(modify, path, lambda metadata, body: (dict(metadata, counter=metadata.get("counter", 0) + 1), body))
+        time.sleep(random.uniform(0, 2 * interval))
+    results.put(("metadata", errors, dict(task_store.stats)))
+
+
+def main(args):
+    workdir = tempfile.mkdtemp(prefix="task_store_stress_")
+    path = os.path.join(workdir, "task_stress.md")
+    plan = "".join(f"- [ ] step {i}\n" for i in range(1, args.steps + 1))
+    task_store.create(path, {"status": "planning", "counter": 0},
+                      f"\n\n# Request\nstress\n\n# Plan\n{plan}\n# History\n")
+    task_store.stats.update(writes=0)  # counted per writer process from here on
+
+    results = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=runner, args=(path, args.steps, args.work, args.naive, results))]
+    procs += [multiprocessing.Process(target=appender, args=(path, i, args.count, args.interval, args.naive, results))
+              for i in range(args.appenders)]
+    procs += [multiprocessing.Process(target=metadata_writer, args=(path, args.count, args.interval, args.naive, results))
+              for _ in range(args.metadata_writers)]
+
+    started = time.monotonic()
+    for p in procs:
+        p.start()
+    reports = [results.get() for _ in procs]
+    for p in procs:
+        p.join()
+    elapsed = time.monotonic() - started
+
+    doc = task_store.read(path) or task_store.TaskDoc({}, "", 0)
+    missing_inputs = sum(
+        1 for i in range(args.appenders) for n in range(args.count)
+        if f"appender {i} message {n}\n" not in doc.body
+    )
+    missing_steps = sum(
+        1 for s in range(1, args.steps + 1)
+        if f"- [x] step {s}\n" not in doc.body or f"## step {s}\nresult {s}\n" not in doc.body
+    )
+    lost_increments = args.metadata_writers * args.count - doc.metadata.get("counter", 0)
+    totals = {key: sum(stats.get(key, 0) for _, _, stats in reports) for key in ("writes", "conflicts", "merges")}
+    failed_writes = sum(errors for _, errors, _ in reports)
+
+    print(f"mode: {'naive read-modify-write' if args.naive else 'task_store'}, "
+          f"{len(procs)} writer processes, {elapsed:.1f}s")
+    print(f"writes {totals['writes']}  conflicts {totals['conflicts']}  merges {totals['merges']}  "
+          f"failed writes {failed_writes}  final version {doc.version}")
+    print(f"lost USER INPUT sections: {missing_inputs}/{args.appenders * args.count}")
+    print(f"lost counter increments:  {lost_increments}/{args.metadata_writers * args.count}")
+    print(f"lost plan steps:          {missing_steps}/{args.steps}")
+    if args.keep:
+        print(f"task file: {path}")
+    else:
+        shutil.rmtree(workdir)
+    return 0 if args.naive or not (missing_inputs or missing_steps or lost_increments or failed_writes) else 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--appenders", type=int, default=4)
+    parser.add_argument("--metadata-writers", type=int, default=2)
+    parser.add_argument("--count", type=int, default=50, help="writes per appender / metadata writer")
+    parser.add_argument("--interval", type=float, default=0.005, help="mean pause between their writes, seconds")
+    parser.add_argument("--steps", type=int, default=20, help="plan steps the runner executes")
+    parser.add_argument("--work", type=float, default=0.02, help="mean simulated Gemini call, seconds")
+    parser.add_argument("--naive", action="store_true", help="plain read-modify-write, for comparison")
+    parser.add_argument("--keep", action="store_true", help="keep the task file for inspection")
+    sys.exit(main(parser.parse_args()))
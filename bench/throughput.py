@@ -0,0 +1,381 @@
+"""Offline throughput of task_runner, heartbeat and the notifier on a synthetic users/ tree.
+
+Generates a tree with bench/synth_tree.py and runs the real service code on
+it, each service in its own process with every /app path pointed into a temp
+directory:
+- --runners task runners (the loop of task_runner's __main__), calling
+  bench/fake_gemini.py as GEMINI_BIN; git auto-commit is skipped;
+- the heartbeat, every --heartbeat-interval seconds (production: 60);
+- the notifier (state_inspector.notify_results) with a fake Outbox, if
+  aiogram is installed.
+
+The run ends when every queued task and every spawned recurrent task is
+archived, or after --max-seconds. Reported:
+- tasks/minute;
+- per-stage latency, Gemini call latency and message-to-answer latency, from
+  the services' metrics histograms (see metrics.py; percentiles are
+  interpolated within buckets);
+- wall time, CPU and I/O per loop iteration of each service. The runner's
+  child CPU is the fake Gemini processes. I/O is rchar/wchar from
+  /proc/self/io, pipes included.
+
+--json writes the report, and --compare prints the change against an
+earlier one, for release-to-release comparisons on the same box.
+
+    python bench/throughput.py --users 20 --queued 5 --archived 200 --runners 2 \\
+        --latency lognormal:0.5,0.5 --quota-rate 0.02 --json report.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import resource
+import tempfile
+import functools
+import statistics
+import multiprocessing
+from types import SimpleNamespace
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "scripts"))
+sys.path.insert(0, HERE)
+
+import metrics
+import tracing
+import synth_tree
+
+FAKE_GEMINI = os.path.join(HERE, "fake_gemini.py")
+RUNNER_WAIT = 2  # task_runner's idle wait between passes
+
+
+def use_paths(workdir):
+    """Points the services' /app paths into workdir. Call in each service process before running it."""
+    import task_runner, heartbeat, task_lease, runner_wakeup, events, notification_spool, msg_index, mcp_broker, tracing, usage
+    users, data = os.path.join(workdir, "users"), os.path.join(workdir, "data")
+    task_runner.USERS_ROOT = heartbeat.USERS_ROOT = msg_index.USERS_ROOT = users
+    task_runner.CORE_INSTRUCTIONS_DIR = os.path.join(workdir, "core_instructions")
+    task_runner.commit_user_repo = lambda user_id, message: None  # git sync is not part of this benchmark
+    task_lease.LEASE_DIR = os.path.join(data, "leases")
+    task_lease.RUNNERS_DIR = os.path.join(data, "runners")
+    runner_wakeup.RUNNER_SOCKET_DIR = os.path.join(data, "runner_sockets")
+    events.EVENTS_SOCKET = os.path.join(data, "events.sock")
+    notification_spool.SPOOL_DB = os.path.join(data, "notifications.db")
+    notification_spool.LEGACY_DIR = os.path.join(data, "notifications")
+    msg_index.INDEX_DIR = os.path.join(data, "msg_index")
+    mcp_broker.SETTINGS_DIR = os.path.join(data, "mcp_broker")
+    metrics.METRICS_DIR = os.path.join(data, "metrics")
+    tracing.TRACE_DIR = os.path.join(data, "traces")
+    usage.USAGE_DIR = os.path.join(data, "usage")
+    task_runner.OUTPUT_DIR = os.path.join(data, "gemini_output")
+    for path in (data, runner_wakeup.RUNNER_SOCKET_DIR, msg_index.INDEX_DIR):
+        os.makedirs(path, exist_ok=True)
+
+
+def _io():
+    counters = {}
+    try:
+        with open("/proc/self/io", 'r') as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                counters[key] = int(value)
+    except OSError:
+        pass
+    return counters.get("rchar", 0), counters.get("wchar", 0)
+
+
+def _sample():
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (time.perf_counter(), time.process_time(), children.ru_utime + children.ru_stime, *_io())
+
+
+class Loops:
+    """Wall, CPU, child CPU and I/O of each loop iteration."""
+
+    def __init__(self):
+        self.samples = []
+
+    def measure(self, fn, *args):
+        before = _sample()
+        fn(*args)
+        self.samples.append([b - a for a, b in zip(before, _sample())])
+
+    def summary(self, iterations=None):
+        if not self.samples:
+            return {"loops": 0}
+        n = iterations or len(self.samples)
+        walls = sorted(s[0] for s in self.samples)
+        totals = [sum(column) for column in zip(*self.samples)]
+        return {
+            "loops": n,
+            "wall_p50_ms": statistics.median(walls) * 1000,
+            "wall_p95_ms": walls[min(len(walls) - 1, int(len(walls) * 0.95))] * 1000,
+            "cpu_ms": totals[1] / n * 1000,
+            "child_cpu_ms": totals[2] / n * 1000,
+            "read_kb": totals[3] / n / 1024,
+            "write_kb": totals[4] / n / 1024,
+        }
+
+
+# --- Services (each runs in its own process) ---
+
+def runner_service(workdir, index, env, stop, results):
+    os.environ.update(env)  # GEMINI_BIN and GEMINI_TIMEOUT are read when task_runner is imported
+    use_paths(workdir)
+    import task_runner, task_lease, runner_wakeup
+    name = f"runner-{index}"
+    metrics.init(name)
+    tracing.init("runner")
+    task_runner.leases = task_lease.LeaseManager(f"bench-{name}")
+    task_runner.leases.start()
+    inbox = task_runner.inbox = runner_wakeup.Inbox(name=name)
+    loops = Loops()
+    woken = []
+    while not stop.is_set():
+        loops.measure(task_runner.process_tasks, inbox, woken)
+        woken = inbox.wait(RUNNER_WAIT)
+    task_runner.leases.shutdown()
+    inbox.close()
+    metrics.flush()
+    results.put((name, loops.summary()))
+
+
+def heartbeat_service(workdir, interval, stop, results):
+    use_paths(workdir)
+    import heartbeat
+    metrics.init("heartbeat")
+    tracing.init("heartbeat")
+    loops = Loops()
+    while not stop.is_set():
+        loops.measure(heartbeat.check_recurrent_tasks)
+        stop.wait(interval)
+    metrics.flush()
+    results.put(("heartbeat", loops.summary()))
+
+
+class FakeOutbox:
+    """Outbox that "sends" instantly, so the notifier's own cost is measured."""
+
+    def __init__(self):
+        self.next_id = 1000
+
+    def _done(self, message_id):
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(SimpleNamespace(message_id=message_id))
+        return future
+
+    def send(self, chat_id, **kwargs):
+        self.next_id += 1
+        return self._done(self.next_id)
+
+    def edit(self, chat_id, message_id, **kwargs):
+        return self._done(message_id)
+
+
+def notifier_service(workdir, stop, results):
+    use_paths(workdir)
+    import state_inspector, delivery_ledger
+    state_inspector.USERS_ROOT = os.path.join(workdir, "users")
+    state_inspector.DeliveryLedger = functools.partial(
+        delivery_ledger.DeliveryLedger, os.path.join(workdir, "data", "delivery_ledger.json"))
+    metrics.init("notifier")
+    tracing.init("notifier")
+
+    async def run():
+        task = asyncio.create_task(state_inspector.notify_results(FakeOutbox(), None))
+        while not stop.is_set():
+            await asyncio.sleep(0.2)
+        task.cancel()
+
+    # One "loop" is an iteration of notify_results; its wall times come from the histogram
+    loops = Loops()
+    loops.measure(asyncio.run, run())
+    counts = metrics.snapshot()["histograms"].get("notify_iteration_seconds", [[{}, None]])[0][1]
+    summary = loops.summary(iterations=max(1, sum(counts[:-1])) if counts else None)
+    if counts:
+        summary.update(wall_p50_ms=metrics.quantile(counts, 0.5) * 1000, wall_p95_ms=metrics.quantile(counts, 0.95) * 1000)
+    metrics.flush()
+    results.put(("notifier", summary))
+
+
+# --- Report ---
+
+def count_archived(users_dir):
+    return sum(len(os.listdir(os.path.join(users_dir, d, "tasks", "archive"))) for d in os.listdir(users_dir))
+
+
+def histogram_summary(snapshots, name, label):
+    """{label value: {count, mean, p50, p95}} of a histogram summed over all processes."""
+    merged = {}
+    for data in snapshots.values():
+        for labels, counts in data.get("histograms", {}).get(name, []):
+            key = "/".join(str(labels.get(part, "")) for part in label.split("/"))
+            current = merged.get(key)
+            merged[key] = counts if current is None else [a + b for a, b in zip(current, counts)]
+    out = {}
+    for key, counts in sorted(merged.items()):
+        total = sum(counts[:-1])
+        out[key] = {"count": total, "mean": counts[-1] / total if total else 0.0,
+                    "p50": metrics.quantile(counts, 0.5) or 0.0, "p95": metrics.quantile(counts, 0.95) or 0.0}
+    return out
+
+
+def gemini_calls(path):
+    calls = {}
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                record = json.loads(line)
+                key = f"{record['kind']}/{record['outcome']}"
+                calls[key] = calls.get(key, 0) + 1
+    except FileNotFoundError:
+        pass
+    return calls
+
+
+def print_report(report):
+    t = report["throughput"]
+    print(f"\nCompleted {t['completed']}/{t['expected']} tasks in {t['seconds']:.1f}s: {t['tasks_per_minute']:.1f} tasks/minute")
+    for title, key in (("Stage latency", "stages"), ("Gemini calls (model/outcome)", "gemini"),
+                       ("Message to answer", "task_latency")):
+        print(f"\n{title:<32}{'count':>7}{'mean s':>9}{'p50 s':>9}{'p95 s':>9}")
+        for name, s in report[key].items():
+            print(f"  {name:<30}{s['count']:>7}{s['mean']:>9.2f}{s['p50']:>9.2f}{s['p95']:>9.2f}")
+    print(f"\n{'Per loop':<16}{'loops':>7}{'wall p50':>10}{'wall p95':>10}{'CPU':>9}{'child CPU':>11}{'read':>10}{'write':>10}")
+    for name, s in report["loops"].items():
+        if not s.get("loops"):
+            continue
+        print(f"  {name:<14}{s['loops']:>7}{s['wall_p50_ms']:>8.1f}ms{s['wall_p95_ms']:>8.1f}ms{s['cpu_ms']:>7.1f}ms"
+              f"{s['child_cpu_ms']:>9.1f}ms{s['read_kb']:>8.1f}KB{s['write_kb']:>8.1f}KB")
+    print(f"\nFake Gemini calls (kind/outcome): {report['fake_gemini']}")
+
+
+def compare(old, new):
+    """Prints the main numbers of two reports side by side."""
+    rows = [("tasks/minute", old["throughput"]["tasks_per_minute"], new["throughput"]["tasks_per_minute"])]
+    for stage, s in new["stages"].items():
+        if stage in old["stages"]:
+            rows.append((f"{stage} p50 s", old["stages"][stage]["p50"], s["p50"]))
+            rows.append((f"{stage} p95 s", old["stages"][stage]["p95"], s["p95"]))
+    for service, s in new["loops"].items():
+        for field in ("cpu_ms", "read_kb", "write_kb"):
+            if field in s and field in old["loops"].get(service, {}):
+                rows.append((f"{service} {field}/loop", old["loops"][service][field], s[field]))
+    print(f"\n{'':<28}{'before':>12}{'after':>12}{'change':>9}")
+    for label, before, after in rows:
+        change = f"{(after - before) / before * 100:+.0f}%" if before else "-"
+        print(f"  {label:<26}{before:>12.2f}{after:>12.2f}{change:>9}")
+
+
+def main(args):
+    workdir = tempfile.mkdtemp(prefix="throughput_bench_")
+    users_dir = os.path.join(workdir, "users")
+    totals = synth_tree.generate(users_dir, args.users, args.queued, args.archived, args.recurrent, args.seed)
+    os.makedirs(os.path.join(workdir, "core_instructions"))
+    with open(os.path.join(workdir, "core_instructions", "core.md"), 'w') as f:
+        f.write("You are a helpful assistant.\n" * 40)
+    # Same interpreter as the benchmark, without the startup of `/usr/bin/env python3` shims
+    launcher = os.path.join(workdir, "gemini")
+    with open(launcher, 'w') as f:
+        f.write(f'#!/bin/sh\nexec "{sys.executable}" "{FAKE_GEMINI}" "$@"\n')
+    os.chmod(launcher, 0o755)
+    env = {
+        "GEMINI_BIN": launcher, "GEMINI_TIMEOUT": str(args.timeout), "MCP_BROKER": "0",
+        "FAKE_GEMINI_LATENCY": args.latency, "FAKE_GEMINI_OUTPUT": str(args.output), "FAKE_GEMINI_STEPS": args.steps,
+        "FAKE_GEMINI_QUOTA_RATE": str(args.quota_rate), "FAKE_GEMINI_QUOTA_RESET": "2s",
+        "FAKE_GEMINI_HANG_RATE": str(args.hang_rate), "FAKE_GEMINI_ERROR_RATE": str(args.error_rate),
+        "FAKE_GEMINI_LOG": os.path.join(workdir, "gemini_calls.jsonl"),
+    }
+    expected = totals["queued"] + totals["recurrent"]
+    print(f"{args.users} users: {totals['queued']} queued, {totals['archived']} archived, "
+          f"{totals['recurrent']} recurrent; {args.runners} runner(s), Gemini latency {args.latency}")
+
+    try:
+        import aiogram  # noqa: F401 (the notifier needs it)
+        with_notifier = not args.no_notifier
+    except ImportError:
+        print("aiogram not installed: running without the notifier")
+        with_notifier = False
+
+    stop, results = multiprocessing.Event(), multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=runner_service, args=(workdir, i, env, stop, results))
+             for i in range(1, args.runners + 1)]
+    procs.append(multiprocessing.Process(target=heartbeat_service, args=(workdir, args.heartbeat_interval, stop, results)))
+    if with_notifier:
+        procs.append(multiprocessing.Process(target=notifier_service, args=(workdir, stop, results)))
+
+    started = time.monotonic()
+    for p in procs:
+        p.start()
+    completed = 0
+    while time.monotonic() - started < args.max_seconds:
+        completed = count_archived(users_dir) - totals["archived"]
+        if completed >= expected:
+            break
+        time.sleep(0.5)
+    elapsed = time.monotonic() - started
+    stop.set()
+
+    loops = {}
+    for _ in procs:
+        try:
+            name, summary = results.get(timeout=args.timeout + 30)
+            loops[name] = summary
+        except Exception:
+            break
+    for p in procs:
+        p.join(5)
+        if p.is_alive():
+            p.terminate()
+
+    metrics.METRICS_DIR = os.path.join(workdir, "data", "metrics")
+    snapshots = metrics.load_snapshots()
+    report = {
+        "config": vars(args),
+        "throughput": {"completed": completed, "expected": expected, "seconds": elapsed,
+                       "tasks_per_minute": completed / elapsed * 60},
+        "stages": histogram_summary(snapshots, "task_stage_seconds", "stage"),
+        "gemini": histogram_summary(snapshots, "gemini_call_seconds", "model/outcome"),
+        "task_latency": histogram_summary(snapshots, "task_latency_seconds", "outcome"),
+        "loops": dict(sorted(loops.items())),
+        "fake_gemini": gemini_calls(env["FAKE_GEMINI_LOG"]),
+    }
+    print_report(report)
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            compare(json.load(f), report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.keep:
+        print(f"\nTree and data: {workdir}")
+    else:
+        shutil.rmtree(workdir)
+    return 0 if completed >= expected else 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--queued", type=int, default=3, help="queued tasks per user")
+    parser.add_argument("--archived", type=int, default=100, help="archived tasks per user")
+    parser.add_argument("--recurrent", type=int, default=1, help="recurrent templates per user (each spawns once)")
+    parser.add_argument("--runners", type=int, default=1)
+    parser.add_argument("--latency", default="lognormal:0.3,0.5", help="fake Gemini latency (see fake_gemini.py)")
+    parser.add_argument("--output", type=int, default=2000, help="bytes per step result")
+    parser.add_argument("--steps", default="3-5", help="plan length, N or LO-HI")
+    parser.add_argument("--quota-rate", type=float, default=0.0)
+    parser.add_argument("--hang-rate", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--timeout", type=int, default=10, help="GEMINI_TIMEOUT for the runners, seconds")
+    parser.add_argument("--heartbeat-interval", type=float, default=5)
+    parser.add_argument("--max-seconds", type=float, default=600)
+    parser.add_argument("--no-notifier", action="store_true")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="write the report to this file")
+    parser.add_argument("--compare", help="earlier --json report to compare with")
+    parser.add_argument("--keep", action="store_true", help="keep the generated tree")
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,102 @@
+"""Update-ingestion latency: long polling vs webhook, against bench/fake_bot_api.py.
+
+Each mode gets the same dispatcher: one message handler that spends
+--work seconds (standing in for the gateway's access checks and task-file
+writes) and then replies. Updates are injected at --rate per second from
+distinct chats; the fake API measures injected -> reply and, for webhooks,
+injected -> HTTP ack. --rtt adds a simulated network round trip to every
+Bot API request and webhook delivery. Also reports how many getUpdates calls polling made.
+
+    python bench/webhook_vs_polling.py --updates 200 --rate 50 --work 0.2 --rtt 0.1
+"""
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+from aiogram import Dispatcher, types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import webhook
+from fake_bot_api import FakeBotAPI
+
+API_PORT = 18081
+WEBHOOK_PORT = 18080
+TOKEN = "123456:fake-bench-token"
+
+
+def build_dispatcher(work):
+    dp = Dispatcher()
+
+    @dp.message()
+    async def handle(message: types.Message):
+        await asyncio.sleep(work)
+        await message.answer("ok")
+
+    return dp
+
+
+async def run_mode(api, mode, args):
+    api.reset()
+    dp = build_dispatcher(args.work)
+    bot = webhook.make_bot(TOKEN, api_base=f"http://127.0.0.1:{API_PORT}")
+    if mode == "polling":
+        await bot.delete_webhook()
+        server = asyncio.create_task(dp.start_polling(bot, handle_signals=False, close_bot_session=False))
+    else:
+        server = asyncio.create_task(webhook.serve(
+            dp, bot, url=f"http://127.0.0.1:{WEBHOOK_PORT}/webhook", secret="bench-secret",
+            host="127.0.0.1", port=WEBHOOK_PORT, path="/webhook",
+            background=(mode == "webhook"), log=lambda *_: None,
+        ))
+    await asyncio.sleep(1)  # let polling/webhook registration settle
+
+    started = time.monotonic()
+    for i in range(args.updates):
+        api.inject(chat_id=100000 + i)
+        await asyncio.sleep(1 / args.rate)
+    deadline = time.monotonic() + args.work + 30
+    while sum(1 for r in api.records.values() if r["replied"]) < args.updates and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    elapsed = time.monotonic() - started
+    await asyncio.sleep(args.rtt + 0.5)  # let the last replies' responses arrive before shutting down
+
+    if mode == "polling":
+        await dp.stop_polling()
+    server.cancel()
+    try:
+        await server
+    except (asyncio.CancelledError, Exception):
+        pass
+    await bot.session.close()
+    return api.stats(), elapsed
+
+
+async def main(args):
+    api = FakeBotAPI(rtt=args.rtt)
+    await api.start("127.0.0.1", API_PORT)
+    try:
+        print(f"{args.updates} updates at {args.rate}/s, handler work {args.work}s, API round trip {args.rtt}s\n")
+        print(f"{'mode':<20}{'reply p50':>11}{'reply p95':>11}{'reply max':>11}{'ack p50':>10}{'ack p95':>10}{'getUpdates':>12}")
+        for mode in ["polling", "webhook", "webhook (sync ack)"]:
+            stats, _ = await run_mode(api, mode, args)
+            ack = f"{stats['ack_p50'] * 1000:>8.1f}ms{stats['ack_p95'] * 1000:>8.1f}ms" if mode != "polling" else f"{'-':>10}{'-':>10}"
+            print(f"{mode:<20}{stats['reply_p50'] * 1000:>9.1f}ms{stats['reply_p95'] * 1000:>9.1f}ms"
+                  f"{stats['reply_max'] * 1000:>9.1f}ms{ack}{stats['calls'].get('getUpdates', 0):>12}")
+            if stats["replied"] < stats["injected"]:
+                print(f"  ! only {stats['replied']}/{stats['injected']} updates answered")
+    finally:
+        await api.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--updates", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=50.0, help="injected updates per second")
+    parser.add_argument("--work", type=float, default=0.2, help="seconds each handler spends before replying")
+    parser.add_argument("--rtt", type=float, default=0.1, help="simulated Bot API round trip, seconds")
+    asyncio.run(main(parser.parse_args()))
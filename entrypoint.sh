@@ -17,9 +17,9 @@ for user_dir in /app/users/user_*; do
         # Make executable if not already
         chmod +x "$user_dir/init.sh"
         
-        # Execute in background (fire and forget)
+        # Execute in background (fire and forget), metered per user (see usage.py)
         (
-            bash "$user_dir/init.sh" >> "/app/data/logs/${user_id}_init.log" 2>&1
+            python3 /app/scripts/usage.py run "${user_id#user_}" -- bash "$user_dir/init.sh" >> "/app/data/logs/${user_id}_init.log" 2>&1
         ) &
     fi
 done
@@ -39,16 +39,39 @@ echo "Starting Heartbeat Service..."
 ) &
 HEARTBEAT_PID=$!
 
-echo "Starting Task Runner..."
-(
-    while true; do
-        echo "[$(date)] Starting Task Runner..."
-        python3 -u /app/scripts/task_runner.py
-        echo "[$(date)] Task Runner exited. Restarting in 5 seconds..."
-        sleep 5
-    done
-) &
-RUNNER_PID=$!
+# Warm stdio MCP servers for Gemini calls; MCP_BROKER=0 lets Gemini start them per call
+BROKER_PID=""
+if [ "${MCP_BROKER:-1}" != "0" ]; then
+    echo "Starting MCP Broker..."
+    (
+        while true; do
+            echo "[$(date)] Starting MCP Broker..."
+            python3 -u /app/scripts/mcp_broker.py
+            echo "[$(date)] MCP Broker exited. Restarting in 5 seconds..."
+            sleep 5
+        done
+    ) &
+    BROKER_PID=$!
+fi
+
+# RUNNER_COUNT > 1 starts several runners; they split the work through task leases.
+# Invariant: at most one runner works for a user at a time (the per-user lease in
+# task_lease.py), since a user's tasks share its tree, memories and Gemini settings.
+# Different users' tasks run in parallel.
+RUNNER_PIDS=""
+for i in $(seq 1 "${RUNNER_COUNT:-1}"); do
+    echo "Starting Task Runner $i..."
+    (
+        export RUNNER_ID="$(hostname)-runner-$i"
+        while true; do
+            echo "[$(date)] Starting Task Runner $i..."
+            python3 -u /app/scripts/task_runner.py
+            echo "[$(date)] Task Runner $i exited. Restarting in 5 seconds..."
+            sleep 5
+        done
+    ) &
+    RUNNER_PIDS="$RUNNER_PIDS $!"
+done
 
 echo "Starting Telegram Gateway..."
 (
@@ -64,5 +87,5 @@ GATEWAY_PID=$!
 echo "All core processes started. Waiting..."
 
 # Trap signals and kill background processes
-trap "kill $HEARTBEAT_PID $RUNNER_PID $GATEWAY_PID; exit" SIGINT SIGTERM
+trap "kill $HEARTBEAT_PID $BROKER_PID $RUNNER_PIDS $GATEWAY_PID; exit" SIGINT SIGTERM
 wait
@@ -0,0 +1,148 @@
+"""Non-blocking filesystem/YAML access for the gateway's asyncio code.
+
+Everything that touches the disk (or parses YAML) from a handler or the
+notify loop goes through a small bounded thread pool, so a slow disk or a
+large directory scan cannot stall Telegram update polling. Small appends to
+the same task file are batched into a single task_store.append(). monitor_loop_lag() measures
+how late the event loop wakes up and logs stalls.
+"""
+
+import os
+import time
+import asyncio
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+
+import task_store
+import metrics
+
+STORAGE_WORKERS = int(os.getenv("STORAGE_WORKERS", "4"))
+STALL_THRESHOLD = float(os.getenv("LOOP_STALL_THRESHOLD", "0.25"))  # seconds
+LAG_INTERVAL = 0.5
+LAG_SAMPLES = 600
+
+_executor = ThreadPoolExecutor(max_workers=STORAGE_WORKERS, thread_name_prefix="storage")
+
+# path -> [(text, future)] waiting for the next batched append
+_pending_appends = {}
+
+lag_stats = {"last": 0.0, "max": 0.0, "stalls": 0}
+_lag_samples = deque(maxlen=LAG_SAMPLES)
+
+
+async def run(fn, *args, **kwargs):
+    """Runs a blocking callable in the storage pool."""
+    loop = asyncio.get_running_loop()
+    if kwargs:
+        return await loop.run_in_executor(_executor, lambda: fn(*args, **kwargs))
+    return await loop.run_in_executor(_executor, fn, *args)
+
+
+def _read(path):
+    with open(path, 'r') as f:
+        return f.read()
+
+
+def _write(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+def replace_text(path, text):
+    """Writes text to path atomically (temp file in the same directory + os.replace); readers never see a partial file."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        try:
+            os.chmod(tmp, os.stat(path).st_mode & 0o7777)  # mkstemp creates 0600
+        except FileNotFoundError:
+            os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        try: os.remove(tmp)
+        except OSError: pass
+        raise
+
+
+async def read_text(path):
+    return await run(_read, path)
+
+
+async def write_text(path, text):
+    await run(_write, path, text)
+
+
+async def write_text_atomic(path, text):
+    await run(replace_text, path, text)
+
+
+async def exists(path):
+    return await run(os.path.exists, path)
+
+
+async def listdir(path):
+    return await run(os.listdir, path)
+
+
+async def rename(src, dst):
+    await run(os.rename, src, dst)
+
+
+async def yaml_load(text):
+    return await run(yaml.safe_load, text)
+
+
+async def yaml_dump(data):
+    return await run(yaml.dump, data, allow_unicode=True)
+
+
+async def append_text(path, text):
+    """Appends text to a task file; concurrent appends to the same path are merged into one write."""
+    loop = asyncio.get_running_loop()
+    fut = loop.create_future()
+    batch = _pending_appends.get(path)
+    if batch is None:
+        batch = _pending_appends[path] = []
+        loop.call_soon(lambda: asyncio.ensure_future(_flush_appends(path)))
+    batch.append((text, fut))
+    await fut
+
+
+async def _flush_appends(path):
+    batch = _pending_appends.pop(path, [])
+    if not batch:
+        return
+    try:
+        await run(task_store.append, path, "".join(text for text, _ in batch))
+    except Exception as e:
+        for _, fut in batch:
+            if not fut.done(): fut.set_exception(e)
+        return
+    for _, fut in batch:
+        if not fut.done(): fut.set_result(None)
+
+
+async def monitor_loop_lag(log=print):
+    """Samples event-loop lag forever; logs any stall above STALL_THRESHOLD."""
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(LAG_INTERVAL)
+        lag = max(0.0, time.monotonic() - start - LAG_INTERVAL)
+        _lag_samples.append(lag)
+        lag_stats["last"] = lag
+        lag_stats["max"] = max(lag_stats["max"], lag)
+        metrics.observe("event_loop_lag_seconds", lag)
+        if lag > STALL_THRESHOLD:
+            lag_stats["stalls"] += 1
+            log(f"⚠️ Event loop stalled for {lag:.2f}s")
+
+
+def lag_summary():
+    """Current, p95 and max event-loop lag in seconds, plus the stall count."""
+    samples = sorted(_lag_samples)
+    p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))] if samples else 0.0
+    return {"last": lag_stats["last"], "p95": p95, "max": lag_stats["max"], "stalls": lag_stats["stalls"]}
@@ -0,0 +1,81 @@
+"""Burst coalescing: folds rapid consecutive messages into one pending task.
+
+A plain message creates a task whose metadata carries `coalesce_until`
+(now + the user's window); the runner leaves such a task alone until that
+moment. Another message from the same chat before then is appended to the
+task's # Request and pushes `coalesce_until` forward, instead of becoming a
+task of its own with its own plan, steps, answer and commit.
+
+The window is per user (`burst_window` in user_registry.json, set with
+/burst), BURST_WINDOW seconds by default; 0 turns coalescing off.
+"""
+
+import os
+import json
+import time
+
+import config_cache
+import task_store
+import async_storage
+
+DEFAULT_WINDOW = float(os.getenv("BURST_WINDOW", "3"))
+MAX_WINDOW = 30
+GUARD = 0.5              # no appends this close to the deadline, so an append never races the runner
+MIN_CALLS_PER_TASK = 3   # plan + at least one step + final answer
+
+stats = {"merged_messages": 0, "gemini_calls_saved": 0}
+
+_PLAN_MARKER = "\n\n# Plan\n"
+
+
+def window_for(user_id):
+    """The user's debounce window in seconds (0 = off)."""
+    entry = config_cache.load_registry().get(str(user_id)) or {}
+    try:
+        return max(0.0, min(MAX_WINDOW, float(entry.get("burst_window", DEFAULT_WINDOW))))
+    except (TypeError, ValueError):
+        return DEFAULT_WINDOW
+
+
+def set_window(user_id, seconds):
+    registry = dict(config_cache.load_registry())
+    entry = dict(registry.get(str(user_id)) or {})
+    entry["burst_window"] = max(0.0, min(MAX_WINDOW, float(seconds)))
+    registry[str(user_id)] = entry
+    async_storage.replace_text(config_cache.USER_REGISTRY_FILE, json.dumps(registry, indent=4))
+    config_cache.registry.invalidate()
+
+
+def is_held(metadata, now=None):
+    """True while the task is still collecting messages and must not be planned."""
+    until = metadata.get("coalesce_until")
+    return bool(until) and (now or time.time()) < float(until)
+
+
+def try_append(task_path, text, window):
+    """
+    Appends `text` to the task's # Request if the task is still inside its
+    window and unplanned. Returns True if the message was merged.
+    """
+    now = time.time()
+
+    def merge(metadata, body):
+        until = metadata.get("coalesce_until")
+        if metadata.get("status") != "planning" or not until or now > float(until) - GUARD:
+            return None
+        plan_at = body.find(_PLAN_MARKER)
+        if plan_at == -1 or not body[plan_at + len(_PLAN_MARKER):].lstrip().startswith("# History"):
+            return None
+        metadata["coalesce_until"] = now + window
+        metadata["merged_messages"] = metadata.get("merged_messages", 0) + 1
+        return metadata, f"{body[:plan_at]}\n{text}{body[plan_at:]}"
+
+    try:
+        if task_store.modify(task_path, merge) is None:
+            return False
+    except FileNotFoundError:
+        return False
+
+    stats["merged_messages"] += 1
+    stats["gemini_calls_saved"] += MIN_CALLS_PER_TASK
+    return True
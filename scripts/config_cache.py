@@ -0,0 +1,96 @@
+"""In-memory cache of the shared JSON config files (allowlist, user registry).
+
+Files are parsed once and re-read only when their (mtime, size) changes, or
+after SIGHUP. The stat itself is rate-limited to once per CHECK_INTERVAL. If
+a changed file fails to parse, the last good version stays in effect.
+"""
+
+import os
+import json
+import time
+import signal
+import logging
+import threading
+
+ALLOWED_USERS_FILE = "/app/config/allowed_users.json"
+USER_REGISTRY_FILE = "/app/config/user_registry.json"
+USAGE_LIMITS_FILE = "/app/config/usage_limits.json"   # see usage.py
+
+CHECK_INTERVAL = 1.0  # seconds between stat() calls per file
+
+logger = logging.getLogger("ConfigCache")
+
+
+class CachedJSONFile:
+    def __init__(self, path, transform=None, default=None):
+        self.path = path
+        self.transform = transform or (lambda data: data)
+        self.default = default
+        self.value = default
+        self.loaded = False       # a good version has been parsed at least once
+        self.missing = True
+        self._stamp = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        self._checked_at = 0.0
+        self._stamp = None
+
+    def get(self):
+        now = time.monotonic()
+        if now - self._checked_at < CHECK_INTERVAL:
+            return self.value
+        with self._lock:
+            self._checked_at = now
+            try:
+                st = os.stat(self.path)
+            except FileNotFoundError:
+                self.missing = True
+                self.value, self.loaded, self._stamp = self.default, False, None
+                return self.value
+            self.missing = False
+            stamp = (st.st_mtime_ns, st.st_size)
+            if stamp == self._stamp:
+                return self.value
+            try:
+                with open(self.path, 'r') as f:
+                    value = self.transform(json.load(f))
+            except Exception as e:
+                # Keep serving the last good config; retry on the next change
+                logger.error(f"Could not reload {self.path}, keeping last good version: {e}")
+                self._stamp = stamp
+                return self.value
+            self.value, self.loaded, self._stamp = value, True, stamp
+            return self.value
+
+
+def _allowed_set(data):
+    return frozenset(int(uid) for uid in data.get("allowed_ids", []))
+
+
+allowlist = CachedJSONFile(ALLOWED_USERS_FILE, transform=_allowed_set, default=frozenset())
+registry = CachedJSONFile(USER_REGISTRY_FILE, default={})
+
+
+def is_user_allowed(user_id):
+    """True/False from the cached allowlist; None if the allowlist file does not exist."""
+    allowed = allowlist.get()
+    if allowlist.missing:
+        return None
+    return int(user_id) in allowed
+
+
+def load_registry():
+    """The cached user registry. Treat as read-only; copy before modifying."""
+    return registry.get()
+
+
+def reload_all(*_):
+    allowlist.invalidate()
+    registry.invalidate()
+
+
+def install_sighup_handler():
+    """Makes SIGHUP force a re-read of every cached file. Main thread only."""
+    signal.signal(signal.SIGHUP, reload_all)
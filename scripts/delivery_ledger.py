@@ -0,0 +1,172 @@
+"""Persistent record of what notify_results has already delivered to Telegram.
+
+For every task file the ledger remembers the (mtime, size) it last saw, the
+hash of the dashboard text it last rendered and whether the final state has
+been delivered. Finalized archive entries are never read again, and the
+archive folder itself is only re-listed when its mtime changes.
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+
+LEDGER_FILE = "/app/data/delivery_ledger.json"
+
+# Archived tasks older than this that already have a dashboard message are
+# assumed delivered when the ledger has no entry for them (first run after
+# an upgrade, or a lost ledger), instead of re-editing the whole history.
+BOOTSTRAP_GRACE = 600
+
+
+def content_hash(text):
+    """Stable across processes, unlike the built-in hash() of a str."""
+    return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+class DeliveryLedger:
+    def __init__(self, path=LEDGER_FILE):
+        self.path = path
+        self.users = {}
+        self.dirty = False
+        # The gateway calls into the ledger from its storage thread pool
+        self.lock = threading.RLock()
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                self.users = json.load(f).get("users", {})
+        except Exception as e:
+            print(f"Delivery ledger unreadable, starting empty: {e}", flush=True)
+            self.users = {}
+
+    def save(self):
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        if not self.dirty:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump({"users": self.users}, f)
+        os.replace(tmp, self.path)
+        self.dirty = False
+
+    def _user(self, user_dir):
+        user_id = os.path.basename(user_dir)
+        return self.users.setdefault(user_id, {"archive_mtime": None, "files": {}})
+
+    def changed_files(self, user_dir):
+        with self.lock:
+            return self._changed_files(user_dir)
+
+    def _changed_files(self, user_dir):
+        """
+        Returns [(filepath, archived)] for task files that need to be read:
+        everything in tasks/ whose (mtime, size) changed since it was recorded,
+        plus archive entries that are new or not yet finalized.
+        """
+        state = self._user(user_dir)
+        files = state["files"]
+        tasks_dir = os.path.join(user_dir, "tasks")
+        archive_dir = os.path.join(tasks_dir, "archive")
+        result = []
+
+        active = set()
+        if os.path.exists(tasks_dir):
+            for entry in os.scandir(tasks_dir):
+                if not entry.name.endswith(".md") or not entry.is_file():
+                    continue
+                rel = entry.name
+                active.add(rel)
+                st = entry.stat()
+                rec = files.get(rel)
+                if rec and rec.get("stat") == [st.st_mtime_ns, st.st_size]:
+                    continue
+                result.append((entry.path, False))
+
+        archive_mtime = _stat(archive_dir)
+        archive_listed = archive_mtime is not None and archive_mtime[0] != state["archive_mtime"]
+        archived = set()
+        if archive_listed:
+            for entry in os.scandir(archive_dir):
+                if entry.name.endswith(".md") and entry.is_file():
+                    archived.add(f"archive/{entry.name}")
+            state["archive_mtime"] = archive_mtime[0]
+            self.dirty = True
+
+        for rel in list(files):
+            in_archive = rel.startswith("archive/")
+            if not in_archive and rel not in active:
+                del files[rel]
+                self.dirty = True
+            elif in_archive and archive_listed and rel not in archived:
+                del files[rel]
+                self.dirty = True
+
+        # Archive: new entries once, then only known entries still awaiting delivery
+        for rel in archived:
+            if rel not in files:
+                files[rel] = {"stat": None, "hash": None, "final": False}
+                self.dirty = True
+        for rel, rec in files.items():
+            if not rel.startswith("archive/") or rec.get("final"):
+                continue
+            path = os.path.join(tasks_dir, rel)
+            st = _stat(path)
+            if st and st != rec.get("stat"):
+                result.append((path, True))
+
+        return result
+
+    def _locate(self, filepath):
+        folder, name = os.path.split(filepath)
+        if os.path.basename(folder) == "archive":
+            folder, rel = os.path.dirname(folder), f"archive/{name}"
+        else:
+            rel = name
+        return self._user(os.path.dirname(folder))["files"], rel
+
+    def last_hash(self, filepath):
+        with self.lock:
+            files, rel = self._locate(filepath)
+            rec = files.get(rel)
+            return rec.get("hash") if rec else None
+
+    def record(self, filepath, digest=None, final=False):
+        """Remember the file's current stat so it is skipped until it changes."""
+        with self.lock:
+            self._record(filepath, digest, final)
+
+    def _record(self, filepath, digest, final):
+        files, rel = self._locate(filepath)
+        prev = files.get(rel, {})
+        rec = {"stat": _stat(filepath), "hash": digest or prev.get("hash"), "final": bool(final)}
+        if rec != prev:
+            files[rel] = rec
+            self.dirty = True
+
+    def assume_delivered(self, filepath, metadata):
+        """Bootstrap rule for archived files the ledger has never seen."""
+        with self.lock:
+            files, rel = self._locate(filepath)
+            if (files.get(rel) or {}).get("hash"):
+                return False
+        if not metadata.get('status_message_id'):
+            return False
+        st = _stat(filepath)
+        return st is not None and (time.time() - st[0] / 1e9) > BOOTSTRAP_GRACE
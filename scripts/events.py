@@ -0,0 +1,60 @@
+"""Local runner -> gateway event channel for dashboard updates.
+
+Events are small JSON datagrams on a Unix socket. Publishing never blocks and
+never fails the caller: if the gateway is not listening the event is dropped
+and the notifier's periodic reconciliation scan picks the change up later.
+"""
+
+import os
+import json
+import time
+import socket
+import asyncio
+
+EVENTS_SOCKET = "/app/data/events.sock"
+
+PLAN_CREATED = "plan_created"
+STEP_STARTED = "step_started"
+STEP_DONE = "step_done"
+ANSWER_READY = "answer_ready"
+DEFERRED = "deferred"
+
+EVENT_TYPES = {PLAN_CREATED, STEP_STARTED, STEP_DONE, ANSWER_READY, DEFERRED}
+
+
+def publish(event_type, user_id, task_path, **fields):
+    """Fire-and-forget: send one event to the gateway if it is listening."""
+    event = {"type": event_type, "user_id": str(user_id), "path": task_path, "ts": time.time()}
+    event.update(fields)
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.setblocking(False)
+            sock.sendto(json.dumps(event).encode('utf-8'), EVENTS_SOCKET)
+    except OSError:
+        pass  # Gateway down or busy; reconciliation will catch up
+
+
+class _EventProtocol(asyncio.DatagramProtocol):
+    def __init__(self, handler):
+        self.handler = handler
+
+    def datagram_received(self, data, addr):
+        try:
+            event = json.loads(data.decode('utf-8'))
+        except ValueError:
+            return
+        if event.get("type") in EVENT_TYPES:
+            self.handler(event)
+
+
+async def listen(handler, path=None):
+    """Binds the event socket and calls handler(event) for every event received."""
+    path = path or EVENTS_SOCKET
+    if os.path.exists(path):
+        os.remove(path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(path)
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(lambda: _EventProtocol(handler), sock=sock)
+    return transport
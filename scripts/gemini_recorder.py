@@ -0,0 +1,74 @@
+"""Records the runner's Gemini calls as replay fixtures (GEMINI_RECORD_DIR).
+
+Off unless GEMINI_RECORD_DIR is set. Fixtures contain the users' requests,
+memories and Gemini's answers, so only record with their consent or on a
+test account. Each task gets a fixture directory:
+
+    <GEMINI_RECORD_DIR>/user_<id>/<task>/
+        task.md         the task file as it was before the first recorded call
+        parent.md       the parent task (replies), if any
+        context/        core_instructions/, instructions/, memories/ and skills/
+                        as get_context() read them
+        calls.jsonl     one line per _call_gemini: model, prompt, stdout, stderr,
+                        rc, outcome (ok, timeout, cancelled), seconds
+
+bench/gemini_replay.py re-runs the runner against these fixtures and reports
+how the prompts changed.
+"""
+
+import os
+import json
+import time
+import shutil
+
+RECORD_DIR = os.getenv("GEMINI_RECORD_DIR", "")
+
+
+def enabled():
+    return bool(RECORD_DIR)
+
+
+def fixture_dir(user_id, filename):
+    return os.path.join(RECORD_DIR, f"user_{user_id}", os.path.splitext(filename)[0])
+
+
+def _copy_context(user_dir, core_dir, dest):
+    sources = {"core_instructions": core_dir}
+    for name in ("instructions", "memories", "skills"):
+        sources[name] = os.path.join(user_dir, name)
+    for name, src in sources.items():
+        if os.path.isdir(src):
+            shutil.copytree(src, os.path.join(dest, "context", name),
+                            ignore=lambda d, names: [n for n in names if not n.endswith(".md")])
+
+
+def _snapshot(path, user_dir, filename, core_dir):
+    """Stores the task and its context the first time one of its calls is recorded."""
+    tasks_dir = os.path.join(user_dir, "tasks")
+    os.makedirs(path, exist_ok=True)
+    shutil.copyfile(os.path.join(tasks_dir, filename), os.path.join(path, "task.md"))
+    _copy_context(user_dir, core_dir, path)
+    import task_parser
+    doc = task_parser.load(os.path.join(tasks_dir, filename))
+    parent = doc and doc.metadata.get('parent_task_id')
+    for candidate in (parent and os.path.join(tasks_dir, parent), parent and os.path.join(tasks_dir, "archive", parent)):
+        if candidate and os.path.isfile(candidate):
+            shutil.copyfile(candidate, os.path.join(path, "parent.md"))
+            break
+
+
+def record(user_dir, filename, core_dir, model, prompt, stdout, stderr, rc, outcome, seconds):
+    """Appends one call to the task's fixture. Never raises."""
+    if not RECORD_DIR or not filename:
+        return
+    user_id = os.path.basename(os.path.normpath(user_dir))[len("user_"):]
+    path = fixture_dir(user_id, filename)
+    try:
+        if not os.path.exists(os.path.join(path, "calls.jsonl")):
+            _snapshot(path, user_dir, filename, core_dir)
+        line = {"ts": time.time(), "model": model, "prompt": prompt, "stdout": stdout, "stderr": stderr,
+                "rc": rc, "outcome": outcome, "seconds": round(seconds, 3)}
+        with open(os.path.join(path, "calls.jsonl"), 'a') as f:
+            f.write(json.dumps(line, ensure_ascii=False) + "\n")
+    except Exception as e:
+        print(f"  -> WARNING: Gemini call not recorded: {e}", flush=True)
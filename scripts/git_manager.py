@@ -3,10 +3,12 @@ import json
 import subprocess
 import logging
 from datetime import datetime
+import config_cache
+import metrics
 
 # Configure
 LOG_FILE = "/app/data/logs/git_manager.log"
-USER_REGISTRY_FILE = "/app/config/user_registry.json"
+USER_REGISTRY_FILE = config_cache.USER_REGISTRY_FILE
 USERS_ROOT = "/app/users"
 
 # Setup Logger
@@ -22,30 +24,30 @@ logging.basicConfig(
 logger = logging.getLogger("GitManager")
 
 def load_registry():
-    try:
-        with open(USER_REGISTRY_FILE, 'r') as f:
-            return json.load(f)
-    except FileNotFoundError:
+    """Cached registry (re-read only when the file changes, see config_cache.py)."""
+    registry = config_cache.load_registry()
+    if config_cache.registry.missing:
         logger.warning(f"Registry file not found at {USER_REGISTRY_FILE}")
-        return {}
-    except Exception as e:
-        logger.error(f"Error loading registry: {e}")
-        return {}
+    return registry
 
 def run_git_cmd(cwd, args, description="git command"):
-    try:
-        result = subprocess.run(
-            ["git"] + args,
-            cwd=cwd,
-            capture_output=True,
-            text=True,
-            check=True
-        )
-        logger.info(f"Success: {description} in {cwd}")
-        return True, result.stdout
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Failed: {description} in {cwd}. Error: {e.stderr}")
-        return False, e.stderr
+    # git_command_seconds{command, outcome}: commit/push/pull durations per git subcommand
+    with metrics.timer("git_command_seconds", command=args[0]) as timing:
+        try:
+            result = subprocess.run(
+                ["git"] + args,
+                cwd=cwd,
+                capture_output=True,
+                text=True,
+                check=True
+            )
+            logger.info(f"Success: {description} in {cwd}")
+            timing.labels["outcome"] = "ok"
+            return True, result.stdout
+        except subprocess.CalledProcessError as e:
+            logger.error(f"Failed: {description} in {cwd}. Error: {e.stderr}")
+            timing.labels["outcome"] = "failed"
+            return False, e.stderr
 
 def setup_user_repo(user_id, config):
     user_dir = os.path.join(USERS_ROOT, f"user_{user_id}")
@@ -227,6 +229,7 @@ def initialize_repo_structure(user_id):
                 "!.gemini/settings.json\n"
                 "__pycache__/\n"
                 "*.log\n"
+                "tasks/**/.*.tmp\n"
             )
             
     # Commit and push
@@ -235,6 +238,8 @@ def initialize_repo_structure(user_id):
 if __name__ == "__main__":
     import sys
     action = sys.argv[1] if len(sys.argv) > 1 else "help"
+    # A short-lived process per commit: add to the totals of earlier runs
+    metrics.init("git_manager", accumulate=True)
     
     if action == "restore":
         registry = load_registry()
@@ -1,9 +1,16 @@
 import os
-import yaml
+import re
 import json
 import time
 import glob
 from datetime import datetime, timedelta
+import runner_wakeup
+import notification_spool
+import task_store
+import task_parser
+import metrics
+import tracing
+import profiling
 
 USERS_ROOT = "/app/users"
 
@@ -50,6 +57,18 @@ def should_run(filename, metadata, state):
         except Exception: pass
     return False, None
 
+_TASK_TIME = re.compile(r'_(\d{8}_\d{6})(?:_|\.md$)')
+
+def queued_at(filename):
+    """Creation time from a task filename (task_<time>_<hash>.md, recurrent_<name>_<time>.md), or None."""
+    match = _TASK_TIME.search(filename)
+    if not match:
+        return None
+    try:
+        return datetime.strptime(match.group(1), "%Y%m%d_%H%M%S").timestamp()
+    except ValueError:
+        return None
+
 def check_recurrent_tasks():
     user_dirs = glob.glob(os.path.join(USERS_ROOT, "user_*"))
 
@@ -57,66 +76,102 @@ def check_recurrent_tasks():
         state = load_state(user_dir)
         recurrent_dir = os.path.join(user_dir, "tasks", "recurrent")
         tasks_dir = os.path.join(user_dir, "tasks")
+        user_id = os.path.basename(user_dir).replace("user_", "")
+        try:
+            queued = [f for f in os.listdir(tasks_dir) if f.endswith(".md")]
+        except OSError:
+            queued = []
+        metrics.set_gauge("queue_depth", len(queued), user=user_id)
+        created = [queued_at(f) for f in queued]
+        created = [t for t in created if t]
+        metrics.set_gauge("queue_oldest_seconds", round(time.time() - min(created)) if created else 0, user=user_id)
         
         if not os.path.exists(recurrent_dir): continue
 
         files = [f for f in os.listdir(recurrent_dir) if f.endswith(".md")]
+        deferred = {"quota": 0, "usage": 0}
         for filename in files:
             filepath = os.path.join(recurrent_dir, filename)
             try:
-                with open(filepath, 'r') as f:
-                    content = f.read()
-                    parts = content.split('---', 2)
-                    if len(parts) < 3: continue
-                    metadata = yaml.safe_load(parts[1])
+                task = task_parser.load(filepath)
+                if task is None: continue
+                metadata = dict(task.metadata)
+                
+                # --- DEFERRED TASKS (run_after) ---
+                run_after = metadata.get('run_after')
+                if run_after:
+                    reason = "usage" if metadata.get('status') == 'deferred_usage' else "quota"
+                    deferred[reason] += 1
+                    try:
+                        run_after_dt = datetime.fromisoformat(run_after)
+                        if datetime.now() >= run_after_dt:
+                            print(f"[{datetime.now()}] Deferred task ready: {filename} for {os.path.basename(user_dir)}")
+                            # Remove run_after so it processes normally
+                            del metadata['run_after']
+                            metadata['status'] = 'planning'
+                            task_store.modify(filepath, lambda meta, body: (
+                                {**{k: v for k, v in meta.items() if k != 'run_after'}, 'status': 'planning'}, body,
+                            ))
+                            
+                            # Move back to tasks/
+                            dest = os.path.join(tasks_dir, filename)
+                            task_store.move(filepath, dest)
+                            runner_wakeup.task_enqueued(os.path.basename(user_dir).replace("user_", ""), filename, interactive=False)
+                            print(f"  -> Moved {filename} back to tasks/")
+                            metrics.inc("heartbeat_spawned_total", kind="deferred")
+                            tracing.record(metadata.get('trace_id'), "resumed", run_after_dt.timestamp(), time.time(),
+                                           task=filename)
+                            if metadata.get('chat_id'):
+                                notification_spool.enqueue(
+                                    metadata['chat_id'],
+                                    "▶️ <b>Resuming your deferred task.</b>",
+                                    key=f"resumed:{os.path.basename(user_dir)}:{filename}:{run_after}"
+                                )
+                        # else: not yet time, skip
+                    except Exception as e:
+                        print(f"Error handling run_after for {filename}: {e}")
+                    continue  # Skip schedule check for deferred tasks
+                
+                # --- SCHEDULED TASKS ---
+                run_needed, run_time_str = should_run(filename, metadata, state)
+                if run_needed:
+                    print(f"[{datetime.now()}] Spawning recurrent {filename} for {os.path.basename(user_dir)}")
+                    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+                    new_task = f"recurrent_{os.path.splitext(filename)[0]}_{timestamp}.md"
                     
-                    # --- DEFERRED TASKS (run_after) ---
-                    run_after = metadata.get('run_after')
-                    if run_after:
-                        try:
-                            run_after_dt = datetime.fromisoformat(run_after)
-                            if datetime.now() >= run_after_dt:
-                                print(f"[{datetime.now()}] Deferred task ready: {filename} for {os.path.basename(user_dir)}")
-                                # Remove run_after so it processes normally
-                                del metadata['run_after']
-                                metadata['status'] = 'planning'
-                                new_content = f"--- \n{yaml.dump(metadata, allow_unicode=True)}--- {parts[2]}"
-                                
-                                # Move back to tasks/
-                                dest = os.path.join(tasks_dir, filename)
-                                with open(dest, 'w') as nf:
-                                    nf.write(new_content)
-                                os.remove(filepath)
-                                print(f"  -> Moved {filename} back to tasks/")
-                            # else: not yet time, skip
-                        except Exception as e:
-                            print(f"Error handling run_after for {filename}: {e}")
-                        continue  # Skip schedule check for deferred tasks
+                    metadata['regular'] = False
+                    metadata['created_at'] = datetime.now().isoformat()
+                    metadata['trace_id'] = tracing.new_trace_id()
+                    task_store.create(os.path.join(tasks_dir, new_task), metadata, task.body)
+                    runner_wakeup.task_enqueued(os.path.basename(user_dir).replace("user_", ""), new_task, interactive=False)
+                    metrics.inc("heartbeat_spawned_total", kind="scheduled")
+                    tracing.record(metadata['trace_id'], "spawned", time.time(), task=new_task, template=filename)
                     
-                    # --- SCHEDULED TASKS ---
-                    run_needed, run_time_str = should_run(filename, metadata, state)
-                    if run_needed:
-                        print(f"[{datetime.now()}] Spawning recurrent {filename} for {os.path.basename(user_dir)}")
-                        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                        new_task = f"recurrent_{os.path.splitext(filename)[0]}_{timestamp}.md"
-                        
-                        metadata['regular'] = False
-                        new_content = f"--- \n{yaml.dump(metadata, allow_unicode=True)}--- \n{parts[2]}"
-                        
-                        with open(os.path.join(tasks_dir, new_task), "w") as nf:
-                            nf.write(new_content)
-                        
-                        key = f"{filename}_{run_time_str}"
-                        state[key] = {'last_run_date': datetime.now().strftime("%Y-%m-%d")}
-                        save_state(user_dir, state)
+                    key = f"{filename}_{run_time_str}"
+                    state[key] = {'last_run_date': datetime.now().strftime("%Y-%m-%d")}
+                    save_state(user_dir, state)
 
-                        if metadata.get('schedule', {}).get('date'):
-                            os.remove(filepath)
+                    if metadata.get('schedule', {}).get('date'):
+                        os.remove(filepath)
             except Exception as e:
                 print(f"Error in heartbeat for {filename}: {e}")
+                metrics.inc("heartbeat_errors_total")
+        for reason, count in deferred.items():
+            metrics.set_gauge("tasks_deferred", count, user=user_id, reason=reason)
 
 if __name__ == "__main__":
     print("Heartbeat service started (Multi-user).")
+    metrics.init("heartbeat")
+    tracing.init("heartbeat")
+    profiler = profiling.Profiler("heartbeat").install()
+    try:
+        # The heartbeat also exports every process's metrics (see metrics.py)
+        if metrics.serve():
+            print(f"Metrics on http://127.0.0.1:{metrics.PORT}/metrics")
+    except OSError as e:
+        print(f"Metrics endpoint unavailable: {e}")
     while True:
-        check_recurrent_tasks()
+        with profiler.iteration(), metrics.timer("heartbeat_iteration_seconds"):
+            check_recurrent_tasks()
+        tracing.prune()
         time.sleep(60)
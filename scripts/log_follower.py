@@ -0,0 +1,172 @@
+"""`tail -F` for asyncio: follows a growing log file without blocking the loop.
+
+Wakes on inotify events for the file's directory (via ctypes, Linux only) and
+falls back to polling every POLL_INTERVAL where inotify is unavailable. Reads
+happen in the async_storage pool in bounded chunks, so a log that grows by
+megabytes is consumed a chunk at a time between other work. Only lines
+matching the precompiled pattern are decoded and returned. Rotation (the path
+now names a different inode) and in-place truncation (smaller, or same size
+but modified with nothing new to read) are detected at EOF; a rotated file is
+drained before switching to its replacement.
+"""
+
+import os
+import re
+import struct
+import asyncio
+import ctypes
+import ctypes.util
+
+import async_storage as storage
+
+CHUNK_SIZE = 256 * 1024
+MAX_PARTIAL_LINE = 64 * 1024   # an unterminated line longer than this is dropped
+POLL_INTERVAL = 3.0            # without inotify
+SAFETY_INTERVAL = 30.0         # with inotify, in case an event is lost (queue overflow)
+
+IN_MODIFY = 0x002
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+_WATCH_MASK = IN_MODIFY | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+_EVENT = struct.Struct("iIII")   # wd, mask, cookie, len
+
+
+def _inotify_watch(directory):
+    """inotify fd watching `directory`; raises OSError if inotify is unavailable."""
+    libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+    if libc.inotify_add_watch(fd, os.fsencode(directory), _WATCH_MASK) < 0:
+        errno = ctypes.get_errno()
+        os.close(fd)
+        raise OSError(errno, f"inotify_add_watch failed for {directory}")
+    return fd
+
+
+class LogFollower:
+    def __init__(self, path, pattern, from_end=True, log=print):
+        self.path = path
+        self.name = os.fsencode(os.path.basename(path))
+        self.matcher = re.compile(pattern.encode("utf-8"))
+        self.log = log
+        self._from_end = from_end
+        self._file = None
+        self._partial = b""
+        self._eof_mtime = None
+        self._wake = None
+        self._inotify_fd = None
+
+    # --- Wake-ups (event loop) ---
+
+    def _start_watch(self):
+        self._wake = asyncio.Event()
+        try:
+            self._inotify_fd = _inotify_watch(os.path.dirname(self.path) or ".")
+        except (OSError, AttributeError) as e:
+            self.log(f"inotify unavailable for {self.path} ({e}), polling every {POLL_INTERVAL:g}s")
+            return
+        asyncio.get_running_loop().add_reader(self._inotify_fd, self._on_inotify)
+
+    def _on_inotify(self):
+        try:
+            data = os.read(self._inotify_fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset + _EVENT.size <= len(data):
+            _, mask, _, name_len = _EVENT.unpack_from(data, offset)
+            name = data[offset + _EVENT.size:offset + _EVENT.size + name_len].rstrip(b"\0")
+            offset += _EVENT.size + name_len
+            if name == self.name or mask & IN_Q_OVERFLOW:
+                self._wake.set()
+                return
+
+    def _stop_watch(self):
+        if self._inotify_fd is not None:
+            asyncio.get_running_loop().remove_reader(self._inotify_fd)
+            os.close(self._inotify_fd)
+            self._inotify_fd = None
+
+    async def _wait(self):
+        timeout = SAFETY_INTERVAL if self._inotify_fd is not None else POLL_INTERVAL
+        try:
+            await asyncio.wait_for(self._wake.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._wake.clear()
+
+    # --- Reading (storage pool) ---
+
+    def _read(self):
+        """Matching lines from the next chunk, and whether more data may be waiting."""
+        if self._file is None:
+            try:
+                self._file = open(self.path, 'rb')
+            except FileNotFoundError:
+                return [], False
+            if self._from_end:
+                self._file.seek(0, os.SEEK_END)
+            self._from_end = False   # files appearing later (rotation) are read from the start
+            self._partial = b""
+            self._eof_mtime = os.fstat(self._file.fileno()).st_mtime_ns
+
+        data = self._file.read(CHUNK_SIZE)
+        if not data:
+            return [], self._check_replaced()
+
+        *complete, self._partial = (self._partial + data).split(b"\n")
+        if len(self._partial) > MAX_PARTIAL_LINE:
+            self._partial = b""
+        lines = [line.decode("utf-8", errors="ignore") for line in complete if self.matcher.search(line)]
+        if len(data) < CHUNK_SIZE:
+            self._eof_mtime = os.fstat(self._file.fileno()).st_mtime_ns
+        return lines, len(data) == CHUNK_SIZE
+
+    def _check_replaced(self):
+        """At EOF: handles rotation and truncation. True if there is something new to read."""
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            st = None
+        if st is None or st.st_ino != os.fstat(self._file.fileno()).st_ino:
+            # Rotated or removed; the old file is fully drained at this point
+            self._file.close()
+            self._file = None
+            return st is not None
+        if st.st_size < self._file.tell() or (st.st_size == self._file.tell() and st.st_mtime_ns != self._eof_mtime):
+            # Truncated in place (possibly rewritten back up to the same size)
+            self._file.seek(0)
+            self._partial = b""
+            self._eof_mtime = st.st_mtime_ns
+            return True
+        self._eof_mtime = st.st_mtime_ns
+        return False
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    async def batches(self):
+        """Async generator of lists of matching lines, forever."""
+        self._start_watch()
+        try:
+            while True:
+                try:
+                    lines, more = await storage.run(self._read)
+                except Exception as e:
+                    self.log(f"Error reading {self.path}: {e}")
+                    lines, more = [], False
+                if lines:
+                    yield lines
+                if not more:
+                    await self._wait()
+        finally:
+            self._stop_watch()
+            self._close()
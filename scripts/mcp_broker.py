@@ -0,0 +1,622 @@
+"""Keeps users' stdio MCP servers warm between Gemini calls.
+
+Without the broker, every Gemini CLI call starts each stdio server listed in
+the user's .gemini/settings.json (Node or Python processes with seconds of
+startup) and kills it when the step ends. The broker, one process started by
+entrypoint.sh, starts a user's server on first use (or at startup with
+MCP_BROKER_PREWARM=1), performs the MCP handshake once and keeps it running.
+Gemini reaches it through the SSE transport, i.e. the `url` key of
+mcpServers:
+
+    GET  /u/<user_id>/<server>/sse                        event stream; first event names the POST endpoint
+    POST /u/<user_id>/<server>/messages?session_id=<id>   client JSON-RPC, answered on the stream
+    GET  /health
+
+Several Gemini sessions (runners working on the same user) share one server
+process: request ids and progress tokens are rewritten per session and the
+responses routed back. Each client's `initialize` is answered from the
+broker's own handshake, so a restarted server is re-initialized without the
+clients noticing. A server that exits or misses a ping is restarted on its
+next use, with backoff if it keeps failing; one unused for MCP_IDLE_TIMEOUT
+seconds (0 = never) is stopped. Server stderr goes to
+/app/data/logs/mcp_user_<id>_<server>.log.
+
+Read-only tools declared in the user's .gemini/mcp_cache.json are answered
+from a TTL cache (see mcp_cache).
+
+Runner side: effective_settings() writes a Gemini system settings file that
+maps each stdio server name to its broker URL. task_runner passes it as
+GEMINI_CLI_SYSTEM_SETTINGS_PATH, which overrides the user's entries of the
+same name without touching their settings.json. When the broker is not
+reachable, Gemini starts the servers itself as before.
+
+The broker listens on loopback only, where any local process (another
+user's Gemini CLI or MCP server) could connect. So every request must carry
+the user's token: `Authorization: Bearer <token>`. The runner creates a
+random token per user in SETTINGS_DIR/user_<id>.token (mode 0600) and puts
+it in the `headers` of the settings file's entries; requests whose token
+does not match the user id in the URL are rejected with 403.
+"""
+
+import os
+import re
+import json
+import time
+import uuid
+import hmac
+import signal
+import secrets
+import asyncio
+import urllib.request
+from collections import namedtuple
+from datetime import datetime
+from urllib.parse import quote, unquote
+
+from aiohttp import web
+
+import mcp_cache
+
+USERS_ROOT = "/app/users"
+SETTINGS_DIR = "/app/data/mcp_broker"
+LOG_DIR = "/app/data/logs"
+
+ENABLED = os.getenv("MCP_BROKER", "1") != "0"
+HOST = "127.0.0.1"
+PORT = int(os.getenv("MCP_BROKER_PORT", "8765"))
+PREWARM = os.getenv("MCP_BROKER_PREWARM", "0") == "1"
+IDLE_TIMEOUT = float(os.getenv("MCP_IDLE_TIMEOUT", "0"))
+
+STARTUP_TIMEOUT = 60     # seconds for a server to answer initialize
+PING_INTERVAL = 30
+PING_TIMEOUT = 10
+KEEPALIVE = 15           # SSE comment lines, so dead clients are noticed
+MAX_BACKOFF = 60
+HEALTH_CACHE = 15        # runner re-checks /health this often
+PROTOCOL_VERSION = "2025-06-18"
+STDOUT_LIMIT = 16 * 1024 * 1024  # longest JSON-RPC line a server may send
+
+SERVER_EXITED = -32000
+
+Forwarded = namedtuple("Forwarded", "session client_id cache_token")
+
+_VAR = re.compile(r'\$(?:\{(\w+)\}|(\w+))')
+
+
+def log(msg):
+    print(f"[{datetime.now().strftime('%H:%M:%S')}] [mcp-broker] {msg}", flush=True)
+
+
+# --- Runner side ---
+
+_health = (False, 0.0)
+
+
+def user_token(user_id):
+    """The user's broker token, created on first use (SETTINGS_DIR/user_<id>.token)."""
+    path = os.path.join(SETTINGS_DIR, f"user_{user_id}.token")
+    try:
+        with open(path, 'r') as f:
+            token = f.read().strip()
+        if token:
+            return token
+    except FileNotFoundError:
+        pass
+    os.makedirs(SETTINGS_DIR, exist_ok=True)
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    fd = os.open(tmp, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(secrets.token_urlsafe(32))
+    try:
+        os.link(tmp, path)   # another runner may have created it first; theirs wins
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(tmp)
+    with open(path, 'r') as f:
+        return f.read().strip()
+
+
+def auth_headers(user_id):
+    return {"Authorization": f"Bearer {user_token(user_id)}"}
+
+
+def server_url(user_id, name):
+    return f"http://{HOST}:{PORT}/u/{user_id}/{quote(name, safe='')}/sse"
+
+
+def available():
+    """True if the broker answers /health (cached for HEALTH_CACHE seconds)."""
+    global _health
+    ok, checked_at = _health
+    if time.monotonic() - checked_at < HEALTH_CACHE:
+        return ok
+    try:
+        with urllib.request.urlopen(f"http://{HOST}:{PORT}/health", timeout=0.5) as resp:
+            ok = resp.status == 200
+    except OSError:
+        ok = False
+    _health = (ok, time.monotonic())
+    return ok
+
+
+def stdio_servers(settings):
+    """{name: spec} of the mcpServers entries Gemini would start as subprocesses."""
+    servers = settings.get("mcpServers") if isinstance(settings, dict) else None
+    if not isinstance(servers, dict):
+        return {}
+    return {name: spec for name, spec in servers.items()
+            if isinstance(spec, dict) and spec.get("command") and not spec.get("url")}
+
+
+def effective_settings(user_id, settings):
+    """
+    Path of a Gemini system settings file that routes the user's stdio MCP
+    servers through the broker, or None to let Gemini start them itself.
+    """
+    servers = stdio_servers(settings)
+    if not ENABLED or not servers or not available():
+        return None
+    overrides = {}
+    for name, spec in servers.items():
+        overrides[name] = {"url": server_url(user_id, name), "headers": auth_headers(user_id)}
+        if "timeout" in spec:
+            overrides[name]["timeout"] = spec["timeout"]
+    text = json.dumps({"mcpServers": overrides}, indent=2, sort_keys=True)
+
+    path = os.path.join(SETTINGS_DIR, f"user_{user_id}.json")
+    try:
+        with open(path, 'r') as f:
+            if f.read() == text:
+                return path
+    except FileNotFoundError:
+        pass
+    os.makedirs(SETTINGS_DIR, exist_ok=True)
+    tmp = f"{path}.tmp"
+    with os.fdopen(os.open(tmp, os.O_CREAT | os.O_TRUNC | os.O_WRONLY, 0o600), 'w') as f:
+        f.write(text)   # holds the token
+    os.replace(tmp, path)
+    return path
+
+
+# --- Broker ---
+
+def _expand(value, env):
+    """$VAR / ${VAR} in settings values, like Gemini CLI resolves them."""
+    if not isinstance(value, str):
+        return value
+    return _VAR.sub(lambda m: env.get(m.group(1) or m.group(2), m.group(0)), value)
+
+
+class Session:
+    """One SSE client (a Gemini CLI process) of a server."""
+
+    def __init__(self, server):
+        self.id = uuid.uuid4().hex
+        self.server = server
+        self.queue = asyncio.Queue()
+
+    def send(self, message):
+        self.queue.put_nowait(message)
+
+
+class StdioServer:
+    def __init__(self, user_id, name, spec):
+        self.user_id = user_id
+        self.name = name
+        self.spec = spec
+        self.proc = None
+        self.init_result = None
+        self.sessions = {}
+        self.pending = {}           # broker id -> Future (own requests) or Forwarded
+        self.progress = {}          # broker progress token -> (session, client token)
+        self.next_id = 0
+        self.last_used = time.monotonic()
+        self.failures = 0
+        self.retry_at = 0.0
+        self.starts = 0
+        self.cache = mcp_cache.ToolCache()
+        self._start_lock = asyncio.Lock()
+
+    @property
+    def label(self):
+        return f"user_{self.user_id}/{self.name}"
+
+    @property
+    def running(self):
+        return self.proc is not None and self.proc.returncode is None and self.init_result is not None
+
+    # --- Process lifecycle ---
+
+    async def ensure_started(self):
+        if self.running:
+            return
+        async with self._start_lock:
+            if self.running:
+                return
+            if time.monotonic() < self.retry_at:
+                raise RuntimeError(f"{self.label} failed to start, retrying in {self.retry_at - time.monotonic():.0f}s")
+            try:
+                await self._start()
+                self.failures = 0
+            except Exception:
+                self.failures += 1
+                self.retry_at = time.monotonic() + min(MAX_BACKOFF, 2 ** self.failures)
+                await self.stop()
+                raise
+
+    async def _start(self):
+        user_dir = os.path.join(USERS_ROOT, f"user_{self.user_id}")
+        env = dict(os.environ, HOME=user_dir)
+        env.update({k: str(_expand(v, env)) for k, v in (self.spec.get("env") or {}).items()})
+        command = _expand(self.spec["command"], env)
+        args = [str(_expand(a, env)) for a in (self.spec.get("args") or [])]
+
+        os.makedirs(LOG_DIR, exist_ok=True)
+        started = time.monotonic()
+        with open(os.path.join(LOG_DIR, f"mcp_user_{self.user_id}_{self.name}.log"), 'ab') as stderr:
+            self.proc = await asyncio.create_subprocess_exec(
+                command, *args, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+                stderr=stderr, env=env, cwd=self.spec.get("cwd"), start_new_session=True, limit=STDOUT_LIMIT,
+            )
+        self.init_result = None
+        asyncio.create_task(self._read_loop(self.proc))
+        result = await self._call("initialize", {
+            "protocolVersion": PROTOCOL_VERSION,
+            "capabilities": {},
+            "clientInfo": {"name": "mcp-broker", "version": "1.0"},
+        }, timeout=STARTUP_TIMEOUT)
+        await self._write({"jsonrpc": "2.0", "method": "notifications/initialized"})
+        self.init_result = result
+        self.starts += 1
+        log(f"{self.label} ready in {time.monotonic() - started:.2f}s (pid {self.proc.pid}, start #{self.starts})")
+
+    async def stop(self):
+        proc, self.proc = self.proc, None
+        self.init_result = None
+        if proc is None or proc.returncode is not None:
+            return
+        for sig, grace in ((signal.SIGTERM, 3), (signal.SIGKILL, 5)):
+            try:
+                os.killpg(proc.pid, sig)
+            except ProcessLookupError:
+                break
+            try:
+                await asyncio.wait_for(proc.wait(), grace)
+                break
+            except asyncio.TimeoutError:
+                continue
+
+    def _on_exit(self, proc):
+        if proc is not self.proc:
+            return
+        log(f"{self.label} exited (code {proc.returncode})")
+        self.init_result = None
+        for broker_id, entry in list(self.pending.items()):
+            del self.pending[broker_id]
+            if isinstance(entry, asyncio.Future):
+                if not entry.done():
+                    entry.set_exception(RuntimeError(f"{self.label} exited"))
+            else:
+                entry.session.send(_error(entry.client_id, SERVER_EXITED, f"MCP server {self.name} exited"))
+        self.progress.clear()
+
+    # --- Server -> broker ---
+
+    async def _read_loop(self, proc):
+        try:
+            while True:
+                line = await proc.stdout.readline()
+                if not line:
+                    break
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    log(f"{self.label} stdout: {line[:200].decode(errors='replace').rstrip()}")
+                    continue
+                for m in message if isinstance(message, list) else [message]:
+                    self._from_server(m)
+        except Exception as e:
+            log(f"{self.label} read error: {e}")
+        await proc.wait()
+        self._on_exit(proc)
+
+    def _from_server(self, message):
+        if "method" not in message:
+            entry = self.pending.pop(message.get("id"), None)
+            if isinstance(entry, asyncio.Future):
+                if entry.done():
+                    return
+                if "error" in message:
+                    entry.set_exception(RuntimeError(message["error"].get("message", "error")))
+                else:
+                    entry.set_result(message.get("result"))
+            elif entry:
+                self.progress.pop(str(message.get("id")), None)
+                if entry.cache_token and "result" in message:
+                    self.cache.store(entry.cache_token, message["result"])
+                entry.session.send(dict(message, id=entry.client_id))
+            return
+
+        if "id" in message:
+            # Server -> client request. The broker declared no client capabilities,
+            # so only ping is expected.
+            if message["method"] == "ping":
+                reply = {"jsonrpc": "2.0", "id": message["id"], "result": {}}
+            else:
+                reply = _error(message["id"], -32601, f"{message['method']} not supported through the broker")
+            asyncio.create_task(self._write(reply))
+            return
+
+        if message["method"] == "notifications/progress":
+            target = self.progress.get(str((message.get("params") or {}).get("progressToken")))
+            if target:
+                session, token = target
+                session.send({**message, "params": {**message["params"], "progressToken": token}})
+            return
+        for session in list(self.sessions.values()):
+            session.send(message)
+
+    # --- Client -> server ---
+
+    async def from_client(self, session, message):
+        self.last_used = time.monotonic()
+        method = message.get("method")
+        if method is None:
+            return  # a response to a server request; those are answered by the broker
+        if "id" not in message:
+            await self._client_notification(session, message)
+            return
+
+        if method == "ping":
+            session.send({"jsonrpc": "2.0", "id": message["id"], "result": {}})
+            return
+        cache_token = None
+        if method == "tools/call":
+            params = message.get("params") or {}
+            cached, cache_token = self.cache.call(params.get("name"), params.get("arguments") or {})
+            if cached is not None:
+                session.send({"jsonrpc": "2.0", "id": message["id"], "result": cached})
+                return
+        try:
+            await self.ensure_started()
+        except Exception as e:
+            session.send(_error(message["id"], SERVER_EXITED, f"MCP server {self.name} unavailable: {e}"))
+            return
+        if method == "initialize":
+            session.send({"jsonrpc": "2.0", "id": message["id"], "result": self.init_result})
+            return
+
+        broker_id = self._new_id()
+        self.pending[broker_id] = Forwarded(session, message["id"], cache_token)
+        forwarded = dict(message, id=broker_id)
+        meta = (message.get("params") or {}).get("_meta") or {}
+        if "progressToken" in meta:
+            self.progress[str(broker_id)] = (session, meta["progressToken"])
+            forwarded["params"] = {**message["params"], "_meta": {**meta, "progressToken": str(broker_id)}}
+        await self._write(forwarded)
+
+    async def _client_notification(self, session, message):
+        method = message["method"]
+        if method == "notifications/initialized" or not self.running:
+            return  # sent by the broker itself after each start
+        if method == "notifications/cancelled":
+            client_id = (message.get("params") or {}).get("requestId")
+            broker_id = next((b for b, e in self.pending.items()
+                              if isinstance(e, Forwarded) and (e.session, e.client_id) == (session, client_id)), None)
+            if broker_id is None:
+                return
+            message = {**message, "params": {**message["params"], "requestId": broker_id}}
+        await self._write(message)
+
+    # --- Plumbing ---
+
+    def _new_id(self):
+        self.next_id += 1
+        return f"b{self.next_id}"
+
+    async def _write(self, message):
+        if self.proc is None or self.proc.stdin is None or self.proc.stdin.is_closing():
+            return
+        self.proc.stdin.write(json.dumps(message).encode() + b"\n")
+        try:
+            await self.proc.stdin.drain()
+        except ConnectionError:
+            pass
+
+    async def _call(self, method, params=None, timeout=PING_TIMEOUT):
+        broker_id = self._new_id()
+        future = asyncio.get_running_loop().create_future()
+        self.pending[broker_id] = future
+        await self._write({"jsonrpc": "2.0", "id": broker_id, "method": method, "params": params or {}})
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.pending.pop(broker_id, None)
+
+    async def check(self):
+        """Pings a running server; restarts it if it does not answer."""
+        if not self.running:
+            return
+        if IDLE_TIMEOUT and not self.sessions and time.monotonic() - self.last_used > IDLE_TIMEOUT:
+            log(f"{self.label} idle for {IDLE_TIMEOUT:.0f}s, stopping")
+            await self.stop()
+            return
+        try:
+            await self._call("ping")
+        except Exception as e:
+            log(f"{self.label} failed its health check ({e or type(e).__name__}), restarting")
+            await self.stop()
+            if self.sessions:
+                try:
+                    await self.ensure_started()
+                except Exception as e:
+                    log(f"{self.label} restart failed: {e}")
+
+    def stats(self):
+        stats = {"running": self.running, "pid": self.proc.pid if self.proc else None,
+                 "sessions": len(self.sessions), "starts": self.starts, "failures": self.failures}
+        if self.cache.ttl:
+            stats["cache"] = self.cache.stats()
+        return stats
+
+
+def _error(request_id, code, message):
+    return {"jsonrpc": "2.0", "id": request_id, "error": {"code": code, "message": message}}
+
+
+class Broker:
+    def __init__(self, users_root=None):
+        self.users_root = users_root or USERS_ROOT
+        self.servers = {}           # (user_id, name) -> StdioServer
+        self.sessions = {}          # session id -> Session
+        self._configs = {}          # (user_id, file name) -> (mtime_ns, parsed JSON)
+        self._tokens = {}           # user_id -> token, as last read from SETTINGS_DIR
+
+    def _user_config(self, user_id, filename):
+        """A JSON file from the user's .gemini directory, re-read when it changes; {} if missing or broken."""
+        path = os.path.join(self.users_root, f"user_{user_id}", ".gemini", filename)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return {}
+        cached = self._configs.get((user_id, filename))
+        if cached and cached[0] == mtime:
+            return cached[1]
+        try:
+            with open(path, 'r') as f:
+                config = json.load(f)
+        except (OSError, ValueError):
+            config = {}
+        self._configs[(user_id, filename)] = (mtime, config)
+        return config
+
+    def _user_servers(self, user_id):
+        return stdio_servers(self._user_config(user_id, "settings.json"))
+
+    async def server_for(self, user_id, name):
+        """The user's server `name`, replaced if its settings entry changed; None if not configured."""
+        spec = self._user_servers(user_id).get(name)
+        if spec is None:
+            return None
+        server = self.servers.get((user_id, name))
+        if server and server.spec != spec:
+            log(f"{server.label} settings changed, restarting")
+            await server.stop()
+            server = None
+        if server is None:
+            server = self.servers[(user_id, name)] = StdioServer(user_id, name, spec)
+        server.cache.configure(*mcp_cache.server_config(self._user_config(user_id, mcp_cache.CONFIG_NAME), name))
+        return server
+
+    # --- HTTP ---
+
+    def _check_token(self, request, user_id):
+        """Raises 403 unless the request carries user_id's token (see user_token)."""
+        scheme, _, presented = request.headers.get("Authorization", "").partition(" ")
+        if scheme.lower() != "bearer" or not presented or not re.fullmatch(r"[\w-]+", user_id):
+            raise web.HTTPForbidden(text="missing or invalid broker token")
+        token = self._tokens.get(user_id)
+        if token is None or not hmac.compare_digest(presented, token):
+            try:
+                with open(os.path.join(SETTINGS_DIR, f"user_{user_id}.token"), 'r') as f:
+                    token = self._tokens[user_id] = f.read().strip()
+            except OSError:
+                token = None
+        if not token or not hmac.compare_digest(presented, token):
+            raise web.HTTPForbidden(text="missing or invalid broker token")
+
+    async def handle_sse(self, request):
+        user_id, name = request.match_info["user_id"], unquote(request.match_info["name"])
+        self._check_token(request, user_id)
+        server = await self.server_for(user_id, name)
+        if server is None:
+            raise web.HTTPNotFound(text=f"no stdio MCP server {name!r} for user {user_id}")
+        session = Session(server)
+        server.sessions[session.id] = session
+        self.sessions[session.id] = session
+        asyncio.create_task(self._warm(server))
+
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await resp.prepare(request)
+        endpoint = f"/u/{user_id}/{quote(name, safe='')}/messages?session_id={session.id}"
+        try:
+            await resp.write(f"event: endpoint\ndata: {endpoint}\n\n".encode())
+            while True:
+                try:
+                    message = await asyncio.wait_for(session.queue.get(), KEEPALIVE)
+                except asyncio.TimeoutError:
+                    await resp.write(b": keepalive\n\n")
+                    continue
+                await resp.write(f"event: message\ndata: {json.dumps(message)}\n\n".encode())
+        except (ConnectionResetError, asyncio.CancelledError):
+            pass
+        finally:
+            server.sessions.pop(session.id, None)
+            self.sessions.pop(session.id, None)
+        return resp
+
+    async def _warm(self, server):
+        try:
+            await server.ensure_started()
+        except Exception as e:
+            log(f"{server.label} failed to start: {e}")
+
+    async def handle_message(self, request):
+        user_id, name = request.match_info["user_id"], unquote(request.match_info["name"])
+        self._check_token(request, user_id)
+        session = self.sessions.get(request.query.get("session_id", ""))
+        if session is None or (session.server.user_id, session.server.name) != (user_id, name):
+            raise web.HTTPNotFound(text="unknown session")
+        try:
+            payload = await request.json()
+        except ValueError:
+            raise web.HTTPBadRequest(text="invalid JSON")
+        for message in payload if isinstance(payload, list) else [payload]:
+            if isinstance(message, dict):
+                await session.server.from_client(session, message)
+        return web.Response(status=202, text="Accepted")
+
+    async def handle_health(self, request):
+        return web.json_response({"servers": {s.label: s.stats() for s in self.servers.values()}})
+
+    # --- Background ---
+
+    async def health_loop(self):
+        while True:
+            await asyncio.sleep(PING_INTERVAL)
+            await asyncio.gather(*(s.check() for s in list(self.servers.values())), return_exceptions=True)
+
+    async def prewarm(self):
+        if not os.path.isdir(self.users_root):
+            return
+        for entry in sorted(os.listdir(self.users_root)):
+            if entry.startswith("user_"):
+                user_id = entry[len("user_"):]
+                for name in self._user_servers(user_id):
+                    asyncio.create_task(self._warm(await self.server_for(user_id, name)))
+
+    async def stop_all(self, app=None):
+        await asyncio.gather(*(s.stop() for s in self.servers.values()), return_exceptions=True)
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_get("/u/{user_id}/{name}/sse", self.handle_sse)
+        app.router.add_post("/u/{user_id}/{name}/messages", self.handle_message)
+        app.router.add_get("/health", self.handle_health)
+
+        async def background(app):
+            tasks = [asyncio.create_task(self.health_loop())]
+            if PREWARM:
+                tasks.append(asyncio.create_task(self.prewarm()))
+            yield
+            for task in tasks:
+                task.cancel()
+            await self.stop_all()
+
+        app.cleanup_ctx.append(background)
+        return app
+
+
+if __name__ == "__main__":
+    log(f"Listening on {HOST}:{PORT}")
+    web.run_app(Broker().make_app(), host=HOST, port=PORT, print=None)
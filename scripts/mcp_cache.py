@@ -0,0 +1,99 @@
+"""TTL cache for read-only MCP tool calls, applied by mcp_broker.
+
+Recurrent digests and multi-step plans call the same read-only tools
+(calendar event listing, WhatsApp chat listing) with the same arguments
+minutes apart. The broker answers such tools/call requests from this cache
+instead of the user's server.
+
+Cacheable tools are declared per server in users/user_<id>/.gemini/mcp_cache.json
+(not settings.json: Gemini CLI rejects unknown keys there):
+
+    {
+      "google_calendar": {"ttl": {"list_events": 300, "get_event": 300},
+                          "readonly": ["find_free_time"]},
+      "whatsapp": {"ttl": {"list_chats": 120}}
+    }
+
+`ttl` maps tool names to seconds. Any other tool called on the same server
+counts as a write and empties that server's cache, except the ones listed in
+`readonly`. Only successful results are stored, and a response that was
+in flight while a write happened is not. Hits and misses are counted per
+tool and reported in the broker's /health.
+"""
+
+import os
+import json
+import time
+from collections import OrderedDict
+
+CONFIG_NAME = "mcp_cache.json"
+MAX_ENTRIES = int(os.getenv("MCP_CACHE_ENTRIES", "256"))     # per user and server
+MAX_RESULT_BYTES = 1024 * 1024
+
+
+def server_config(config, name):
+    """(ttl dict, readonly set) of one server's entry in mcp_cache.json."""
+    entry = config.get(name) if isinstance(config, dict) else None
+    if not isinstance(entry, dict):
+        return {}, frozenset()
+    ttl = {tool: float(seconds) for tool, seconds in (entry.get("ttl") or {}).items()
+           if isinstance(seconds, (int, float)) and seconds > 0}
+    return ttl, frozenset(entry.get("readonly") or ())
+
+
+class ToolCache:
+    def __init__(self):
+        self.ttl = {}
+        self.readonly = frozenset()
+        self.entries = OrderedDict()    # (tool, arguments JSON) -> (expires_at, result)
+        self.generation = 0             # bumped by every write
+        self.counts = {}                # tool -> {"hits": n, "misses": n}
+        self.invalidations = 0
+
+    def configure(self, ttl, readonly):
+        if (ttl, readonly) != (self.ttl, self.readonly):
+            self.ttl, self.readonly = ttl, readonly
+            self.entries.clear()
+
+    def call(self, tool, arguments):
+        """
+        Called for each tools/call. Returns (result, None) on a hit,
+        (None, token) on a miss of a cacheable tool (pass the token to store()),
+        and (None, None) otherwise; a write empties the cache here.
+        """
+        if tool not in self.ttl:
+            if tool not in self.readonly:
+                self.generation += 1
+                if self.entries:
+                    self.entries.clear()
+                    self.invalidations += 1
+            return None, None
+
+        counts = self.counts.setdefault(tool, {"hits": 0, "misses": 0})
+        key = (tool, json.dumps(arguments, sort_keys=True, separators=(",", ":")))
+        cached = self.entries.get(key)
+        if cached and cached[0] > time.monotonic():
+            self.entries.move_to_end(key)
+            counts["hits"] += 1
+            return cached[1], None
+        self.entries.pop(key, None)
+        counts["misses"] += 1
+        return None, (key, self.generation)
+
+    def store(self, token, result):
+        key, generation = token
+        if generation != self.generation or not isinstance(result, dict) or result.get("isError"):
+            return
+        if len(json.dumps(result)) > MAX_RESULT_BYTES:
+            return
+        self.entries[key] = (time.monotonic() + self.ttl.get(key[0], 0), result)
+        self.entries.move_to_end(key)
+        while len(self.entries) > MAX_ENTRIES:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        tools = {}
+        for tool, counts in self.counts.items():
+            total = counts["hits"] + counts["misses"]
+            tools[tool] = dict(counts, hit_rate=round(counts["hits"] / total, 3) if total else 0.0)
+        return {"tools": tools, "entries": len(self.entries), "invalidations": self.invalidations}
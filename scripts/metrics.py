@@ -0,0 +1,308 @@
+"""Counters, gauges and histograms shared by the runner, heartbeat, gateway and git sync.
+
+Each process records into its own in-memory registry (a dict update under a
+lock, about a microsecond) and a daemon thread writes the registry every
+METRICS_INTERVAL seconds to /app/data/metrics/<process>.json, atomically.
+Short-lived processes (`git_manager.py commit`) are started with
+init(..., accumulate=True): at exit their counters and histograms are added
+to the previous snapshot of the same name instead of replacing it.
+
+The heartbeat serves every snapshot in the Prometheus text format at
+http://127.0.0.1:METRICS_PORT/metrics (default 9464, 0 = off), each series
+labelled with its `process`; snapshots of processes that stopped writing
+more than STALE_AFTER seconds ago are left out.
+
+    metrics.init("heartbeat")
+    metrics.inc("recurrent_spawned_total", kind="scheduled")
+    metrics.set_gauge("queue_depth", 3, user="42")
+    metrics.inc_recent("gemini_calls_last_hour", model=model, outcome="ok")
+    with metrics.timer("gemini_call_seconds", model=model) as t:
+        ...
+        t.labels["outcome"] = "ok"   # set while timing; "error" if the block raises
+
+Metric names get the `assistant_` prefix in the Prometheus output.
+"""
+
+import os
+import json
+import time
+import atexit
+import fcntl
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_DIR = "/app/data/metrics"
+PORT = int(os.getenv("METRICS_PORT", "9464"))
+INTERVAL = float(os.getenv("METRICS_INTERVAL", "15"))
+STALE_AFTER = 600
+RECENT_WINDOW = 3600  # seconds counted by inc_recent()
+PREFIX = "assistant_"
+
+# Seconds; Gemini calls run for minutes, file and git operations for milliseconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+_lock = threading.Lock()
+_counters = {}      # name -> {labels tuple: value}
+_gauges = {}
+_histograms = {}    # name -> {labels tuple: [bucket counts..., +Inf count, sum]}
+_recent = {}        # name -> {labels tuple: {minute: count}}
+_process = None
+_accumulate = False
+
+
+def _key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name, value=1, **labels):
+    key = _key(labels)
+    with _lock:
+        series = _counters.setdefault(name, {})
+        series[key] = series.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    with _lock:
+        _gauges.setdefault(name, {})[_key(labels)] = value
+
+
+def inc_recent(name, value=1, **labels):
+    """Counts into per-minute buckets; exported as a gauge summing the last RECENT_WINDOW seconds."""
+    key = _key(labels)
+    minute = int(time.time() // 60)
+    with _lock:
+        minutes = _recent.setdefault(name, {}).setdefault(key, {})
+        minutes[minute] = minutes.get(minute, 0) + value
+
+
+def _recent_gauges():
+    """Windowed sums of the inc_recent() series, dropping expired minutes (call with _lock held)."""
+    oldest = int(time.time() // 60) - RECENT_WINDOW // 60
+    gauges = {}
+    for name, series in _recent.items():
+        for key, minutes in series.items():
+            for minute in [m for m in minutes if m < oldest]:
+                del minutes[minute]
+            gauges.setdefault(name, []).append([dict(key), sum(minutes.values())])
+    return gauges
+
+
+def observe(name, value, **labels):
+    key = _key(labels)
+    with _lock:
+        series = _histograms.setdefault(name, {})
+        counts = series.get(key)
+        if counts is None:
+            counts = series[key] = [0] * (len(DEFAULT_BUCKETS) + 1) + [0.0]
+        counts[bisect_left(DEFAULT_BUCKETS, value)] += 1
+        counts[-1] += value
+
+
+class timer:
+    """Context manager observing the elapsed seconds of its block into a histogram."""
+
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.labels.setdefault("outcome", "error")
+        observe(self.name, time.perf_counter() - self.started, **self.labels)
+
+
+def quantile(counts, q, bounds=DEFAULT_BUCKETS):
+    """Estimate of the q-quantile of a histogram's counts (linear within the bucket), or None if empty."""
+    total = sum(counts[:-1])
+    if not total:
+        return None
+    rank = q * total
+    seen = 0
+    for i, count in enumerate(counts[:-1]):
+        if count and seen + count >= rank:
+            lower = bounds[i - 1] if i > 0 else 0.0
+            upper = bounds[i] if i < len(bounds) else bounds[-1]
+            return lower + (upper - lower) * (rank - seen) / count
+        seen += count
+    return bounds[-1]
+
+
+# --- Snapshots ---
+
+def snapshot():
+    """The registry as JSON-ready data."""
+    with _lock:
+        return {
+            "process": _process,
+            "pid": os.getpid(),
+            "updated_at": time.time(),
+            "accumulate": _accumulate,
+            "buckets": list(DEFAULT_BUCKETS),
+            "counters": {n: [[dict(k), v] for k, v in s.items()] for n, s in _counters.items()},
+            "gauges": {**{n: [[dict(k), v] for k, v in s.items()] for n, s in _gauges.items()}, **_recent_gauges()},
+            "histograms": {n: [[dict(k), list(c)] for k, c in s.items()] for n, s in _histograms.items()},
+        }
+
+
+def _merge(old, new):
+    """Adds old's counters and histograms to new (same bucket layout)."""
+    for kind in ("counters", "histograms"):
+        for name, series in old.get(kind, {}).items():
+            current = {_key(labels): value for labels, value in new[kind].get(name, [])}
+            for labels, value in series:
+                key = _key(labels)
+                if kind == "counters":
+                    current[key] = current.get(key, 0) + value
+                elif key not in current:
+                    current[key] = value
+                elif len(value) == len(current[key]):
+                    current[key] = [a + b for a, b in zip(current[key], value)]
+            new[kind][name] = [[dict(k), v] for k, v in current.items()]
+    return new
+
+
+def flush():
+    """Writes this process's snapshot (merged into the previous one when accumulating)."""
+    if _process is None:
+        return
+    data = snapshot()
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, f"{_process}.json")
+    with open(f"{path}.lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if _accumulate:
+            try:
+                with open(path, 'r') as f:
+                    data = _merge(json.load(f), data)
+            except (OSError, ValueError):
+                pass
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+
+
+def _flush_loop():
+    while True:
+        time.sleep(INTERVAL)
+        try:
+            flush()
+        except Exception as e:
+            print(f"Metrics snapshot failed: {e}", flush=True)
+
+
+def init(process, accumulate=False):
+    """Names this process's snapshot file and starts writing it (at exit only when accumulating)."""
+    global _process, _accumulate
+    _process = process.replace(os.sep, "_")
+    _accumulate = accumulate
+    atexit.register(flush)
+    if not accumulate:
+        threading.Thread(target=_flush_loop, name="metrics", daemon=True).start()
+
+
+# --- Exporter ---
+
+def load_snapshots():
+    """Current snapshots of all processes, this one included."""
+    snapshots = {}
+    try:
+        names = os.listdir(METRICS_DIR)
+    except FileNotFoundError:
+        names = []
+    for name in names:
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, name), 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        age = time.time() - data.get("updated_at", 0)
+        if data.get("accumulate") or age < STALE_AFTER:
+            snapshots[data.get("process") or name[:-5]] = data
+        elif age > 86400:
+            # Runners of a previous container (RUNNER_ID contains the hostname)
+            for path in (os.path.join(METRICS_DIR, name), os.path.join(METRICS_DIR, f"{name}.lock")):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+    if _process is not None:
+        snapshots[_process] = snapshot()
+    return snapshots
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels, **extra):
+    items = {**labels, **extra}
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in sorted(items.items())) + "}"
+
+
+def _number(value):
+    return "+Inf" if value == float("inf") else repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render_prometheus(snapshots):
+    families = {}   # metric name -> (type, [lines])
+    for process, data in sorted(snapshots.items()):
+        bounds = data.get("buckets", DEFAULT_BUCKETS)
+        for kind, type_name in (("counters", "counter"), ("gauges", "gauge")):
+            for name, series in data.get(kind, {}).items():
+                lines = families.setdefault(PREFIX + name, (type_name, []))[1]
+                for labels, value in series:
+                    lines.append(f"{PREFIX}{name}{_labels(labels, process=process)} {_number(value)}")
+        for name, series in data.get("histograms", {}).items():
+            lines = families.setdefault(PREFIX + name, ("histogram", []))[1]
+            for labels, counts in series:
+                cumulative = 0
+                for bound, count in zip(list(bounds) + [float("inf")], counts[:-1]):
+                    cumulative += count
+                    lines.append(f"{PREFIX}{name}_bucket{_labels(labels, process=process, le=_number(bound))} {cumulative}")
+                lines.append(f"{PREFIX}{name}_sum{_labels(labels, process=process)} {_number(counts[-1])}")
+                lines.append(f"{PREFIX}{name}_count{_labels(labels, process=process)} {cumulative}")
+        lines = families.setdefault(PREFIX + "snapshot_age_seconds", ("gauge", []))[1]
+        lines.append(f"{PREFIX}snapshot_age_seconds{_labels({}, process=process)} "
+                     f"{_number(round(time.time() - data.get('updated_at', 0), 3))}")
+
+    out = []
+    for name, (type_name, lines) in sorted(families.items()):
+        out.append(f"# TYPE {name} {type_name}")
+        out.extend(lines)
+    return "\n".join(out) + "\n"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render_prometheus(load_snapshots()).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(port=None):
+    """Serves /metrics on 127.0.0.1 from a daemon thread. Returns the server, or None if disabled."""
+    port = PORT if port is None else port
+    if not port:
+        return None
+    server = ThreadingHTTPServer(("127.0.0.1", port), _Handler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
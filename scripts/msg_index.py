@@ -0,0 +1,162 @@
+"""Per-user index of Telegram message ids -> task filename.
+
+Replaces scanning tasks/ and archive/ on every reply and reaction. Entries
+store only the filename, so a task moving between tasks/ and archive/ does
+not invalidate them. The index is written by whoever records a message id in
+a task's metadata, and rebuilt from the task files when it is missing, an
+entry points at a file that no longer exists, or an id is not found (at most
+once per MISS_REBUILD_INTERVAL per user).
+"""
+
+import os
+import re
+import json
+import fcntl
+import tempfile
+import time
+import threading
+from contextlib import contextmanager
+
+USERS_ROOT = "/app/users"
+INDEX_DIR = "/app/data/msg_index"
+
+ID_FIELDS = ("message_id", "trigger_message_id", "status_message_id", "last_ai_message_id")
+_ID_LINE = re.compile(rf"^({'|'.join(ID_FIELDS)}):\s*(\d+)\s*$", re.MULTILINE)
+
+# user_id -> (mtime_ns of the index file, {msg_id: filename})
+_cache = {}
+# user_id -> monotonic time of the last rebuild after a lookup miss
+_miss_rebuilds = {}
+MISS_REBUILD_INTERVAL = 60   # seconds; ids of bot messages that belong to no task miss every time
+# Writers: the gateway's storage pool threads (this lock) and other processes (flock)
+_lock = threading.Lock()
+
+
+def _index_path(user_id):
+    return os.path.join(INDEX_DIR, f"user_{user_id}.json")
+
+
+def _task_dirs(user_id):
+    tasks_dir = os.path.join(USERS_ROOT, f"user_{user_id}", "tasks")
+    return tasks_dir, os.path.join(tasks_dir, "archive")
+
+
+def _load(user_id):
+    path = _index_path(user_id)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+    cached = _cache.get(str(user_id))
+    if cached and cached[0] == mtime:
+        return cached[1]
+    try:
+        with open(path, 'r') as f:
+            index = json.load(f)
+    except Exception:
+        return None
+    _cache[str(user_id)] = (mtime, index)
+    return index
+
+
+@contextmanager
+def _locked(user_id):
+    """Serializes read-modify-write of the user's index across threads and processes."""
+    os.makedirs(INDEX_DIR, exist_ok=True)
+    with _lock, open(f"{_index_path(user_id)}.lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def _save(user_id, index):
+    path = _index_path(user_id)
+    fd, tmp = tempfile.mkstemp(dir=INDEX_DIR, prefix=os.path.basename(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp, path)
+    except BaseException:
+        try: os.remove(tmp)
+        except OSError: pass
+        raise
+    _cache[str(user_id)] = (os.stat(path).st_mtime_ns, index)
+
+
+def rebuild(user_id):
+    """Full scan of the user's task headers; newest active task wins on collisions."""
+    with _locked(user_id):
+        return _rebuild(user_id)
+
+
+def _rebuild(user_id):
+    index = {}
+    tasks_dir, archive_dir = _task_dirs(user_id)
+    for folder in [archive_dir, tasks_dir]:
+        if not os.path.exists(folder): continue
+        for f in sorted(os.listdir(folder)):
+            if not f.endswith(".md"): continue
+            try:
+                with open(os.path.join(folder, f), 'r') as file:
+                    header = file.read(2000)
+            except Exception:
+                continue
+            for _, msg_id in _ID_LINE.findall(header):
+                index[msg_id] = f
+    _save(user_id, index)
+    return index
+
+
+def add(user_id, filename, *msg_ids):
+    """Records that the given message ids belong to task `filename`."""
+    msg_ids = [str(m) for m in msg_ids if m]
+    if not msg_ids:
+        return
+    with _locked(user_id):
+        index = _load(user_id)
+        if index is None:
+            index = _rebuild(user_id)
+        if all(index.get(m) == filename for m in msg_ids):
+            return
+        index = dict(index)
+        for m in msg_ids:
+            index[m] = filename
+        _save(user_id, index)
+
+
+def _resolve(user_id, filename):
+    for folder in _task_dirs(user_id):
+        path = os.path.join(folder, filename)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def _miss_rebuild_due(user_id):
+    now = time.monotonic()
+    if now - _miss_rebuilds.get(str(user_id), -MISS_REBUILD_INTERVAL) < MISS_REBUILD_INTERVAL:
+        return False
+    _miss_rebuilds[str(user_id)] = now
+    return True
+
+
+def lookup(user_id, msg_id):
+    """Returns the task path for a Telegram message id, or None."""
+    if not msg_id:
+        return None
+    index = _load(user_id)
+    rebuilt = index is None
+    if rebuilt:
+        index = rebuild(user_id)
+    filename = index.get(str(msg_id))
+    if not filename and not rebuilt and _miss_rebuild_due(user_id):
+        # Never recorded (crash between send and add, messages older than the index): scan once
+        index, rebuilt = rebuild(user_id), True
+        filename = index.get(str(msg_id))
+    if not filename:
+        return None
+    path = _resolve(user_id, filename)
+    if path is None and not rebuilt:
+        # Stale entry (task deleted or renamed outside the gateway)
+        filename = rebuild(user_id).get(str(msg_id))
+        path = _resolve(user_id, filename) if filename else None
+    return path
@@ -0,0 +1,205 @@
+"""Durable outgoing-notification spool shared by the runner, heartbeat and gateway.
+
+Producers call enqueue(); the gateway claims due rows in batches, sends them
+and acks or fails each one. Delivery is at-least-once: a claim is only a
+lease, so rows claimed by a gateway that died are handed out again after
+CLAIM_TIMEOUT. The gateway extend()s the lease while a row waits in its
+rate-limited Outbox queue. Failures back off exponentially and end up dead-lettered
+after MAX_ATTEMPTS. An idempotency key makes repeated enqueues of the same
+notification a no-op.
+"""
+
+import os
+import json
+import time
+import sqlite3
+
+SPOOL_DB = "/app/data/notifications.db"
+LEGACY_DIR = "/app/data/notifications"
+
+CLAIM_TIMEOUT = 120      # seconds before an unacknowledged claim is retried
+BASE_BACKOFF = 5         # seconds, doubled per failed attempt
+MAX_BACKOFF = 1800
+MAX_ATTEMPTS = 8
+KEEP_SENT_DAYS = 7       # sent rows are kept this long for idempotency
+
+PENDING = "pending"
+SENT = "sent"
+DEAD = "dead"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS notifications (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT UNIQUE,
+    chat_id INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    parse_mode TEXT,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_notifications_due ON notifications (status, next_attempt_at);
+"""
+
+
+def _connect():
+    os.makedirs(os.path.dirname(SPOOL_DB), exist_ok=True)
+    conn = sqlite3.connect(SPOOL_DB, timeout=10, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+def enqueue_many(items):
+    """items: iterable of dicts with chat_id, text and optional parse_mode/key."""
+    now = time.time()
+    rows = [
+        (item.get("key"), int(item["chat_id"]), item["text"], item.get("parse_mode", "HTML"), now, now)
+        for item in items
+    ]
+    conn = _connect()
+    try:
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(
+                "INSERT OR IGNORE INTO notifications (key, chat_id, text, parse_mode, next_attempt_at, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+    finally:
+        conn.close()
+
+
+def enqueue(chat_id, text, parse_mode="HTML", key=None):
+    """Queues one Telegram message. Re-enqueueing an existing key does nothing."""
+    enqueue_many([{"chat_id": chat_id, "text": text, "parse_mode": parse_mode, "key": key}])
+
+
+def claim_batch(limit=20):
+    """Leases up to `limit` due notifications; returns them as dicts."""
+    now = time.time()
+    conn = _connect()
+    try:
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(
+                "SELECT id, chat_id, text, parse_mode, attempts FROM notifications "
+                "WHERE status = ? AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT ?",
+                (PENDING, now, limit),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE notifications SET attempts = attempts + 1, next_attempt_at = ? WHERE id = ?",
+                [(now + CLAIM_TIMEOUT, row["id"]) for row in rows],
+            )
+        return [dict(row) for row in rows]
+    finally:
+        conn.close()
+
+
+def extend(notification_ids):
+    """Renews the lease on claimed rows that are still queued or being sent."""
+    if not notification_ids:
+        return
+    conn = _connect()
+    try:
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(
+                "UPDATE notifications SET next_attempt_at = ? WHERE id = ? AND status = ?",
+                [(time.time() + CLAIM_TIMEOUT, notification_id, PENDING) for notification_id in notification_ids],
+            )
+    finally:
+        conn.close()
+
+
+def ack(notification_id):
+    conn = _connect()
+    try:
+        conn.execute("UPDATE notifications SET status = ?, last_error = NULL WHERE id = ?", (SENT, notification_id))
+    finally:
+        conn.close()
+
+
+def fail(notification_id, error, permanent=False):
+    """Schedules a retry with exponential backoff, or dead-letters the row."""
+    conn = _connect()
+    try:
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT attempts FROM notifications WHERE id = ?", (notification_id,)).fetchone()
+            if row is None:
+                return
+            attempts = row["attempts"]
+            if permanent or attempts >= MAX_ATTEMPTS:
+                conn.execute(
+                    "UPDATE notifications SET status = ?, last_error = ? WHERE id = ?",
+                    (DEAD, str(error)[:500], notification_id),
+                )
+                print(f"Notification {notification_id} dead-lettered after {attempts} attempts: {error}", flush=True)
+            else:
+                delay = min(MAX_BACKOFF, BASE_BACKOFF * 2 ** (attempts - 1))
+                conn.execute(
+                    "UPDATE notifications SET next_attempt_at = ?, last_error = ? WHERE id = ?",
+                    (time.time() + delay, str(error)[:500], notification_id),
+                )
+    finally:
+        conn.close()
+
+
+def next_due():
+    """Seconds until the next pending notification is due (0 if overdue), or None."""
+    conn = _connect()
+    try:
+        row = conn.execute(
+            "SELECT MIN(next_attempt_at) AS due FROM notifications WHERE status = ?", (PENDING,)
+        ).fetchone()
+    finally:
+        conn.close()
+    if row["due"] is None:
+        return None
+    return max(0.0, row["due"] - time.time())
+
+
+def prune():
+    """Drops sent rows older than KEEP_SENT_DAYS."""
+    conn = _connect()
+    try:
+        conn.execute(
+            "DELETE FROM notifications WHERE status = ? AND created_at < ?",
+            (SENT, time.time() - KEEP_SENT_DAYS * 86400),
+        )
+    finally:
+        conn.close()
+
+
+def stats():
+    conn = _connect()
+    try:
+        rows = conn.execute("SELECT status, COUNT(*) AS n FROM notifications GROUP BY status").fetchall()
+    finally:
+        conn.close()
+    return {row["status"]: row["n"] for row in rows}
+
+
+def import_legacy():
+    """Moves notifications left in the old one-JSON-file-per-message directory into the spool."""
+    if not os.path.isdir(LEGACY_DIR):
+        return 0
+    imported = 0
+    for name in sorted(os.listdir(LEGACY_DIR)):
+        if not name.endswith(".json"):
+            continue
+        path = os.path.join(LEGACY_DIR, name)
+        try:
+            with open(path, 'r') as f:
+                notif = json.load(f)
+            enqueue(notif["chat_id"], notif["text"], notif.get("parse_mode", "HTML"), key=f"legacy:{name}")
+            imported += 1
+        except Exception as e:
+            print(f"Skipping unreadable legacy notification {name}: {e}", flush=True)
+        os.remove(path)
+    return imported
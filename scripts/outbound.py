@@ -0,0 +1,193 @@
+"""Outbound Telegram delivery: per-chat queues with global and per-chat rate limits.
+
+Every chat gets its own FIFO worker, so a RetryAfter for one chat only pauses
+that chat. Pending edits of the same message are coalesced: only the newest
+text is sent, and every caller waiting on the older edit gets the result of
+the newer one. An edit already being sent is not coalesced into; a newer
+edit of that message is queued after it.
+"""
+
+import time
+import asyncio
+from collections import deque
+
+from aiogram.exceptions import TelegramRetryAfter, TelegramBadRequest
+
+# Telegram Bot API limits: ~30 messages/s overall, ~1/s per private chat,
+# 20/minute per group chat.
+GLOBAL_RATE = 30
+PRIVATE_CHAT_RATE = 1
+GROUP_CHAT_RATE = 20 / 60
+LATENCY_SAMPLES = 500
+BUCKET_IDLE = 60     # seconds; a chat's bucket outlives its drained queue this long
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def reserve(self):
+        """Takes one token; returns how many seconds to wait before it may be used."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    async def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class _Request:
+    __slots__ = ("method", "kwargs", "future", "queued_at")
+
+    def __init__(self, method, kwargs, future):
+        self.method = method
+        self.kwargs = kwargs
+        self.future = future
+        self.queued_at = time.monotonic()
+
+
+class _ChatQueue:
+    def __init__(self, bucket):
+        self.order = deque()
+        self.requests = {}
+        self.bucket = bucket
+        self.worker = None
+
+
+class Outbox:
+    def __init__(self, bot):
+        self.bot = bot
+        self.global_bucket = TokenBucket(GLOBAL_RATE, burst=GLOBAL_RATE)
+        self.chats = {}
+        # chat_id -> TokenBucket; kept after the chat's queue drains, so sparse sends stay spaced
+        self.buckets = {}
+        self._seq = 0
+        self.counters = {"sent": 0, "failed": 0, "coalesced": 0, "retry_after": 0}
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    def _submit(self, chat_id, key, method, kwargs):
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            bucket = self.buckets.get(chat_id)
+            if bucket is None:
+                bucket = self.buckets[chat_id] = TokenBucket(GROUP_CHAT_RATE if int(chat_id) < 0 else PRIVATE_CHAT_RATE)
+            chat = self.chats[chat_id] = _ChatQueue(bucket)
+
+        pending = chat.requests.get(key)
+        if pending is not None:
+            # Superseded edit: keep the queue position, send only the newest text
+            pending.kwargs = kwargs
+            self.counters["coalesced"] += 1
+            return pending.future
+
+        request = _Request(method, kwargs, asyncio.get_running_loop().create_future())
+        chat.requests[key] = request
+        chat.order.append(key)
+        if chat.worker is None or chat.worker.done():
+            chat.worker = asyncio.create_task(self._run_chat(chat_id, chat))
+        return request.future
+
+    def send(self, chat_id, **kwargs):
+        """Queues bot.send_message; returns a future resolving to the sent Message."""
+        self._seq += 1
+        return self._submit(chat_id, ("send", self._seq), "send_message", dict(chat_id=chat_id, **kwargs))
+
+    def edit(self, chat_id, message_id, **kwargs):
+        """Queues bot.edit_message_text, replacing any not-yet-sent edit of the same message."""
+        return self._submit(chat_id, ("edit", message_id), "edit_message_text",
+                            dict(chat_id=chat_id, message_id=message_id, **kwargs))
+
+    async def _run_chat(self, chat_id, chat):
+        while chat.order:
+            key = chat.order[0]
+            request = chat.requests[key]
+            await chat.bucket.acquire()
+            await self.global_bucket.acquire()
+            # In flight from here on: a later edit of the same message queues a new request
+            chat.order.popleft()
+            del chat.requests[key]
+            try:
+                result = await getattr(self.bot, request.method)(**request.kwargs)
+            except TelegramRetryAfter as e:
+                # Only this chat waits; the request goes back to the head (and may be coalesced meanwhile)
+                self.counters["retry_after"] += 1
+                print(f"Rate limited in chat {chat_id}. Waiting {e.retry_after + 1}s.", flush=True)
+                await asyncio.sleep(e.retry_after + 1)
+                self._requeue(chat, key, request)
+                continue
+            except TelegramBadRequest as e:
+                if "message is not modified" in str(e):
+                    result = None
+                else:
+                    self._finish(request, error=e)
+                    continue
+            except Exception as e:
+                self._finish(request, error=e)
+                continue
+            self._finish(request, result=result)
+        if not chat.order:
+            self.chats.pop(chat_id, None)
+            self._expire_buckets()
+
+    def _expire_buckets(self):
+        """Forgets the buckets of chats idle for BUCKET_IDLE (refilled, so a new one is the same)."""
+        now = time.monotonic()
+        for chat_id in [c for c, b in self.buckets.items() if now - b.updated > BUCKET_IDLE and c not in self.chats]:
+            del self.buckets[chat_id]
+
+    def _requeue(self, chat, key, request):
+        """Puts a rate-limited request back at the head, or lets a newer edit queued meanwhile stand for it."""
+        newer = chat.requests.get(key)
+        if newer is None:
+            chat.requests[key] = request
+        else:
+            chat.order.remove(key)
+            self.counters["coalesced"] += 1
+            newer.future.add_done_callback(lambda done: _copy_outcome(done, request.future))
+        chat.order.appendleft(key)
+
+    def _finish(self, request, result=None, error=None):
+        if error is not None:
+            self.counters["failed"] += 1
+            if not request.future.done():
+                request.future.set_exception(error)
+            return
+        self.counters["sent"] += 1
+        self.latencies.append(time.monotonic() - request.queued_at)
+        if not request.future.done():
+            request.future.set_result(result)
+
+    def stats(self):
+        """Queue depth and send-latency numbers for status and metrics output."""
+        depths = {chat_id: len(chat.order) for chat_id, chat in self.chats.items()}
+        samples = sorted(self.latencies)
+
+        def pct(p):
+            return samples[min(len(samples) - 1, int(len(samples) * p))] if samples else 0.0
+
+        return {
+            "queued": sum(depths.values()),
+            "chats": len(depths),
+            "max_chat_depth": max(depths.values(), default=0),
+            "latency_p50": pct(0.5),
+            "latency_p95": pct(0.95),
+            **self.counters,
+        }
+
+
+def _copy_outcome(source, target):
+    if target.done():
+        return
+    if source.cancelled():
+        target.cancel()
+    elif source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
@@ -0,0 +1,268 @@
+"""On-demand profiling of the long-running services, without restarting them.
+
+A capture is requested by a signal or by a request file, usually written
+by the admin command /profile in the gateway:
+
+    kill -USR1 <pid>    CPU profile (cProfile) of the next ITERATIONS loop iterations
+    kill -USR2 <pid>    memory: allocations made during the next ITERATIONS iterations
+                        and still alive at the end (tracemalloc)
+    /app/data/profiles/request_<service>.json   {"id": ..., "kind": "cpu"|"memory"|"tasks", "iterations": N}
+
+Every process of a service handles each request once, so all runners are
+profiled. The runner and heartbeat check for requests at the start of each
+loop iteration (`with profiler.iteration(): ...`). The gateway has no loop
+iterations; it profiles for `seconds` instead and can also dump its asyncio
+tasks with their stacks and the event-loop lag ("tasks").
+
+Results go to /app/data/profiles/<process>_<time>_<kind>.*:
+.prof files are cProfile stats, for `python -m pstats` or snakeviz;
+.tracemalloc files are tracemalloc.Snapshot.dump() output. Each capture
+also writes a .txt summary. Only the newest MAX_FILES files are kept.
+"""
+
+import io
+import os
+import json
+import time
+import signal
+import pstats
+import asyncio
+import cProfile
+import tracemalloc
+from datetime import datetime
+
+PROFILE_DIR = "/app/data/profiles"
+ITERATIONS = int(os.getenv("PROFILE_ITERATIONS", "5"))
+SECONDS = 30         # default capture length for the gateway
+MAX_FILES = 60
+TOP = 40             # lines in the .txt summaries
+TRACE_FRAMES = 10    # tracemalloc traceback depth
+
+KINDS = ("cpu", "memory", "tasks")
+
+
+def request(service, kind, iterations=None, seconds=None):
+    """Asks every process of `service` to capture a profile; returns the request."""
+    req = {"id": time.time(), "kind": kind, "iterations": iterations or ITERATIONS, "seconds": seconds or SECONDS}
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, f"request_{service}.json")
+    with open(f"{path}.tmp", 'w') as f:
+        json.dump(req, f)
+    os.replace(f"{path}.tmp", path)
+    return req
+
+
+def recent(limit=10):
+    """Newest result files (summaries only), newest first."""
+    try:
+        names = [n for n in os.listdir(PROFILE_DIR) if n.endswith(".txt")]
+    except FileNotFoundError:
+        return []
+    return sorted(names, key=lambda n: os.path.getmtime(os.path.join(PROFILE_DIR, n)), reverse=True)[:limit]
+
+
+def _prune():
+    names = [n for n in os.listdir(PROFILE_DIR) if not n.startswith("request_")]
+    names.sort(key=lambda n: os.path.getmtime(os.path.join(PROFILE_DIR, n)))
+    for name in names[:-MAX_FILES]:
+        try:
+            os.remove(os.path.join(PROFILE_DIR, name))
+        except OSError:
+            pass
+
+
+def _cpu_summary(profile):
+    out = io.StringIO()
+    stats = pstats.Stats(profile, stream=out)
+    stats.sort_stats("cumulative").print_stats(TOP)
+    stats.sort_stats("tottime").print_stats(TOP)
+    return out.getvalue()
+
+
+def _memory_summary(snapshot):
+    snapshot = snapshot.filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ))
+    stats = snapshot.statistics("lineno")
+    total = sum(s.size for s in stats)
+    lines = [f"{len(stats)} allocation sites, {total / 1024:.1f} KiB still allocated", ""]
+    lines += [str(s) for s in stats[:TOP]]
+    lines += ["", "Largest by traceback:", ""]
+    for s in snapshot.statistics("traceback")[:5]:
+        lines.append(f"{s.count} blocks, {s.size / 1024:.1f} KiB")
+        lines += [f"  {line}" for line in s.traceback.format()]
+    return "\n".join(lines) + "\n"
+
+
+class Profiler:
+    """Per-process profiling state. install() once, then wrap each loop iteration."""
+
+    def __init__(self, service, process=None):
+        self.service = service
+        self.process = (process or service).replace(os.sep, "_")
+        self.started = time.time()
+        self.seen = None        # id of the last request file handled
+        self.pending = None     # (kind, iterations) from a signal
+        self.active = None      # kind being captured
+        self.remaining = 0
+        self.profile = None
+
+    def install(self, loop=None):
+        """SIGUSR1/SIGUSR2 request a CPU/memory capture (through the event loop when given)."""
+        handlers = {signal.SIGUSR1: "cpu", signal.SIGUSR2: "memory"}
+        for signum, kind in handlers.items():
+            callback = lambda kind=kind: setattr(self, "pending", (kind, ITERATIONS))
+            if loop is not None:
+                loop.add_signal_handler(signum, callback)
+            else:
+                signal.signal(signum, lambda *_, callback=callback: callback())
+        return self
+
+    def poll(self):
+        """The next request for this process, or None (a signal, else an unseen request file)."""
+        if self.pending:
+            kind, iterations = self.pending
+            self.pending = None
+            return {"kind": kind, "iterations": iterations, "seconds": SECONDS}
+        for name in (self.service, "all"):
+            path = os.path.join(PROFILE_DIR, f"request_{name}.json")
+            try:
+                if os.path.getmtime(path) < self.started:
+                    continue
+                with open(path, 'r') as f:
+                    req = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if req.get("id") != self.seen and req.get("id", 0) >= self.started:
+                self.seen = req.get("id")
+                if req.get("kind") in KINDS:
+                    return req
+        return None
+
+    def _path(self, kind, ext):
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        return os.path.join(PROFILE_DIR, f"{self.process}_{datetime.now():%Y%m%d_%H%M%S}_{kind}.{ext}")
+
+    def _write(self, kind, header, summary, dump=None, ext=None):
+        """Writes the summary (and the standard-format dump); returns the summary path."""
+        if dump is not None:
+            dump(self._path(kind, ext))
+        path = self._path(kind, "txt")
+        with open(path, 'w') as f:
+            f.write(header + "\n\n" + summary)
+        _prune()
+        print(f"Profile written: {path}", flush=True)
+        return path
+
+    # --- Loop-driven services (runner, heartbeat) ---
+
+    def iteration(self):
+        return _Iteration(self)
+
+    def _begin(self):
+        if self.active is None:
+            req = self.poll()
+            if req is None or req["kind"] == "tasks":
+                return
+            self.active, self.remaining = req["kind"], max(1, int(req.get("iterations") or ITERATIONS))
+            self.total = self.remaining
+            self.capture_started = time.time()
+            if self.active == "memory" and not tracemalloc.is_tracing():
+                tracemalloc.start(TRACE_FRAMES)
+            print(f"Profiling ({self.active}) the next {self.remaining} iterations...", flush=True)
+        if self.active == "cpu":
+            self.profile = self.profile or cProfile.Profile()
+            self.profile.enable()
+
+    def _end(self):
+        if self.active is None:
+            return
+        if self.active == "cpu":
+            self.profile.disable()
+        self.remaining -= 1
+        if self.remaining > 0:
+            return
+        kind, self.active = self.active, None
+        header = (f"{self.process}: {kind} profile of {self.total} iterations, "
+                  f"{time.time() - self.capture_started:.1f}s, pid {os.getpid()}")
+        try:
+            if kind == "cpu":
+                profile, self.profile = self.profile, None
+                self._write(kind, header, _cpu_summary(profile), profile.dump_stats, "prof")
+            else:
+                snapshot = tracemalloc.take_snapshot()
+                tracemalloc.stop()
+                self._write(kind, header, _memory_summary(snapshot), snapshot.dump, "tracemalloc")
+        except Exception as e:
+            print(f"Profile capture failed: {e}", flush=True)
+
+    # --- The gateway (asyncio) ---
+
+    async def capture(self, kind, seconds=SECONDS):
+        """Profiles the event loop thread for `seconds` (cpu, memory) or dumps its tasks; returns the summary path."""
+        header = f"{self.process}: {kind}, pid {os.getpid()}"
+        if kind == "tasks":
+            return self._write(kind, header, _tasks_summary())
+        header += f", {seconds:g}s"
+        if kind == "cpu":
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                profile.disable()
+            return self._write(kind, header, _cpu_summary(profile), profile.dump_stats, "prof")
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start(TRACE_FRAMES)
+        try:
+            await asyncio.sleep(seconds)
+            snapshot = tracemalloc.take_snapshot()
+        finally:
+            if not tracing:
+                tracemalloc.stop()
+        return self._write(kind, header, _memory_summary(snapshot), snapshot.dump, "tracemalloc")
+
+    async def watch(self, interval=5):
+        """Serves request files and signals for the gateway forever."""
+        while True:
+            await asyncio.sleep(interval)
+            req = self.poll()
+            if req is None:
+                continue
+            try:
+                await self.capture(req["kind"], float(req.get("seconds") or SECONDS))
+            except Exception as e:
+                print(f"Profile capture failed: {e}", flush=True)
+
+
+class _Iteration:
+    def __init__(self, profiler):
+        self.profiler = profiler
+
+    def __enter__(self):
+        try:
+            self.profiler._begin()
+        except Exception as e:
+            print(f"Profiling error: {e}", flush=True)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.profiler._end()
+
+
+def _tasks_summary():
+    """The running loop's asyncio tasks with their stacks, and its lag."""
+    import async_storage as storage
+    lag = storage.lag_summary()
+    lines = [f"Event loop lag: last {lag['last'] * 1000:.0f}ms, p95 {lag['p95'] * 1000:.0f}ms, "
+             f"max {lag['max'] * 1000:.0f}ms, {lag['stalls']} stalls", ""]
+    tasks = sorted(asyncio.all_tasks(), key=lambda t: t.get_name())
+    lines.append(f"{len(tasks)} tasks:")
+    for task in tasks:
+        stack = io.StringIO()
+        task.print_stack(limit=TRACE_FRAMES, file=stack)
+        lines += ["", stack.getvalue().rstrip()]
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,124 @@
+"""Gateway -> runner wake-up channel.
+
+The task file on disk stays the source of truth; these datagrams only tell
+the runner which user to look at first instead of waiting for its next poll,
+or that a task it may be running right now was cancelled. A dropped message
+costs at most one poll interval (or cancel check interval).
+"""
+
+import os
+import json
+import time
+import socket
+import select
+
+RUNNER_SOCKET_DIR = "/app/data/runner_sockets"   # one socket per runner process
+
+
+def _send(message):
+    """Fans the message out to every runner; each decides whether the task is its to take."""
+    try:
+        names = [n for n in os.listdir(RUNNER_SOCKET_DIR) if n.endswith(".sock")]
+    except OSError:
+        return  # No runner listening; they will find the file on their next pass
+    data = json.dumps(message).encode('utf-8')
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        sock.setblocking(False)
+        for name in names:
+            path = os.path.join(RUNNER_SOCKET_DIR, name)
+            try:
+                sock.sendto(data, path)
+            except ConnectionRefusedError:
+                # Left behind by a runner that died without cleaning up
+                try: os.remove(path)
+                except OSError: pass
+            except OSError:
+                pass
+
+
+def task_enqueued(user_id, filename, interactive=True):
+    """Tell the runner a task file for user_id was written or unblocked."""
+    _send({
+        "type": "task_enqueued",
+        "user_id": str(user_id),
+        "task": filename,
+        "interactive": interactive,
+        "ts": time.time(),
+    })
+
+
+def task_cancelled(user_id, filename):
+    """Tell the runner to abort task `filename` if it is running (status is already on disk)."""
+    _send({
+        "type": "task_cancelled",
+        "user_id": str(user_id),
+        "task": filename,
+        "interactive": True,
+        "ts": time.time(),
+    })
+
+
+class Inbox:
+    """Runner-side endpoint. Not thread-safe; owned by the runner's main loop."""
+
+    def __init__(self, name=None, path=None):
+        path = path or os.path.join(RUNNER_SOCKET_DIR, f"{name or os.getpid()}.sock")
+        self.path = path
+        if os.path.exists(path):
+            os.remove(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(path)
+        self.sock.setblocking(False)
+        self.cancelled = set()    # (user_id, filename) pairs seen in task_cancelled messages
+        self._buffered = []       # received by poll_cancels(), not yet returned by drain()/wait()
+
+    def _receive(self):
+        messages, self._buffered = self._buffered, []
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except BlockingIOError:
+                return messages
+            try:
+                msg = json.loads(data.decode('utf-8'))
+            except ValueError:
+                continue
+            if msg.get("type") == "task_cancelled":
+                self.cancelled.add((msg.get("user_id"), msg.get("task")))
+            messages.append(msg)
+
+    def _users(self, messages, interactive_only):
+        users = []
+        # Interactive wake-ups first, each user once
+        for msg in sorted(messages, key=lambda m: not m.get("interactive")):
+            if msg.get("type") not in ("task_enqueued", "task_cancelled"):
+                continue
+            if interactive_only and not msg.get("interactive"):
+                continue
+            if msg.get("user_id") and msg["user_id"] not in users:
+                users.append(msg["user_id"])
+        return users
+
+    def drain(self):
+        """Non-blocking: user ids with pending interactive tasks."""
+        return self._users(self._receive(), interactive_only=True)
+
+    def wait(self, timeout):
+        """Blocks up to timeout seconds; returns woken user ids (interactive first)."""
+        if not self._buffered:
+            ready, _, _ = select.select([self.sock], [], [], timeout)
+            if not ready:
+                return []
+        return self._users(self._receive(), interactive_only=False)
+
+    def close(self):
+        self.sock.close()
+        try: os.remove(self.path)
+        except OSError: pass
+
+    def poll_cancels(self):
+        """Non-blocking, for use while a task runs: updates and returns `cancelled`,
+        keeping any wake-ups for the next drain()/wait()."""
+        self._buffered = self._receive()
+        return self.cancelled
@@ -1,16 +1,24 @@
 import os
-import json
-import yaml
 import asyncio
 import re
 import glob
 from datetime import datetime
 from utils import strip_ansi
+from delivery_ledger import DeliveryLedger, content_hash
+import events
+import notification_spool
+import msg_index
+import task_lease
+import task_store
+import task_parser
+import metrics
+import usage
+import tracing
+import async_storage as storage
+from aiogram.types import InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from aiogram.exceptions import TelegramBadRequest
 
 USERS_ROOT = "/app/users"
-CURRENT_TASK_FILE = "/app/data/current_task.json"
 
 def get_current_tasks(user_id=None):
     res = ""
@@ -55,222 +63,414 @@ def get_memories_summary(user_id):
     return res
 
 def get_running_status(user_id):
-    if os.path.exists(CURRENT_TASK_FILE):
-        try:
-            with open(CURRENT_TASK_FILE, 'r') as f:
-                data = json.load(f)
-                if str(data.get('user_id')) == str(user_id):
-                    started = datetime.fromisoformat(data['started_at']).strftime("%H:%M:%S")
-                    return f"⚙️ <b>Выполняется:</b>\n{data['task']} (с {started})"
-        except Exception: pass
+    lines = []
+    for status in task_lease.running_tasks():
+        if status.get('task') and str(status.get('user_id')) == str(user_id):
+            started = datetime.fromisoformat(status['started_at']).strftime("%H:%M:%S")
+            lines.append(f"{status['task']} (с {started})")
+    if lines:
+        return "⚙️ <b>Выполняется:</b>\n" + "\n".join(lines)
     return "⏸ Простой."
 
+def get_running_task(user_id):
+    """Filename of a task some runner is working on for user_id, or None."""
+    for status in task_lease.running_tasks():
+        if status.get('task') and str(status.get('user_id')) == str(user_id):
+            return status['task']
+    return None
+
+def get_usage_summary(user_id):
+    """Today's metered Gemini / init.sh usage and limit state (see usage.py)."""
+    used = usage.totals(user_id)
+    res = (f"📊 <b>Ресурсы сегодня:</b> {used['calls']} запусков, CPU {_age(used['cpu_seconds'])}, "
+           f"время {_age(used['wall_seconds'])}, пик памяти {used['peak_rss_mb']} MB")
+    user_limits = usage.limits(user_id)
+    for level in ("soft", "hard"):
+        caps = [f"{'CPU' if field == 'cpu_seconds' else 'время'} {_age(limit)}"
+                for field, limit in user_limits.get(level, {}).items() if limit]
+        if caps:
+            res += f"\n{'Мягкий' if level == 'soft' else 'Жёсткий'} лимит: {', '.join(caps)}"
+    state = usage.state(user_id)
+    if state == "soft":
+        res += "\n⚠️ Мягкий лимит превышен: ваши задачи выполняются после остальных."
+    elif state == "hard":
+        res += "\n⛔ Жёсткий лимит превышен: новые задачи отложены до завтра."
+    return res
+
 def get_full_state(user_id):
-    return f"{get_running_status(user_id)}\n\n{get_current_tasks(user_id)}\n\n{get_memories_summary(user_id)}"
+    return (f"{get_running_status(user_id)}\n\n{get_current_tasks(user_id)}\n\n{get_memories_summary(user_id)}"
+            f"\n\n{get_usage_summary(user_id)}")
+
+def _age(seconds):
+    seconds = max(0, int(seconds))
+    if seconds < 60: return f"{seconds}s"
+    if seconds < 3600: return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds // 3600}h{seconds // 60 % 60:02d}m"
+
+def _series(snapshots, kind, name, processes=None):
+    """[(process, labels, value)] of one metric across the processes' snapshots."""
+    return [(process, labels, value) for process, data in snapshots.items()
+            if processes is None or process.startswith(processes)
+            for labels, value in data.get(kind, {}).get(name, [])]
+
+def get_perf_report(lag, outbox_stats):
+    """/perf: live numbers from the services' metrics snapshots and runner status files (no task scans)."""
+    snapshots = metrics.load_snapshots()
+    now = datetime.now()
+    res = f"📈 <b>Performance</b> ({now.strftime('%H:%M:%S')})\n"
+
+    # Queue (heartbeat gauges, refreshed every minute)
+    beat = snapshots.get("heartbeat")
+    depth = {labels["user"]: value for _, labels, value in _series(snapshots, "gauges", "queue_depth", "heartbeat")}
+    oldest = {labels["user"]: value for _, labels, value in _series(snapshots, "gauges", "queue_oldest_seconds", "heartbeat")}
+    deferred, deferred_by = {}, {}
+    for _, labels, value in _series(snapshots, "gauges", "tasks_deferred", "heartbeat"):
+        deferred[labels["user"]] = deferred.get(labels["user"], 0) + value
+        if value: deferred_by.setdefault(labels["user"], []).append(f"{labels.get('reason', 'quota')} {value:g}")
+    busy = sorted((u for u in depth if depth[u] or deferred.get(u)), key=lambda u: -oldest.get(u, 0))
+    age = f", as of {_age(now.timestamp() - beat['updated_at'])} ago" if beat else ", heartbeat metrics missing"
+    res += f"\n📋 <b>Queue</b> ({sum(depth.values())} tasks{age}):\n"
+    for user in busy[:10]:
+        line = f"- {user}: {depth[user]} queued"
+        if depth[user]: line += f", oldest {_age(oldest.get(user, 0))}"
+        if deferred.get(user): line += f", {deferred[user]:g} deferred ({', '.join(deferred_by[user])})"
+        res += line + "\n"
+    if len(busy) > 10: res += f"- … {len(busy) - 10} more users\n"
+
+    # Running tasks (runner status files)
+    res += "\n⚙️ <b>Runners:</b>\n"
+    runners = task_lease.running_tasks()
+    for status in runners:
+        if status.get('task'):
+            started = datetime.fromisoformat(status['started_at'])
+            res += f"- {status['runner']}: {status['user_id']}/<code>{status['task']}</code>, step {_age((now - started).total_seconds())}\n"
+        else:
+            res += f"- {status['runner']}: idle\n"
+    if not runners: res += "- none alive\n"
+
+    # Gemini over the last hour, by model
+    calls = {}
+    for _, labels, value in _series(snapshots, "gauges", "gemini_calls_last_hour", "runner-"):
+        calls.setdefault(labels["model"], {}).setdefault(labels["outcome"], 0)
+        calls[labels["model"]][labels["outcome"]] += value
+    res += "\n🤖 <b>Gemini, last hour:</b>\n"
+    for model, outcomes in sorted(calls.items()):
+        failed = {k: v for k, v in outcomes.items() if k != "ok" and v}
+        detail = ", ".join(f"{k} {v}" for k, v in sorted(failed.items()))
+        res += f"- {model}: {sum(outcomes.values())} calls, {sum(failed.values())} failed{f' ({detail})' if detail else ''}\n"
+    if not calls: res += "- no calls\n"
+    resets = {}
+    for _, labels, value in _series(snapshots, "gauges", "gemini_quota_reset_timestamp", "runner-"):
+        resets[labels["model"]] = max(resets.get(labels["model"], 0), value)
+    exhausted = {m: t for m, t in resets.items() if t > now.timestamp()}
+    res += "⏸ <b>Quota:</b> " + (", ".join(f"{m} resets in {_age(t - now.timestamp())}" for m, t in sorted(exhausted.items()))
+                                 or "ok") + "\n"
+
+    # Notifier and event loop (this process)
+    own = metrics.snapshot()
+    for labels, counts in own["histograms"].get("notify_iteration_seconds", []):
+        p50, p95 = metrics.quantile(counts, 0.5), metrics.quantile(counts, 0.95)
+        res += f"\n📤 <b>Notifier loop:</b> p50 {p50 * 1000:.0f}ms, p95 {p95 * 1000:.0f}ms over {sum(counts[:-1])} iterations\n"
+    res += (f"📬 Outbox: {outbox_stats['queued']} queued, latency p95 {outbox_stats['latency_p95']:.1f}s\n"
+            f"⏱ <b>Event loop lag:</b> {lag['last'] * 1000:.0f}ms now, p95 {lag['p95'] * 1000:.0f}ms, "
+            f"max {lag['max'] * 1000:.0f}ms, {lag['stalls']} stalls\n")
+
+    # Git
+    syncing = sum(value for _, _, value in _series(snapshots, "gauges", "git_syncs_in_progress", "runner-"))
+    pushes = {}
+    for _, labels, counts in _series(snapshots, "histograms", "git_command_seconds", "git_manager"):
+        if labels.get("command") == "push":
+            pushes[labels.get("outcome", "ok")] = pushes.get(labels.get("outcome", "ok"), 0) + sum(counts[:-1])
+    res += f"\n🗂 <b>Git:</b> {syncing} syncs in progress, pushes ok {pushes.pop('ok', 0)} / failed {sum(pushes.values())} (total)"
+    return res
+
+def user_id_from_path(filepath):
+    """/app/users/user_<id>/tasks[/archive]/<file> -> <id>"""
+    return os.path.relpath(filepath, USERS_ROOT).split(os.sep)[0].replace("user_", "")
 
 def strip_ansi_compat(text):
     return strip_ansi(text)
 
-async def notify_results(bot, send_fn):
+def _sanitize_answer(final_answer):
+    """Escape everything, then restore only Telegram-supported HTML tags."""
+    import html
+    safe = html.escape(final_answer)
+    tg_tags = ['b', 'i', 'u', 's', 'a', 'code', 'pre', 'blockquote']
+    for tag in tg_tags:
+        safe = safe.replace(f'&lt;{tag}&gt;', f'<{tag}>')
+        safe = safe.replace(f'&lt;{tag} ', f'<{tag} ')  # tags with attributes like <a href>
+        safe = safe.replace(f'&lt;/{tag}&gt;', f'</{tag}>')
+    # Restore href attributes in <a> tags (escaped quotes)
+    return re.sub(r'<a\s+href=&quot;(.*?)&quot;', r'<a href="\1"', safe)
+
+_STEP_LINES = {
+    "pending": "⬜ {}",
+    "running": "🔄 {}",
+    "done": "✅ <b>{}</b>",
+    "failed": "❌ {}",
+    "skipped": "⏭ <s>{}</s>",
+}
+
+def render_dashboard(task):
+    """Returns (display_text, has_answer) for the status message of a parsed task."""
+    import html as _html
+
+    # 1. REQUEST (Short summary), escaped to prevent HTML errors
+    req_text = task.request[:100] + "..." if task.request else "Processing..."
+    req_text = req_text.replace("<", "&lt;").replace(">", "&gt;")
+
+    # 2. FINAL RESULT (if any)
+    final_answer = task.answer
+
+    display_text = f"🤖 <b>Task:</b> {req_text}\n\n"
+    cancelled = task.cancelled
+
+    if final_answer and not cancelled:
+        # Task Completed
+        display_text += f"✅ <b>Done!</b>\n\n{_sanitize_answer(final_answer)}"
+    elif task.plan_text:
+        # Task In Progress - Show Plan
+        display_text += "📋 <b>Plan:</b>\n"
+        for step in task.plan:
+            display_text += _STEP_LINES[step.state].format(_html.escape(step.text)) + "\n"
+    elif not cancelled:
+        display_text += "⏳ <i>Initializing...</i>"
+
+    if cancelled:
+        display_text += "\n🚫 <b>Cancelled.</b>"
+
+    return display_text, bool(final_answer)
+
+def store_delivery(filepath, archived, body, message_id, current_hash):
     """
-    Scans user directories for:
+    Writes status_message_id (and the hash, if the body is unchanged) into the
+    freshly read task file. Returns (filepath, archived, unchanged) or None.
+    """
+    # The runner may have archived the task meanwhile
+    if not os.path.exists(filepath) and not archived:
+        filepath = os.path.join(os.path.dirname(filepath), "archive", os.path.basename(filepath))
+        archived = True
+    unchanged = False
+
+    def update(metadata, current_body):
+        nonlocal unchanged
+        if message_id is not None:
+            metadata['status_message_id'] = message_id
+        unchanged = current_body == body
+        if unchanged:
+            metadata['last_status_hash'] = current_hash
+        return metadata, current_body
+
+    try:
+        if task_store.modify(filepath, update) is None: return None
+    except FileNotFoundError:
+        return None
+    if message_id is not None:
+        msg_index.add(user_id_from_path(filepath), os.path.basename(filepath), message_id)
+    return filepath, archived, unchanged
+
+async def notify_results(outbox, send_fn):
+    """
+    Delivers dashboards for task files that changed:
     1. Active Tasks (in tasks/) -> Update Dashboard (Edit Message)
     2. Completed Tasks (in archive/) -> Final Result (Edit Message one last time)
+    Runner events (see events.py) trigger an immediate update of the task they
+    name; a full scan only runs every RECONCILE_INTERVAL seconds to catch
+    anything whose event was lost. What was already delivered is kept in the
+    DeliveryLedger, so finalized archive entries are never read again.
+    Sends go through the Outbox (outbound.py), so a rate-limited chat never
+    stalls this loop.
     """
-    from aiogram.exceptions import TelegramRetryAfter
     import time as _time
+    from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
     
-    # Per-chat cooldown: chat_id -> timestamp of last successful edit
-    _last_edit = {}
-    MIN_EDIT_INTERVAL = 5  # seconds between edits per chat
-    NOTIF_DIR = "/app/data/notifications"
-    
+    RECONCILE_INTERVAL = 30  # seconds between full scans (fallback for lost events)
+    NOTIF_BATCH = 20  # spool rows claimed per drain
+    MIN_EDIT_INTERVAL = 5  # seconds between dashboard edits per chat
+    # Per-chat cooldown: chat_id -> time the last dashboard edit was queued
+    last_edit = {}
+    SPOOL_POLL = 5  # seconds; producers without an event (heartbeat) are picked up this fast
+    ledger = await storage.run(DeliveryLedger)
+
+    # Tasks waiting for delivery: filepath -> archived
+    pending = {}
+    # Tasks whose first dashboard message is still queued (no message_id yet)
+    sending_new = set()
+    # Spool rows claimed and not yet acked or failed (their leases are renewed), and when they last were
+    claimed = set()
+    claims_renewed = _time.time()
+    # When each pending task first changed (event time), for the "notify" trace span
+    changed_at = {}
+    event_queue = asyncio.Queue()
+    try:
+        imported = await storage.run(notification_spool.import_legacy)
+        if imported: print(f"Imported {imported} legacy notifications into the spool.", flush=True)
+        await storage.run(notification_spool.prune)
+    except Exception as e:
+        print(f"Notification spool error: {e}", flush=True)
+    try:
+        await events.listen(event_queue.put_nowait)
+    except Exception as e:
+        print(f"Event channel unavailable, polling only: {e}", flush=True)
+
+    async def send_notifications():
+        # Drain due rows of the notification spool (from task_runner / heartbeat)
+        for notif in await storage.run(notification_spool.claim_batch, NOTIF_BATCH):
+            fut = outbox.send(notif["chat_id"], text=notif["text"], parse_mode=notif["parse_mode"] or "HTML")
+            claimed.add(notif["id"])
+            asyncio.create_task(notification_done(fut, notif["id"]))
+
+    async def renew_claims():
+        # A rate-limited chat queue can hold a row past CLAIM_TIMEOUT; it must not be claimed twice
+        nonlocal claims_renewed
+        if claimed and _time.time() - claims_renewed >= notification_spool.CLAIM_TIMEOUT / 4:
+            await storage.run(notification_spool.extend, list(claimed))
+            claims_renewed = _time.time()
+
+    async def notification_done(fut, notif_id):
+        try:
+            await fut
+        except Exception as error:
+            claimed.discard(notif_id)
+            print(f"Notification send error: {error}", flush=True)
+            permanent = isinstance(error, (TelegramBadRequest, TelegramForbiddenError))
+            await storage.run(notification_spool.fail, notif_id, error, permanent=permanent)
+        else:
+            claimed.discard(notif_id)
+            await storage.run(notification_spool.ack, notif_id)
+
+    async def delivered(fut, filepath, archived, body, current_hash, is_new, trace_id, since):
+        """Stores the dashboard message id and hash once the Outbox has sent it."""
+        try:
+            sent_msg = await fut
+        except Exception as e:
+            print(f"Notify Error details: {e}")
+            await storage.run(tracing.record, trace_id, "notify", since, _time.time(),
+                              task=os.path.basename(filepath), final=archived, error=type(e).__name__)
+            return
+        finally:
+            if is_new: sending_new.discard(filepath)
+        await storage.run(tracing.record, trace_id, "notify", since, _time.time(),
+                          task=os.path.basename(filepath), kind="send" if is_new else "edit", final=archived)
+
+        # UPDATE METADATA (on the fresh copy, so concurrent runner writes survive)
+        message_id = sent_msg.message_id if sent_msg is not None else None
+        stored = await storage.run(store_delivery, filepath, archived, body, message_id, current_hash)
+        if stored is None: return
+        filepath, archived, unchanged = stored
+        if unchanged:
+            await storage.run(ledger.record, filepath, current_hash, final=archived)
+        else:
+            # Changed while queued: render again
+            event_queue.put_nowait({"type": "retry", "path": filepath})
+
+    async def deliver(filepath, archived):
+        """Renders one task's dashboard and queues it. Returns False to retry later."""
+        filename = os.path.basename(filepath)
+        # READ FILE
+        try:
+            task = await storage.run(task_parser.load, filepath)
+        except Exception:
+            return True # Moved (e.g. archived; its new path gets its own event) or unreadable
+        if task is None: # Metada + Content required
+            await storage.run(ledger.record, filepath, final=archived)
+            return True
+        metadata, body = task.metadata, task.body
+        
+        chat_id = metadata.get('chat_id')
+        status_msg_id = metadata.get('status_message_id')
+        
+        if not chat_id:
+            await storage.run(ledger.record, filepath, final=archived)
+            return True
+
+        display_text, _ = await storage.run(render_dashboard, task)
+
+        # HASH CHECK to avoid spamming edits if nothing changed
+        current_hash = content_hash(display_text)
+        if current_hash in (ledger.last_hash(filepath), metadata.get('last_status_hash')):
+            await storage.run(ledger.record, filepath, current_hash, final=archived)
+            return True
+        if archived and await storage.run(ledger.assume_delivered, filepath, metadata):
+            await storage.run(ledger.record, filepath, current_hash, final=True)
+            return True
+        if not status_msg_id and filepath in sending_new:
+            return False # Wait for the first message_id instead of sending twice
+
+        # SEND / EDIT
+        builder = InlineKeyboardBuilder()
+        # Check for Confirmation
+        if task.confirm is not None:
+            display_text += f"\n\n❓ <b>Confirm:</b> {task.confirm}" # Show pure text
+            builder.button(text="✅ Yes", callback_data=f"conf_yes_{filename}")
+            builder.button(text="❌ No", callback_data=f"conf_no_{filename}")
+            builder.adjust(2)
+        # Cancel button while the task is still active (callback_data is capped at 64 bytes)
+        can_cancel = not archived and len(f"cancel_{filename}".encode()) <= 64
+        if can_cancel:
+            builder.row(InlineKeyboardButton(text="✖️ Cancel", callback_data=f"cancel_{filename}"))
+        reply_markup = builder.as_markup() if task.confirm is not None or can_cancel else None
+
+        if status_msg_id:
+            # Rate limit: retry later if this chat got a dashboard edit too recently
+            if _time.time() - last_edit.get(str(chat_id), 0) < MIN_EDIT_INTERVAL:
+                return False
+            last_edit[str(chat_id)] = _time.time()
+        metrics.inc("dashboard_updates_total", kind="edit" if status_msg_id else "send", final=archived)
+        if status_msg_id:
+            # EDIT (coalesced with any edit of this message still queued)
+            fut = outbox.edit(chat_id, status_msg_id, text=display_text, parse_mode="HTML", reply_markup=reply_markup)
+        else:
+            # SEND NEW
+            fut = outbox.send(chat_id, text=display_text, parse_mode="HTML", reply_markup=reply_markup)
+            sending_new.add(filepath)
+        asyncio.create_task(delivered(fut, filepath, archived, body, current_hash, not status_msg_id,
+                                      metadata.get('trace_id'), changed_at.get(filepath, _time.time())))
+        return True
+
+    last_reconcile = 0
+    spool_due = None
     while True:
+        iteration_started = _time.perf_counter()
         try:
-            # Process notification queue (from task_runner)
-            if os.path.exists(NOTIF_DIR):
-                for nf_name in os.listdir(NOTIF_DIR):
-                    if not nf_name.endswith(".json"): continue
-                    nf_path = os.path.join(NOTIF_DIR, nf_name)
-                    try:
-                        with open(nf_path, 'r') as f:
-                            notif = json.load(f)
-                        await bot.send_message(
-                            chat_id=int(notif["chat_id"]),
-                            text=notif["text"],
-                            parse_mode=notif.get("parse_mode", "HTML")
-                        )
-                        os.remove(nf_path)
-                    except Exception as ne:
-                        print(f"Notification send error: {ne}", flush=True)
-                        os.remove(nf_path)  # Remove even on error to avoid infinite retry
-            user_dirs = glob.glob(os.path.join(USERS_ROOT, "user_*"))
-            for user_dir in user_dirs:
-                user_id = os.path.basename(user_dir).replace("user_", "")
-
-                
-                tasks_dir = os.path.join(user_dir, "tasks")
-                archive_dir = os.path.join(tasks_dir, "archive")
-                
-                # Check both Active and Archive
-                for folder in [tasks_dir, archive_dir]:
-                    if not os.path.exists(folder): continue
-                    
-                    for filename in os.listdir(folder):
-                        if not filename.endswith(".md"): continue
-                        filepath = os.path.join(folder, filename)
-                        
-                        try:
-                            # READ FILE
-                            with open(filepath, 'r') as f: content = f.read()
-                            parts = content.split('---', 2)
-                            if len(parts) < 3: continue # Metada + Content required
-                            
-                            metadata = yaml.safe_load(parts[1]) or {}
-                            chat_id = metadata.get('chat_id')
-                            status_msg_id = metadata.get('status_message_id')
-                            last_hash = metadata.get('last_status_hash')
-                            
-                            if not chat_id: continue
-
-                            # PARSE CONTENT
-                            body = content.split('---', 2)[-1]
-                            
-                            # 1. Extract REQUEST (Short summary)
-                            req_match = re.search(r'# Request\n(.*?)\n#', body, re.DOTALL)
-                            req_text = req_match.group(1).strip()[:100] + "..." if req_match else "Processing..."
-                            # Escape HTML in request text to prevent errors
-                            req_text = req_text.replace("<", "&lt;").replace(">", "&gt;")
-                            
-                            # 2. Extract PLAN
-                            plan_match = re.search(r'# Plan\n(.*?)\n#', body, re.DOTALL)
-                            plan_text = plan_match.group(1).strip() if plan_match else ""
-                            
-                            # 3. Extract FINAL RESULT (if any)
-                            result_match = re.search(r'<answer>(.*?)</answer>', body, re.DOTALL | re.IGNORECASE)
-                            final_answer = result_match.group(1).strip() if result_match else None
-                            
-                            # Sanitize final_answer: only allow Telegram-supported HTML tags
-                            if final_answer:
-                                import html
-                                # First escape everything
-                                safe = html.escape(final_answer)
-                                # Then restore only Telegram-supported tags
-                                tg_tags = ['b', 'i', 'u', 's', 'a', 'code', 'pre', 'blockquote']
-                                for tag in tg_tags:
-                                    safe = safe.replace(f'&lt;{tag}&gt;', f'<{tag}>')
-                                    safe = safe.replace(f'&lt;{tag} ', f'<{tag} ')  # tags with attributes like <a href>
-                                    safe = safe.replace(f'&lt;/{tag}&gt;', f'</{tag}>')
-                                # Restore href attributes in <a> tags (escaped quotes)
-                                safe = re.sub(r'<a\s+href=&quot;(.*?)&quot;', r'<a href="\1"', safe)
-                                final_answer = safe
-                            
-                            # GENERATE DISPLAY TEXT
-                            display_text = f"🤖 <b>Task:</b> {req_text}\n\n"
-                            
-                            if final_answer:
-                                # Task Completed
-                                display_text += f"✅ <b>Done!</b>\n\n{final_answer}"
-                            elif plan_text:
-                                # Task In Progress - Show Plan
-                                import html as _html
-                                display_text += "📋 <b>Plan:</b>\n"
-                                for line in plan_text.splitlines():
-                                    line = line.strip()
-                                    step = ""
-                                    if line.startswith("- [ ]"):
-                                        step = _html.escape(line[5:])
-                                        display_text += f"⬜ {step}\n"
-                                    elif line.startswith("- [/]"):
-                                        step = _html.escape(line[5:])
-                                        display_text += f"🔄 {step}\n"
-                                    elif line.startswith("- [x]"):
-                                        step = _html.escape(line[5:])
-                                        display_text += f"✅ <b>{step}</b>\n"
-                                    elif line.startswith("- [!]"):
-                                        step = _html.escape(line[5:])
-                                        display_text += f"❌ {step}\n"
-                            else:
-                                display_text += "⏳ <i>Initializing...</i>"
-
-                            # HASH CHECK to avoid spamming edits if nothing changed
-                            current_hash = hash(display_text)
-                            if str(current_hash) == str(last_hash):
-                                continue
-
-                            # SEND / EDIT
-                            builder = InlineKeyboardBuilder()
-                            # Check for Confirmation
-                            confirm_match = re.search(r'<confirm>(.*?)</confirm>', body, re.DOTALL)
-                            if confirm_match:
-                                display_text += f"\n\n❓ <b>Confirm:</b> {confirm_match.group(1)}" # Show pure text
-                                # We remove confirm tag from display to avoid double showing if formatting matches
-                                # But actually we want it shown.
-                                builder.button(text="✅ Yes", callback_data=f"conf_yes_{filename}")
-                                builder.button(text="❌ No", callback_data=f"conf_no_{filename}")
-                                builder.adjust(2)
-
-                            # Rate limit: skip if we edited this chat too recently
-                            chat_key = str(chat_id)
-                            now = _time.time()
-                            if chat_key in _last_edit and (now - _last_edit[chat_key]) < MIN_EDIT_INTERVAL:
-                                continue
-
-                            sent_msg = None
-                            try:
-                                if status_msg_id:
-                                    # EDIT
-                                    await bot.edit_message_text(
-                                        chat_id=chat_id,
-                                        message_id=status_msg_id,
-                                        text=display_text,
-                                        parse_mode="HTML",
-                                        reply_markup=builder.as_markup() if confirm_match else None
-                                    )
-                                    sent_msg = type('obj', (object,), {'message_id': status_msg_id})
-                                else:
-                                    # SEND NEW
-                                    sent_msg = await bot.send_message(
-                                        chat_id=chat_id,
-                                        text=display_text,
-                                        parse_mode="HTML",
-                                        reply_markup=builder.as_markup() if confirm_match else None
-                                    )
-                                
-                                _last_edit[chat_key] = _time.time()
-                                
-                                # UPDATE METADATA
-                                if sent_msg:
-                                    metadata['status_message_id'] = sent_msg.message_id
-                                    metadata['last_status_hash'] = str(current_hash)
-                                    
-                                    new_meta = yaml.dump(metadata, allow_unicode=True)
-                                    new_content = f"--- \n{new_meta}--- {body}"
-                                    
-                                    with open(filepath, 'w') as f: f.write(new_content)
-
-                            except TelegramRetryAfter as e:
-                                # Telegram told us exactly how long to wait
-                                wait = e.retry_after + 1
-                                print(f"Rate limited. Waiting {wait}s.", flush=True)
-                                _last_edit[chat_key] = _time.time() + wait
-                                await asyncio.sleep(wait)
-                            except TelegramBadRequest as e:
-                                if "message is not modified" in str(e):
-                                    # Content identical, update hash to avoid retrying
-                                    metadata['last_status_hash'] = str(current_hash)
-                                    new_meta = yaml.dump(metadata, allow_unicode=True)
-                                    new_content = f"--- \n{new_meta}--- {body}"
-                                    with open(filepath, 'w') as f: f.write(new_content)
-                                else:
-                                    print(f"Tg Error: {e}")
-                            except Exception as e:
-                                print(f"Notify Error details: {e}")
-
-                        except Exception as fe:
-                            pass # File read error
-                            
+            await renew_claims()
+            spool_due = await storage.run(notification_spool.next_due)
+            if spool_due == 0:
+                await send_notifications()
+                spool_due = await storage.run(notification_spool.next_due)
+            if _time.time() - last_reconcile >= RECONCILE_INTERVAL:
+                last_reconcile = _time.time()
+                for chat_key in [c for c, t in last_edit.items() if last_reconcile - t >= MIN_EDIT_INTERVAL]:
+                    del last_edit[chat_key]
+                for user_dir in await storage.run(glob.glob, os.path.join(USERS_ROOT, "user_*")):
+                    for filepath, archived in await storage.run(ledger.changed_files, user_dir):
+                        pending[filepath] = archived
+
+            for filepath, archived in list(pending.items()):
+                if await deliver(filepath, archived):
+                    del pending[filepath]
+                    changed_at.pop(filepath, None)
+            await storage.run(ledger.save)
         except Exception as e:
             print(f"Notify loop error: {e}")
-        
-        await asyncio.sleep(5)
+            metrics.inc("notify_errors_total")
+        metrics.observe("notify_iteration_seconds", _time.perf_counter() - iteration_started)
+
+        # Sleep until the next event, a pending retry, a due notification or the next reconciliation
+        timeout = 1 if pending else max(0.1, RECONCILE_INTERVAL - (_time.time() - last_reconcile))
+        timeout = min(timeout, SPOOL_POLL)
+        if spool_due is not None:
+            timeout = max(0.1, min(timeout, spool_due))
+        try:
+            event = await asyncio.wait_for(event_queue.get(), timeout=timeout)
+        except asyncio.TimeoutError:
+            continue
+        while True:
+            path = os.path.normpath(event.get("path") or "")
+            if event["type"] == events.DEFERRED:
+                await send_notifications()
+            elif path.startswith(USERS_ROOT + os.sep) and path.endswith(".md"):
+                pending[path] = os.path.basename(os.path.dirname(path)) == "archive"
+                changed_at.setdefault(path, event.get("ts") or _time.time())
+            if event_queue.empty(): break
+            event = event_queue.get_nowait()
@@ -0,0 +1,170 @@
+"""Bounded-memory capture of a subprocess's stdout and stderr.
+
+subprocess.communicate() holds everything a child prints. A Gemini step that
+dumps a large file or web page would then be copied through the history
+substitutions and every rewrite of the task file. Here each stream is read
+in chunks:
+- the first `cap` bytes are kept in memory;
+- past the cap, the whole stream is spilled to a side file, and text()
+  returns the excerpt with a note naming that file;
+- lines containing one of the `keep` markers (quota errors) are kept even
+  past the cap, so they are found without holding the whole stream.
+
+    stream = Streamer(proc, prompt.encode(), Capture(cap, spill_path), Capture(cap, ..., keep=(b"QuotaError",)))
+    while not stream.pump(0.5):
+        ...   # cancel / timeout checks between polls
+    stdout = stream.stdout.text()
+"""
+
+import os
+import selectors
+import subprocess
+
+CHUNK = 64 * 1024
+KEPT_LINE = 1024     # bytes kept around each `keep` marker
+MAX_KEPT = 5
+
+
+def prune(directory, keep):
+    """Keeps only the newest `keep` files in directory."""
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return
+    names.sort(key=lambda n: os.path.getmtime(os.path.join(directory, n)))
+    for name in names[:-keep]:
+        try:
+            os.remove(os.path.join(directory, name))
+        except OSError:
+            pass
+
+
+class Capture:
+    """One output stream: an in-memory head of `cap` bytes, the rest spilled to spill_path."""
+
+    def __init__(self, cap, spill_path=None, keep=()):
+        self.cap = cap
+        self.spill_path = spill_path
+        self.keep = keep
+        self.head = bytearray()
+        self.total = 0
+        self.kept = []
+        self._spill = None
+        self._tail = b""     # end of the previous chunk, for markers split across chunks
+        self._overlap = max((len(m) for m in keep), default=1) - 1
+
+    def feed(self, data):
+        self.total += len(data)
+        room = self.cap - len(self.head)
+        if room > 0:
+            self.head += data[:room]
+        if len(data) > room:
+            self._overflow(data if room <= 0 else data[room:], data)
+
+    def _overflow(self, rest, data):
+        if self._spill is None and self.spill_path:
+            try:
+                os.makedirs(os.path.dirname(self.spill_path), exist_ok=True)
+                self._spill = open(self.spill_path, 'wb')
+                self._spill.write(self.head)
+            except OSError as e:
+                print(f"  -> WARNING: cannot spill output to {self.spill_path}: {e}", flush=True)
+                self.spill_path = None
+        if self._spill is not None:
+            self._spill.write(rest)
+        if self.keep and len(self.kept) < MAX_KEPT:
+            window = self._tail + rest
+            for marker in self.keep:
+                at = window.find(marker)
+                if at >= 0:
+                    start = window.rfind(b"\n", 0, at) + 1
+                    end = window.find(b"\n", at)
+                    self.kept.append(bytes(window[start:end if end >= 0 else len(window)][:KEPT_LINE]))
+                    break
+        self._tail = bytes(data[len(data) - self._overlap:]) if self._overlap else b""
+
+    def close(self):
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+
+    @property
+    def truncated(self):
+        return self.total > self.cap
+
+    def text(self):
+        """The kept head (plus kept marker lines and a note where the rest went) as text."""
+        text = self.head.decode('utf-8', errors='replace')
+        if not self.truncated:
+            return text
+        for line in self.kept:
+            text += "\n" + line.decode('utf-8', errors='replace')
+        where = f"full output: {self.spill_path}" if self.spill_path else "the rest was discarded"
+        return text + f"\n\n[Output truncated: first {self.cap} of {self.total} bytes shown; {where}]"
+
+
+class Streamer:
+    """Feeds a Popen's stdin and drains its stdout/stderr (binary pipes) without holding more than the caps."""
+
+    def __init__(self, proc, input_bytes, stdout, stderr):
+        self.proc = proc
+        self.stdout = stdout
+        self.stderr = stderr
+        self.selector = selectors.DefaultSelector()
+        self._input = memoryview(input_bytes or b"")
+        if proc.stdin:
+            if self._input:
+                os.set_blocking(proc.stdin.fileno(), False)
+                self.selector.register(proc.stdin, selectors.EVENT_WRITE)
+            else:
+                proc.stdin.close()
+        self.selector.register(proc.stdout, selectors.EVENT_READ, stdout)
+        self.selector.register(proc.stderr, selectors.EVENT_READ, stderr)
+
+    def pump(self, timeout):
+        """Moves data for up to `timeout` seconds. True once both outputs hit EOF and the process exited."""
+        if self.selector.get_map():
+            for key, _ in self.selector.select(timeout):
+                if key.fileobj is self.proc.stdin:
+                    self._write()
+                    continue
+                data = os.read(key.fd, CHUNK)
+                if data:
+                    key.data.feed(data)
+                else:
+                    self.selector.unregister(key.fileobj)
+                    key.fileobj.close()
+            if self.selector.get_map():
+                return False
+        try:
+            self.proc.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            return False
+        self.close()
+        return True
+
+    def _write(self):
+        try:
+            written = os.write(self.proc.stdin.fileno(), self._input[:CHUNK])
+        except BlockingIOError:
+            return
+        except BrokenPipeError:
+            written = len(self._input)
+        self._input = self._input[written:]
+        if not self._input:
+            self.selector.unregister(self.proc.stdin)
+            self.proc.stdin.close()
+
+    def close(self):
+        """Closes the pipes and any spill files (also after killing the process). Idempotent."""
+        if self.selector.get_map() is None:
+            return
+        for key in list(self.selector.get_map().values()):
+            self.selector.unregister(key.fileobj)
+            try:
+                key.fileobj.close()
+            except OSError:
+                pass
+        self.selector.close()
+        self.stdout.close()
+        self.stderr.close()
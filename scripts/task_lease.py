@@ -0,0 +1,234 @@
+"""Lease-based task claiming, so several task runners can share /app/users.
+
+A runner claims a task file by creating LEASE_DIR/user_<id>/<task>.lease with
+O_EXCL before working on it. Around a user's tasks it also holds the user
+lease (LEASE_DIR/user_<id>/_user.lease): only one runner at a time works
+for a user, since tasks of the same user share the working tree, memories,
+.gemini/settings.json and MCP broker sessions. The lease names its owner and an expiry; a
+background thread renews every held lease each RENEW_INTERVAL. A lease past
+its expiry (runner crashed or was killed) can be taken over by any runner.
+
+Each runner also keeps a status file in RUNNERS_DIR (current task and
+heartbeat). It replaces the old single-slot current_task.json, so /status can
+show what every runner is doing.
+
+With RUNNER_SHARDING=1, users are spread over the live runners by rendezvous
+hashing, so each user's tasks keep landing on the same runner. When a runner's
+heartbeat goes stale it drops out and its users move to the others.
+"""
+
+import os
+import json
+import time
+import uuid
+import socket
+import hashlib
+import threading
+from datetime import datetime
+
+LEASE_DIR = "/app/data/leases"
+RUNNERS_DIR = "/app/data/runners"
+
+LEASE_TTL = 60           # seconds a lease stays valid without renewal
+RENEW_INTERVAL = 15
+RUNNER_ID = os.getenv("RUNNER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+SHARDING = os.getenv("RUNNER_SHARDING", "0") == "1"
+USER_LEASE = "_user"     # lease name for "a runner is working for this user"; task leases end in .md
+
+
+def _read_json(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_json(path, data):
+    tmp = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def running_tasks():
+    """Status of every live runner: [{runner, user_id, task, started_at, heartbeat}, ...]."""
+    if not os.path.isdir(RUNNERS_DIR):
+        return []
+    now = time.time()
+    runners = []
+    for name in sorted(os.listdir(RUNNERS_DIR)):
+        if not name.endswith(".json"):
+            continue
+        status = _read_json(os.path.join(RUNNERS_DIR, name))
+        if status and now - status.get("heartbeat", 0) < LEASE_TTL:
+            runners.append(status)
+    return runners
+
+
+class LeaseManager:
+    def __init__(self, runner_id=None):
+        self.runner_id = runner_id or RUNNER_ID
+        self.held = {}               # lease path -> token
+        self.status = {"runner": self.runner_id, "pid": os.getpid(), "user_id": None, "task": None, "started_at": None}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._live_runners = ([], 0.0)   # (ids, fetched_at)
+
+    def _lease_path(self, user_id, filename):
+        return os.path.join(LEASE_DIR, f"user_{user_id}", f"{filename}.lease")
+
+    def _status_path(self):
+        return os.path.join(RUNNERS_DIR, f"{self.runner_id}.json")
+
+    # --- Lifecycle ---
+
+    def start(self):
+        """Publishes the runner status and starts the renewal thread."""
+        os.makedirs(RUNNERS_DIR, exist_ok=True)
+        self._write_status()
+        threading.Thread(target=self._renew_loop, name="lease-renew", daemon=True).start()
+
+    def shutdown(self):
+        self._stop.set()
+        with self._lock:
+            paths = list(self.held)
+        for path in paths:
+            self._release_path(path)
+        try:
+            os.remove(self._status_path())
+        except OSError:
+            pass
+
+    # --- Claiming ---
+
+    def acquire(self, user_id, filename):
+        """True if this runner now holds the task; False if another live runner does."""
+        path = self._lease_path(user_id, filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        for _ in range(2):
+            token = uuid.uuid4().hex
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                if not self._break_if_expired(path):
+                    return False
+                continue
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self._lease(token), f)
+            with self._lock:
+                self.held[path] = token
+            return True
+        return False
+
+    def release(self, user_id, filename):
+        self._release_path(self._lease_path(user_id, filename))
+
+    def acquire_user(self, user_id):
+        """True if this runner may now work on the user's tasks (no other runner is)."""
+        return self.acquire(user_id, USER_LEASE)
+
+    def release_user(self, user_id):
+        self.release(user_id, USER_LEASE)
+
+    def _release_path(self, path):
+        with self._lock:
+            token = self.held.pop(path, None)
+        lease = _read_json(path)
+        if token and lease and lease.get("token") == token:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _lease(self, token):
+        now = time.time()
+        return {"runner": self.runner_id, "token": token, "acquired_at": now, "expires": now + LEASE_TTL}
+
+    def _break_if_expired(self, path):
+        """Removes an expired lease. True if the caller should retry creating its own."""
+        lease = _read_json(path)
+        if lease is not None:
+            expired = lease.get("expires", 0) < time.time()
+        else:
+            # Unreadable: being written right now, or left half-written by a crash
+            try:
+                expired = time.time() - os.stat(path).st_mtime > LEASE_TTL
+            except FileNotFoundError:
+                return True
+        if not expired:
+            return False
+
+        tomb = f"{path}.stale-{uuid.uuid4().hex[:8]}"
+        try:
+            os.rename(path, tomb)
+        except FileNotFoundError:
+            return True   # another runner broke it first
+        taken = _read_json(tomb)
+        if (taken or {}).get("token") != (lease or {}).get("token"):
+            # Lost a race: the file was already re-claimed by a live runner. Put it back.
+            try:
+                os.link(tomb, path)
+            except FileExistsError:
+                pass
+            os.remove(tomb)
+            return False
+        os.remove(tomb)
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] Took over expired lease {os.path.basename(path)} "
+              f"from {(lease or {}).get('runner', '?')}", flush=True)
+        return True
+
+    # --- Heartbeat ---
+
+    def _renew_loop(self):
+        while not self._stop.wait(RENEW_INTERVAL):
+            with self._lock:
+                held = dict(self.held)
+            for path, token in held.items():
+                lease = _read_json(path)
+                if not lease or lease.get("token") != token:
+                    print(f"WARNING: lease {os.path.basename(path)} was lost to another runner", flush=True)
+                    with self._lock:
+                        if self.held.get(path) == token:
+                            del self.held[path]
+                    continue
+                lease["expires"] = time.time() + LEASE_TTL
+                try:
+                    _write_json(path, lease)
+                except OSError as e:
+                    print(f"WARNING: could not renew lease {path}: {e}", flush=True)
+            try:
+                self._write_status()
+            except OSError as e:
+                print(f"WARNING: could not write runner status: {e}", flush=True)
+
+    def _write_status(self):
+        with self._lock:
+            status = dict(self.status, heartbeat=time.time())
+        _write_json(self._status_path(), status)
+
+    def set_current(self, user_id, filename):
+        with self._lock:
+            self.status.update(user_id=str(user_id), task=filename, started_at=datetime.now().isoformat())
+        self._write_status()
+
+    def clear_current(self):
+        with self._lock:
+            self.status.update(user_id=None, task=None, started_at=None)
+        self._write_status()
+
+    # --- Sharding ---
+
+    def owns(self, user_id):
+        """Rendezvous hashing over live runners; always True unless RUNNER_SHARDING=1."""
+        if not SHARDING:
+            return True
+        runners, fetched_at = self._live_runners
+        if time.monotonic() - fetched_at > RENEW_INTERVAL:
+            runners = sorted({r["runner"] for r in running_tasks()} | {self.runner_id})
+            self._live_runners = (runners, time.monotonic())
+
+        def score(runner):
+            return hashlib.md5(f"{runner}:{user_id}".encode()).hexdigest()
+
+        return max(runners, key=score) == self.runner_id
@@ -0,0 +1,212 @@
+"""The one parser for the task .md format, with a parse cache.
+
+    ---
+    <YAML metadata>
+    ---
+    # Request ... # Plan (- [ ] / [/] / [x] / [!] / [-] steps) ... # History
+    ## <step> results, --- USER INPUT / USER DECISION / RESULT / CANCELLED --- sections
+
+parse() splits off the frontmatter and loads it with the libyaml C loader when
+PyYAML was built with it. Everything derived from the body (request, plan
+steps, history entries, decisions, answer, confirmation state) is computed on
+first access, so callers that only need the metadata do not pay for it.
+
+load() caches parsed files in an LRU keyed on the path and validated against
+(mtime, size, inode); task_store writes replace the file, so the inode changes
+even when a rewrite keeps the size within one mtime tick. A writer that
+starts from a cached Task is still safe: task_store's compare-and-swap
+rejects an outdated version. Tasks from load() are shared between callers:
+treat them as read-only and copy `metadata` before changing it.
+"""
+
+import os
+import re
+import threading
+from collections import OrderedDict, namedtuple
+from functools import cached_property
+
+import yaml
+
+from utils import CANCELLED_MARKER
+
+try:
+    from yaml import CSafeLoader as _YamlLoader
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader
+
+CACHE_SIZE = int(os.getenv("TASK_PARSE_CACHE", "1024"))
+
+_REQUEST = re.compile(r'# Request\n(.*?)\n#', re.DOTALL)
+_PLAN = re.compile(r'# Plan\n(.*?)\n#', re.DOTALL)
+_HISTORY = re.compile(r'# History\n(.*)', re.DOTALL)
+_ANSWER = re.compile(r'<answer>(.*?)</answer>', re.DOTALL | re.IGNORECASE)
+_CONFIRM = re.compile(r'<confirm>(.*?)</confirm>', re.DOTALL)
+_STEP = re.compile(r'- \[([ /x!-])\]')
+# "## <step>" result headings and "--- USER INPUT ---" style section markers
+_ENTRY = re.compile(r'(?:## (.+)|--- ([A-Z][A-Z ]*?)(?: \(([^)\n]*)\))? ---)$', re.MULTILINE)
+
+DECISION_MARKER = "--- USER DECISION ---"
+
+# Step states by checkbox character
+STEP_STATES = {" ": "pending", "/": "running", "x": "done", "!": "failed", "-": "skipped"}
+
+Step = namedtuple("Step", "line state text")      # line: index into plan_text.splitlines()
+Entry = namedtuple("Entry", "kind title text")    # kind: "step" or the marker name ("USER INPUT", "RESULT", ...)
+
+
+def load_yaml(text):
+    return yaml.load(text, Loader=_YamlLoader)
+
+
+def split(content):
+    """(metadata, body) of a task file's text, or None if it has no frontmatter."""
+    parts = content.split('---', 2)
+    if len(parts) < 3:
+        return None
+    return load_yaml(parts[1]) or {}, parts[2]
+
+
+def _line_matches(text, pattern, prefixes):
+    """Matches of `pattern` at the start of lines beginning with one of `prefixes`, in order.
+
+    Locating candidate lines with str.find is several times faster than
+    letting a MULTILINE regex try every position of a long history.
+    """
+    matches = []
+    for prefix in prefixes:
+        pos = text.find(prefix)
+        while pos != -1:
+            match = pattern.match(text, pos + 1)
+            if match:
+                matches.append(match)
+            pos = text.find(prefix, pos + 1)
+    matches.sort(key=lambda m: m.start())
+    return matches
+
+
+class Task:
+    def __init__(self, metadata, body):
+        self.metadata = metadata
+        self.body = body
+
+    @property
+    def version(self):
+        return int(self.metadata.get("version") or 0)
+
+    @property
+    def status(self):
+        return self.metadata.get("status", "")
+
+    @cached_property
+    def request(self):
+        match = _REQUEST.search(self.body)
+        return match.group(1).strip() if match else ""
+
+    @cached_property
+    def plan_text(self):
+        match = _PLAN.search(self.body)
+        return match.group(1).strip() if match else ""
+
+    @cached_property
+    def plan(self):
+        """[Step] for every checkbox line of # Plan."""
+        steps = []
+        for i, line in enumerate(self.plan_text.splitlines()):
+            match = _STEP.match(line.strip())
+            if match:
+                steps.append(Step(i, STEP_STATES[match.group(1)], line.strip()[5:].strip()))
+        return steps
+
+    @property
+    def next_step(self):
+        """The first pending or interrupted (running) step, or None when the plan is done."""
+        return next((s for s in self.plan if s.state in ("pending", "running")), None)
+
+    @cached_property
+    def history_text(self):
+        match = _HISTORY.search(self.body)
+        return match.group(1).strip() if match else ""
+
+    @cached_property
+    def history(self):
+        """[Entry] for every step result and marked section after # History."""
+        text = "\n" + self.history_text
+        # Step results may contain their own "## " headings; only plan steps start an entry
+        titles = {step.text for step in self.plan}
+        marks = [m for m in _line_matches(text, _ENTRY, ("\n## ", "\n--- "))
+                 if m.group(1) is None or m.group(1).strip() in titles]
+        entries = []
+        for n, mark in enumerate(marks):
+            end = marks[n + 1].start() if n + 1 < len(marks) else len(text)
+            content = text[mark.end():end].strip()
+            if mark.group(1) is not None:
+                entries.append(Entry("step", mark.group(1).strip(), content))
+            else:
+                entries.append(Entry(mark.group(2), mark.group(3) or "", content))
+        return entries
+
+    @cached_property
+    def decisions(self):
+        """The user's answers to confirmations, oldest first."""
+        return [entry.text for entry in self.history if entry.kind == "USER DECISION"]
+
+    @cached_property
+    def answer(self):
+        match = _ANSWER.search(self.body)
+        return match.group(1).strip() if match else None
+
+    @property
+    def has_answer(self):
+        return "<answer>" in self.body
+
+    @cached_property
+    def confirm(self):
+        """Text of the first <confirm> question, or None."""
+        match = _CONFIRM.search(self.body)
+        return match.group(1) if match else None
+
+    @cached_property
+    def awaiting_confirmation(self):
+        """True if the last <confirm> has no USER DECISION after it yet."""
+        return "<confirm>" in self.body and DECISION_MARKER not in self.body.rsplit("<confirm>", 1)[-1]
+
+    @property
+    def cancelled(self):
+        return CANCELLED_MARKER in self.body
+
+
+def parse(content):
+    """Task for the text of a task file, or None if it has no frontmatter."""
+    parsed = split(content)
+    return Task(*parsed) if parsed else None
+
+
+_cache = OrderedDict()     # path -> ((mtime_ns, size, ino), Task or None)
+_cache_lock = threading.Lock()
+cache_stats = {"hits": 0, "misses": 0}
+
+
+def load(path):
+    """Parsed task file (cached), or None without frontmatter. Raises FileNotFoundError."""
+    with open(path, 'r') as f:
+        st = os.fstat(f.fileno())
+        stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+        with _cache_lock:
+            cached = _cache.get(path)
+            if cached and cached[0] == stamp:
+                _cache.move_to_end(path)
+                cache_stats["hits"] += 1
+                return cached[1]
+        task = parse(f.read())
+    with _cache_lock:
+        cache_stats["misses"] += 1
+        _cache[path] = (stamp, task)
+        _cache.move_to_end(path)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return task
+
+
+def clear_cache():
+    with _cache_lock:
+        _cache.clear()
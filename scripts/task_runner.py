@@ -1,18 +1,53 @@
 import os
 import sys
 import re
-import yaml
 import json
 import subprocess
+import signal
+import fcntl
+import atexit
 import time
 import glob
+import functools
 from datetime import datetime, timedelta
-from utils import strip_ansi
+from utils import strip_ansi, CANCELLED_MARKER
+import events
+import runner_wakeup
+import notification_spool
+import burst
+import task_lease
+import task_store
+import task_parser
+import mcp_broker
+import metrics
+import tracing
+import profiling
+import gemini_recorder
+import usage
+import stream_capture
 
 USERS_ROOT = "/app/users"
 CORE_INSTRUCTIONS_DIR = "/app/core_instructions"
-CURRENT_TASK_FILE = "/app/data/current_task.json"
-GEMINI_BIN = "gemini"
+GEMINI_BIN = os.getenv("GEMINI_BIN", "gemini")     # bench/fake_gemini.py for offline benchmarks
+GEMINI_TIMEOUT = int(os.getenv("GEMINI_TIMEOUT", "300"))
+GIT_MANAGER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "git_manager.py")
+CANCEL_POLL = 0.5           # seconds between cancel checks while Gemini runs
+CANCEL_FILE_CHECK = 5       # re-read the task's status on disk this often (socket may drop)
+KILL_GRACE = 3              # SIGTERM -> SIGKILL delay for the Gemini process group
+OUTPUT_DIR = "/app/data/gemini_output"      # full Gemini output past the cap, per user
+OUTPUT_CAP = int(os.getenv("GEMINI_OUTPUT_CAP", str(256 * 1024)))  # stdout bytes kept (and written to history)
+STDERR_CAP = 64 * 1024
+OUTPUT_KEEP_FILES = 50      # spilled output files kept per user
+QUOTA_MARKERS = ("QuotaError", "exhausted your capacity", "reset after")
+
+# (user_id, filename) and trace id of the task being processed, and the wake-up inbox (set in __main__)
+current_task = None
+current_trace = None
+inbox = None
+leases = task_lease.LeaseManager()
+
+class TaskCancelled(Exception):
+    pass
 
 class QuotaExhaustedError(Exception):
     def __init__(self, wait_seconds, message=""):
@@ -20,13 +55,17 @@ class QuotaExhaustedError(Exception):
         self.message = message
         super().__init__(f"Quota exhausted. Retry after {wait_seconds}s: {message}")
 
-def set_current_task(filename, user_id):
-    with open(CURRENT_TASK_FILE, 'w') as f:
-        json.dump({"task": filename, "user_id": user_id, "started_at": datetime.now().isoformat()}, f)
+def set_current_task(filename, user_id, trace_id=None):
+    global current_task, current_trace
+    current_task = (str(user_id), filename)
+    current_trace = trace_id
+    leases.set_current(user_id, filename)
 
 def clear_current_task():
-    if os.path.exists(CURRENT_TASK_FILE):
-        os.remove(CURRENT_TASK_FILE)
+    global current_task, current_trace
+    current_task = None
+    current_trace = None
+    leases.clear_current()
 
 def get_context(user_dir):
     ctx = ""
@@ -64,10 +103,13 @@ def get_context(user_dir):
 GEMINI_MCP_ALLOWED_KEYS = {"command", "args", "env", "cwd", "timeout", "url", "headers"}
 
 def sanitize_gemini_config(user_dir):
-    """Remove unrecognized keys from mcpServers entries that cause Gemini CLI to reject the config."""
+    """
+    Remove unrecognized keys from mcpServers entries that cause Gemini CLI to reject the config.
+    Returns the mcp_broker system settings path that points the stdio servers at the broker, or None.
+    """
     settings_path = os.path.join(user_dir, ".gemini", "settings.json")
     if not os.path.exists(settings_path):
-        return
+        return None
     
     try:
         with open(settings_path, 'r') as f:
@@ -80,7 +122,7 @@ def sanitize_gemini_config(user_dir):
                 with open(settings_path, 'w') as f:
                     json.dump(settings, f, indent=2)
                 print(f"  -> Fixed mcpServers: was list, reset to dict.", flush=True)
-            return
+            return None
         
         changed = False
         for name, server_config in list(mcp.items()):
@@ -131,26 +173,128 @@ def sanitize_gemini_config(user_dir):
                 json.dump(settings, f, indent=2)
     except Exception as e:
         print(f"  -> WARNING: Could not sanitize config: {e}", flush=True)
+        return None
+
+    user_id = os.path.basename(os.path.normpath(user_dir))[len("user_"):]
+    try:
+        return mcp_broker.effective_settings(user_id, settings)
+    except Exception as e:
+        print(f"  -> WARNING: MCP broker settings failed, Gemini starts the servers itself: {e}", flush=True)
+        return None
 
 MODELS = [
     "gemini-2.5-pro",
     "gemini-2.5-flash",
 ]
 
-def _call_gemini(prompt, user_dir, model, yolo=True, timeout=120):
+def _call_gemini(prompt, user_dir, model, yolo=True, timeout=120, system_settings=None):
     """Low-level Gemini CLI call. Returns (stdout, stderr, returncode) or raises TimeoutExpired."""
+    if not gemini_recorder.enabled():
+        return _run_gemini_cli(prompt, user_dir, model, yolo, timeout, system_settings)
+    # Record mode (see gemini_recorder.py)
+    started = time.monotonic()
+    record = functools.partial(gemini_recorder.record, user_dir, current_task and current_task[1],
+                               CORE_INSTRUCTIONS_DIR, model, prompt)
+    try:
+        stdout, stderr, rc = _run_gemini_cli(prompt, user_dir, model, yolo, timeout, system_settings)
+    except subprocess.TimeoutExpired:
+        record("", "", None, "timeout", time.monotonic() - started)
+        raise
+    except TaskCancelled:
+        record("", "", None, "cancelled", time.monotonic() - started)
+        raise
+    record(stdout, stderr, rc, "ok", time.monotonic() - started)
+    return stdout, stderr, rc
+
+def _run_gemini_cli(prompt, user_dir, model, yolo, timeout, system_settings):
     args = [GEMINI_BIN, "--model", model]
     if yolo: args.append("-y")
     
     env = os.environ.copy()
     env['HOME'] = user_dir
+    if system_settings:
+        # Overrides the user's stdio mcpServers with the broker's warm ones
+        env['GEMINI_CLI_SYSTEM_SETTINGS_PATH'] = system_settings
     
-    result = subprocess.run(args, input=prompt, capture_output=True, text=True, timeout=timeout, env=env)
-    return result.stdout.strip(), result.stderr.strip(), result.returncode
+    # Own session, so cancel/timeout can kill gemini together with its MCP server children
+    proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            env=env, start_new_session=True)
+    user_id = os.path.basename(os.path.normpath(user_dir))[len("user_"):]
+    # Per-user CPU, peak RSS and wall time (see usage.py)
+    meter = usage.Meter(user_id, "gemini").start(proc.pid)
+    # Output is read in chunks and capped; the excess goes to a side file (see stream_capture.py)
+    stream = stream_capture.Streamer(
+        proc, prompt.encode(),
+        stream_capture.Capture(OUTPUT_CAP, _spill_path(user_id, "stdout")),
+        stream_capture.Capture(STDERR_CAP, _spill_path(user_id, "stderr"),
+                               keep=tuple(m.encode() for m in QUOTA_MARKERS)))
+    deadline = time.monotonic() + timeout
+    checker = CancelChecker(user_dir)
+    try:
+        while not stream.pump(CANCEL_POLL):
+            meter.sample()
+            if checker.cancelled():
+                _kill_group(proc)
+                raise TaskCancelled()
+            if time.monotonic() > deadline:
+                _kill_group(proc)
+                raise subprocess.TimeoutExpired(args, timeout)
+        if stream.stdout.truncated or stream.stderr.truncated:
+            metrics.inc("gemini_output_truncated_total")
+            print(f"  -> Output capped: stdout {stream.stdout.total} bytes, stderr {stream.stderr.total} bytes", flush=True)
+            stream_capture.prune(os.path.join(OUTPUT_DIR, f"user_{user_id}"), OUTPUT_KEEP_FILES)
+        return stream.stdout.text().strip(), stream.stderr.text().strip(), proc.returncode
+    finally:
+        stream.close()
+        meter.finish()
+
+def _spill_path(user_id, name):
+    task = os.path.splitext(current_task[1])[0] if current_task else "call"
+    return os.path.join(OUTPUT_DIR, f"user_{user_id}", f"{task}_{datetime.now():%Y%m%d_%H%M%S_%f}_{name}.txt")
+
+def _kill_group(proc):
+    for sig, grace in ((signal.SIGTERM, KILL_GRACE), (signal.SIGKILL, 5)):
+        try:
+            os.killpg(proc.pid, sig)
+        except ProcessLookupError:
+            pass
+        try:
+            proc.wait(timeout=grace)
+            break
+        except subprocess.TimeoutExpired:
+            continue
+    for pipe in (proc.stdin, proc.stdout, proc.stderr):
+        try: pipe.close()
+        except Exception: pass
+
+class CancelChecker:
+    """Answers "was the current task cancelled?" from the wake-up socket, or the file every few seconds."""
+
+    def __init__(self, user_dir):
+        self.task = current_task
+        self.path = os.path.join(user_dir, "tasks", current_task[1]) if current_task else None
+        self.checked_at = time.monotonic()
+
+    def cancelled(self):
+        if self.task is None:
+            return False
+        if inbox is not None and self.task in inbox.poll_cancels():
+            return True
+        if time.monotonic() - self.checked_at >= CANCEL_FILE_CHECK:
+            self.checked_at = time.monotonic()
+            return task_status_on_disk(self.path) == 'cancelled'
+        return False
+
+def task_status_on_disk(filepath):
+    try:
+        doc = task_parser.load(filepath)
+        return doc.status if doc else None
+    except Exception:
+        return None
 
 def _parse_quota_error(stderr):
     """Check stderr for quota exhaustion. Returns wait_seconds or None."""
-    if "QuotaError" in stderr or "exhausted your capacity" in stderr:
+    if any(marker in stderr for marker in QUOTA_MARKERS[:2]):
         wait_match = re.search(r'reset after\s+((?:(\d+)h)?(?:(\d+)m)?(?:(\d+)s)?)', stderr)
         wait_secs = 600  # default 10 min
         if wait_match:
@@ -161,9 +305,9 @@ def _parse_quota_error(stderr):
         return wait_secs
     return None
 
-def run_gemini(prompt, user_dir, yolo=True, timeout=300):
+def run_gemini(prompt, user_dir, yolo=True, timeout=GEMINI_TIMEOUT):
     # Self-heal config before each call
-    sanitize_gemini_config(user_dir)
+    system_settings = sanitize_gemini_config(user_dir)
     
     min_wait = None
     
@@ -171,9 +315,19 @@ def run_gemini(prompt, user_dir, yolo=True, timeout=300):
         for i, model in enumerate(MODELS):
             print(f"  -> Trying model: {model}", flush=True)
             
+            started, started_at = time.monotonic(), time.time()
+            def observe(outcome):
+                metrics.observe("gemini_call_seconds", time.monotonic() - started, model=model, outcome=outcome)
+                metrics.inc_recent("gemini_calls_last_hour", model=model, outcome=outcome)
+                tracing.record(current_trace, "gemini", started_at, time.time(), model=model, outcome=outcome,
+                               prompt_bytes=len(prompt.encode()))
             try:
-                stdout, stderr, rc = _call_gemini(prompt, user_dir, model, yolo, timeout)
+                stdout, stderr, rc = _call_gemini(prompt, user_dir, model, yolo, timeout, system_settings)
+            except TaskCancelled:
+                observe("cancelled")
+                raise
             except subprocess.TimeoutExpired:
+                observe("timeout")
                 print(f"  -> TIMEOUT on {model} after {timeout}s. Trying next...", flush=True)
                 if i < len(MODELS) - 1:
                     continue
@@ -188,7 +342,9 @@ def run_gemini(prompt, user_dir, yolo=True, timeout=300):
             
             # Check for quota exhaustion
             quota_wait = _parse_quota_error(stderr)
+            observe("quota" if quota_wait is not None else "error" if rc != 0 else "empty" if not stdout else "ok")
             if quota_wait is not None:
+                metrics.set_gauge("gemini_quota_reset_timestamp", time.time() + quota_wait, model=model)
                 min_wait = min(min_wait, quota_wait) if min_wait else quota_wait
                 if i < len(MODELS) - 1:
                     print(f"  -> Quota exhausted on {model}. Trying next...", flush=True)
@@ -206,7 +362,7 @@ def run_gemini(prompt, user_dir, yolo=True, timeout=300):
             return stdout
         
         return ""  # Should not reach here
-    except QuotaExhaustedError:
+    except (QuotaExhaustedError, TaskCancelled):
         raise
     except Exception as e:
         print(f"  -> Gemini subprocess error: {e}", flush=True)
@@ -223,19 +379,11 @@ def load_parent_context(user_dir, parent_task_id):
     
     for path in paths:
         if os.path.exists(path):
-            with open(path, 'r') as f: content = f.read()
-            # Try to extract <answer> (Final Result) or full history
             # For context, we probably want the User Request + Final Answer
-            
-            parts = content.split('---')
-            if len(parts) >= 3:
-                body = parts[2]
-                req_match = re.search(r'# Request\n(.*?)\n#', body, re.DOTALL)
-                req_text = req_match.group(1).strip() if req_match else "Unknown Request"
-                
-                ans_match = re.search(r'<answer>(.*?)</answer>', body, re.DOTALL | re.IGNORECASE)
-                ans_text = ans_match.group(1).strip() if ans_match else "No Answer"
-                
+            task = task_parser.load(path)
+            if task:
+                req_text = task.request or "Unknown Request"
+                ans_text = task.answer or "No Answer"
                 return f"\n\n--- PREVIOUS CONVERSATION ---\nUser: {req_text}\nAssistant: {ans_text}\n----------------------------\n"
             return ""
             
@@ -245,254 +393,397 @@ def maintenance_and_memory(user_dir, task_content, task_result):
     # Simplified for now - can be expanded later
     pass
 
-def process_tasks():
-    user_dirs = glob.glob(os.path.join(USERS_ROOT, "user_*"))
+def process_task(user_dir, user_id, filename, user_ctx):
+    """Advances one task file by a single state-machine step."""
+    tasks_dir = os.path.join(user_dir, "tasks")
+    archive_dir = os.path.join(tasks_dir, "archive")
+    filepath = os.path.join(tasks_dir, filename)
+    stage = None  # timed into task_stage_seconds and the task's trace once the task is worked on
+    span = {}     # attributes of the stage's trace span
     
-    for user_dir in user_dirs:
-        user_id = os.path.basename(user_dir).replace("user_", "")
-        tasks_dir = os.path.join(user_dir, "tasks")
-        archive_dir = os.path.join(tasks_dir, "archive")
+    try:
+        # Parsed once per change of the file (cached), so rescanning blocked tasks is cheap
+        doc = task_parser.load(filepath)
+        if doc is None: return
         
-        if not os.path.exists(tasks_dir): continue
-
-        files = [f for f in os.listdir(tasks_dir) if f.endswith(".md") and os.path.isfile(os.path.join(tasks_dir, f))]
-        files.sort() 
+        metadata = dict(doc.metadata)
         
-        if not files: continue
+        # Cancelled by the user while queued or waiting
+        if metadata.get('status') == 'cancelled' or (inbox and (str(user_id), filename) in inbox.poll_cancels()):
+            finish_cancelled(user_dir, user_id, filename)
+            return
 
-        user_ctx = get_context(user_dir)
+        # CHECK BLOCKED STATUS
+        # 1. Explicit <confirm> tag without user decision
+        if doc.awaiting_confirmation:
+            print(f"[{datetime.now().strftime('%H:%M:%S')}] Skipping {filename} (waiting for confirmation)", flush=True)
+            return
+        # 2. Task explicitly marked as needing user input
+        task_status = metadata.get('status', '')
+        if task_status in ('needs_user_input', 'blocked', 'deferred_quota', 'deferred_usage'):
+            print(f"[{datetime.now().strftime('%H:%M:%S')}] Skipping {filename} (status: {task_status})", flush=True)
+            return
+        # 3. Still collecting a burst of messages (see burst.py)
+        if burst.is_held(metadata):
+            return
 
-        for filename in files:
-            filepath = os.path.join(tasks_dir, filename)
-            
+        trace_id = metadata.get('trace_id')
+        set_current_task(filename, user_id, trace_id)
+        started, started_at = time.monotonic(), time.time()
+        print(f"[{datetime.now().strftime('%H:%M:%S')}] Processing {filename}...", flush=True)
+
+        body = doc.body
+        
+        # 1. SECTIONS
+        request_text = doc.request
+        plan_text = doc.plan_text
+        history_text = doc.history_text
+
+        # 2. STATE MACHINE
+        
+        # STEP A: GENERATE PLAN
+        if not plan_text:
+            stage = "plan"
+            print(f"  -> State: PLAN_NEEDED", flush=True)
             try:
-                with open(filepath, 'r') as f: content = f.read()
-                
-                # Split ONLY on the first two '---' (YAML frontmatter delimiters)
-                parts = content.split('---', 2)
-                if len(parts) < 3: continue
-                
-                metadata = yaml.safe_load(parts[1]) or {}
+                created = datetime.fromisoformat(str(metadata.get('created_at'))).timestamp()
+                tracing.record(trace_id, "queued", created, started_at, task=filename)
+            except ValueError:
+                pass
+            parent_ctx = load_parent_context(user_dir, metadata.get('parent_task_id'))
+            
+            prompt = (
+                f"{user_ctx}\n{parent_ctx}\n"
+                f"USER REQUEST: {request_text}\n\n"
+                "INSTRUCTION: Create a checklist plan to solve the user's request. "
+                "Break it down into atomic steps (search, analyze, execute). "
+                "Output ONLY the markdown list, e.g.:\n- [ ] Step 1\n- [ ] Step 2\n"
+            )
+            
+            plan = run_gemini(prompt, user_dir)
+            if plan:
+                if "# Plan" in body:
+                    new_body = re.sub(r'# Plan\s*\n', lambda m: f'# Plan\n{plan}\n\n', body, count=1)
+                else:
+                    new_body = "\n" + body.strip() + f"\n\n# Plan\n{plan}\n\n# History\n"
                 
-                # CHECK BLOCKED STATUS
-                # 1. Explicit <confirm> tag without user decision
-                if "<confirm>" in content and "--- USER DECISION ---" not in content.split("<confirm>")[-1]:
-                    print(f"[{datetime.now().strftime('%H:%M:%S')}] Skipping {filename} (waiting for confirmation)", flush=True)
-                    continue
-                # 2. Task explicitly marked as needing user input
-                task_status = metadata.get('status', '')
-                if task_status in ('needs_user_input', 'blocked', 'deferred_quota'):
-                    print(f"[{datetime.now().strftime('%H:%M:%S')}] Skipping {filename} (status: {task_status})", flush=True)
-                    continue
+                task_store.save(filepath, doc, metadata, new_body)
+                events.publish(events.PLAN_CREATED, user_id, filepath)
+                span["steps"] = sum(1 for line in plan.splitlines() if line.lstrip().startswith("- ["))
+                print(f"  -> Plan saved.", flush=True)
+            else:
+                span["outcome"] = "empty"
+                print(f"  -> WARNING: Gemini returned empty plan.", flush=True)
+            return
 
-                set_current_task(filename, user_id)
-                print(f"[{datetime.now().strftime('%H:%M:%S')}] Processing {filename}...", flush=True)
+        # STEP B: EXECUTE NEXT ITEM
+        lines = plan_text.splitlines()
+        next_step = doc.next_step
+        
+        if next_step:
+            stage = "step"
+            next_step_idx, next_step_text = next_step.line, next_step.text
+            span["step"] = next_step_idx + 1
+            if next_step.state == "running":
+                lines[next_step_idx] = lines[next_step_idx].replace("- [/]", "- [ ]")
+                print(f"  -> Recovering stuck [/] step: {next_step_text}", flush=True)
 
-                body = parts[2]
-                
-                # 1. PARSE SECTIONS
-                req_match = re.search(r'# Request\n(.*?)\n#', body, re.DOTALL)
-                request_text = req_match.group(1).strip() if req_match else ""
-                
-                plan_match = re.search(r'# Plan\n(.*?)\n#', body, re.DOTALL)
-                plan_text = plan_match.group(1).strip() if plan_match else ""
-                
-                history_match = re.search(r'# History\n(.*)', body, re.DOTALL)
-                history_text = history_match.group(1).strip() if history_match else ""
+            print(f"  -> State: EXECUTING step {next_step_idx+1}: {next_step_text}", flush=True)
+            
+            # Mark as In Progress [/]
+            lines[next_step_idx] = lines[next_step_idx].replace("- [ ]", "- [/]")
+            new_plan_text = "\n".join(lines)
+            
+            # Update File (Tick)
+            body = re.sub(r'# Plan\n(.*?)\n#', lambda m: f'# Plan\n{new_plan_text}\n#', body, flags=re.DOTALL)
+            ticked = task_store.save(filepath, doc, metadata, body)
+            metadata = ticked.metadata
+            events.publish(events.STEP_STARTED, user_id, filepath, step=next_step_idx + 1)
+            
+            # Execute
+            decision_ctx = ""
+            if doc.decisions:
+                 decision_ctx = f"\nUSER DECISION ON PREVIOUS CONFIRMATION: {doc.decisions[-1]}\n"
 
-                # 2. STATE MACHINE
-                
-                # STEP A: GENERATE PLAN
-                if not plan_text:
-                    print(f"  -> State: PLAN_NEEDED", flush=True)
-                    parent_ctx = load_parent_context(user_dir, metadata.get('parent_task_id'))
-                    
-                    prompt = (
-                        f"{user_ctx}\n{parent_ctx}\n"
-                        f"USER REQUEST: {request_text}\n\n"
-                        "INSTRUCTION: Create a checklist plan to solve the user's request. "
-                        "Break it down into atomic steps (search, analyze, execute). "
-                        "Output ONLY the markdown list, e.g.:\n- [ ] Step 1\n- [ ] Step 2\n"
-                    )
-                    
-                    plan = run_gemini(prompt, user_dir)
-                    if plan:
-                        if "# Plan" in body:
-                            new_body = re.sub(r'# Plan\s*\n', f'# Plan\n{plan}\n\n', body, count=1)
-                        else:
-                            new_body = body.strip() + f"\n\n# Plan\n{plan}\n\n# History\n"
-                        
-                        with open(filepath, 'w') as f:
-                            f.write(f"--- \n{yaml.dump(metadata, allow_unicode=True)}--- \n{new_body}")
-                        print(f"  -> Plan saved.", flush=True)
-                    else:
-                        print(f"  -> WARNING: Gemini returned empty plan.", flush=True)
-                    continue
+            prompt = (
+                f"{user_ctx}\n"
+                f"OBJECTIVE: {request_text}\n"
+                f"CURRENT PLAN:\n{new_plan_text}\n"
+                f"CURRENT STEP: {next_step_text}\n"
+                f"HISTORY SO FAR:\n{history_text}\n"
+                f"{decision_ctx}\n"
+                "INSTRUCTION: Execute this step. Output PLAIN TEXT or TOOL CALLS. "
+                "Do NOT use <thought> or <answer> tags."
+            )
+            
+            result = run_gemini(prompt, user_dir)
+            
+            if result:
+                # Mark as Done [x]
+                lines[next_step_idx] = lines[next_step_idx].replace("- [/]", "- [x]")
+                print(f"  -> Step done.", flush=True)
+            else:
+                # Gemini failed — mark as failed [!] so we don't loop forever
+                lines[next_step_idx] = lines[next_step_idx].replace("- [/]", "- [!]")
+                result = "(Gemini returned empty — step skipped)"
+                span["outcome"] = "failed"
+                print(f"  -> Step FAILED (empty result).", flush=True)
+            
+            final_plan_text = "\n".join(lines)
+            new_history = f"{history_text}\n\n## {next_step_text}\n{result}\n"
+            
+            # Function replacements: Gemini output may contain backslashes
+            body = re.sub(r'# Plan\n(.*?)\n#', lambda m: f'# Plan\n{final_plan_text}\n#', body, flags=re.DOTALL)
+            body = re.sub(r'# History\n(.*)', lambda m: f'# History\n{new_history}', body, flags=re.DOTALL)
+            
+            # Text the user appended while Gemini ran is merged in, not overwritten
+            task_store.save(filepath, ticked, metadata, body)
+            events.publish(events.STEP_DONE, user_id, filepath, step=next_step_idx + 1, ok="- [x]" in lines[next_step_idx])
+            return 
 
-                # STEP B: EXECUTE NEXT ITEM
-                lines = plan_text.splitlines()
-                next_step_idx = -1
-                next_step_text = ""
-                
-                for i, line in enumerate(lines):
-                    stripped = line.strip()
-                    if stripped.startswith("- [ ]"):
-                        next_step_idx = i
-                        next_step_text = stripped[5:].strip()
-                        break
-                    elif stripped.startswith("- [/]"):
-                        next_step_idx = i
-                        next_step_text = stripped[5:].strip()
-                        lines[i] = line.replace("- [/]", "- [ ]")
-                        print(f"  -> Recovering stuck [/] step: {next_step_text}", flush=True)
-                        break
-                
-                if next_step_idx != -1:
-                    print(f"  -> State: EXECUTING step {next_step_idx+1}: {next_step_text}", flush=True)
-                    
-                    # Mark as In Progress [/]
-                    lines[next_step_idx] = lines[next_step_idx].replace("- [ ]", "- [/]")
-                    new_plan_text = "\n".join(lines)
-                    
-                    # Update File (Tick)
-                    body = re.sub(r'# Plan\n(.*?)\n#', f'# Plan\n{new_plan_text}\n#', body, flags=re.DOTALL)
-                    with open(filepath, 'w') as f:
-                        f.write(f"--- \n{yaml.dump(metadata, allow_unicode=True)}--- {body}")
-                    
-                    # Execute
-                    decision_ctx = ""
-                    if "--- USER DECISION ---" in history_text:
-                         last_decision = history_text.split("--- USER DECISION ---")[-1].strip()
-                         decision_ctx = f"\nUSER DECISION ON PREVIOUS CONFIRMATION: {last_decision}\n"
-
-                    prompt = (
-                        f"{user_ctx}\n"
-                        f"OBJECTIVE: {request_text}\n"
-                        f"CURRENT PLAN:\n{new_plan_text}\n"
-                        f"CURRENT STEP: {next_step_text}\n"
-                        f"HISTORY SO FAR:\n{history_text}\n"
-                        f"{decision_ctx}\n"
-                        "INSTRUCTION: Execute this step. Output PLAIN TEXT or TOOL CALLS. "
-                        "Do NOT use <thought> or <answer> tags."
-                    )
-                    
-                    result = run_gemini(prompt, user_dir)
-                    
-                    if result:
-                        # Mark as Done [x]
-                        lines[next_step_idx] = lines[next_step_idx].replace("- [/]", "- [x]")
-                        print(f"  -> Step done.", flush=True)
-                    else:
-                        # Gemini failed — mark as failed [!] so we don't loop forever
-                        lines[next_step_idx] = lines[next_step_idx].replace("- [/]", "- [!]")
-                        result = "(Gemini returned empty — step skipped)"
-                        print(f"  -> Step FAILED (empty result).", flush=True)
-                    
-                    final_plan_text = "\n".join(lines)
-                    new_history = f"{history_text}\n\n## {next_step_text}\n{result}\n"
-                    
-                    body = re.sub(r'# Plan\n(.*?)\n#', f'# Plan\n{final_plan_text}\n#', body, flags=re.DOTALL)
-                    body = re.sub(r'# History\n(.*)', f'# History\n{new_history}', body, flags=re.DOTALL)
-                    
-                    with open(filepath, 'w') as f:
-                        f.write(f"--- \n{yaml.dump(metadata, allow_unicode=True)}--- {body}")
-                    continue 
-
-                # STEP C: FINALIZE (No unchecked/in-progress items remain)
-                has_answer = "<answer>" in content
-                
-                if not has_answer:
-                    print(f"  -> State: FINALIZING (all steps done, generating answer)...", flush=True)
-                    prompt = (
-                        f"{user_ctx}\n"
-                        f"OBJECTIVE: {request_text}\n"
-                        f"The plan is complete.\n"
-                        f"HISTORY:\n{history_text}\n"
-                        "INSTRUCTION: Provide the FINAL ANSWER to the user. "
-                        "Use <thought> for reasoning and <answer> for the message. "
-                        "Use HTML formatting."
-                    )
-                    
-                    result = run_gemini(prompt, user_dir)
-                    
-                    # If Gemini didn't include <answer> tags, wrap the whole result
-                    if result and "<answer>" not in result:
-                        print(f"  -> WARNING: Gemini didn't use <answer> tags, wrapping.", flush=True)
-                        result = f"<thought>Plan complete.</thought><answer>{result}</answer>"
-                    
-                    with open(filepath, 'a') as f:
-                        f.write(f"\n\n--- RESULT ({datetime.now().strftime('%H:%M')}) ---\n{result}\n")
-                else:
-                    print(f"  -> State: ALREADY FINISHED (has <answer>).", flush=True)
-                
-                # Archive unconditionally
-                print(f"  -> Archiving {filename}...", flush=True)
-                if not os.path.exists(archive_dir): os.makedirs(archive_dir)
-                os.rename(filepath, os.path.join(archive_dir, filename))
-                
-                # Maintenance (Auto Commit)
-                subprocess.run([sys.executable, "/app/scripts/git_manager.py", "commit", user_id, f"Task {filename} completed"], check=False)
-                print(f"  -> DONE.", flush=True)
-
-            except QuotaExhaustedError as qe:
-                # Per-user deferral: move task to recurrent/ with run_after
-                print(f"  -> QUOTA EXHAUSTED for user {user_id}. Deferring task for {qe.wait_seconds}s.", flush=True)
-                try:
-                    # Revert any in-progress [/] steps back to [ ]
-                    with open(filepath, 'r') as f:
-                        current_content = f.read()
-                    current_content = current_content.replace("- [/]", "- [ ]")
-                    
-                    # Update metadata with run_after
-                    run_after_dt = datetime.now() + timedelta(seconds=qe.wait_seconds)
-                    metadata['run_after'] = run_after_dt.isoformat()
-                    metadata['status'] = 'deferred_quota'
-                    
-                    parts = current_content.split('---', 2)
-                    if len(parts) >= 3:
-                        deferred_content = f"--- \n{yaml.dump(metadata, allow_unicode=True)}--- {parts[2]}"
-                    else:
-                        deferred_content = current_content
-                    
-                    # Move to recurrent/
-                    recurrent_dir = os.path.join(tasks_dir, "recurrent")
-                    os.makedirs(recurrent_dir, exist_ok=True)
-                    dest = os.path.join(recurrent_dir, filename)
-                    with open(dest, 'w') as f:
-                        f.write(deferred_content)
-                    os.remove(filepath)
-                    
-                    wait_min = qe.wait_seconds // 60
-                    print(f"  -> Moved {filename} to recurrent/ (run_after: {run_after_dt.strftime('%H:%M')})", flush=True)
-                    
-                    # Queue notification for user
-                    chat_id = metadata.get('chat_id')
-                    if chat_id:
-                        notif_dir = "/app/data/notifications"
-                        os.makedirs(notif_dir, exist_ok=True)
-                        notif_file = os.path.join(notif_dir, f"{filename}_{int(time.time())}.json")
-                        with open(notif_file, 'w') as nf:
-                            json.dump({
-                                "chat_id": chat_id,
-                                "text": f"⏸ <b>Quota exceeded.</b> Your task is deferred.\n\nI'll retry automatically in ~{wait_min} minutes ({run_after_dt.strftime('%H:%M')}).",
-                                "parse_mode": "HTML"
-                            }, nf)
-                except Exception as move_err:
-                    print(f"  -> ERROR deferring task: {move_err}", flush=True)
-                # Continue to next task (don't block other users)
-
-            except Exception as e:
-                print(f"  -> ERROR processing {filename}: {e}", flush=True)
-                import traceback
-                traceback.print_exc()
+        # STEP C: FINALIZE (No unchecked/in-progress items remain)
+        has_answer = doc.has_answer
+        stage = "finalize"
+        
+        if not has_answer:
+            print(f"  -> State: FINALIZING (all steps done, generating answer)...", flush=True)
+            prompt = (
+                f"{user_ctx}\n"
+                f"OBJECTIVE: {request_text}\n"
+                f"The plan is complete.\n"
+                f"HISTORY:\n{history_text}\n"
+                "INSTRUCTION: Provide the FINAL ANSWER to the user. "
+                "Use <thought> for reasoning and <answer> for the message. "
+                "Use HTML formatting."
+            )
+            
+            result = run_gemini(prompt, user_dir)
+            
+            # If Gemini didn't include <answer> tags, wrap the whole result
+            if result and "<answer>" not in result:
+                print(f"  -> WARNING: Gemini didn't use <answer> tags, wrapping.", flush=True)
+                result = f"<thought>Plan complete.</thought><answer>{result}</answer>"
+            
+            task_store.append(filepath, f"\n\n--- RESULT ({datetime.now().strftime('%H:%M')}) ---\n{result}\n")
+        else:
+            print(f"  -> State: ALREADY FINISHED (has <answer>).", flush=True)
+        
+        # Archive unconditionally
+        print(f"  -> Archiving {filename}...", flush=True)
+        if not os.path.exists(archive_dir): os.makedirs(archive_dir)
+        task_store.move(filepath, os.path.join(archive_dir, filename))
+        events.publish(events.ANSWER_READY, user_id, os.path.join(archive_dir, filename))
+        task_finished(metadata, "done")
+        
+        # Maintenance (Auto Commit)
+        with tracing.span(trace_id, "git commit"):
+            commit_user_repo(user_id, f"Task {filename} completed")
+        print(f"  -> DONE.", flush=True)
+
+    except TaskCancelled:
+        print(f"  -> CANCELLED by user, Gemini process group killed.", flush=True)
+        finish_cancelled(user_dir, user_id, filename)
+
+    except QuotaExhaustedError as qe:
+        # Per-user deferral: move task to recurrent/ with run_after
+        print(f"  -> QUOTA EXHAUSTED for user {user_id}. Deferring task for {qe.wait_seconds}s.", flush=True)
+        try:
+            run_after_dt = datetime.now() + timedelta(seconds=qe.wait_seconds)
+            wait_min = qe.wait_seconds // 60
+            defer_task(tasks_dir, user_id, filename, run_after_dt, "quota",
+                       f"⏸ <b>Quota exceeded.</b> Your task is deferred.\n\nI'll retry automatically in ~{wait_min} minutes ({run_after_dt.strftime('%H:%M')}).")
+            span["outcome"] = "deferred"
+        except Exception as move_err:
+            print(f"  -> ERROR deferring task: {move_err}", flush=True)
+        # Continue to next task (don't block other users)
+
+    except Exception as e:
+        print(f"  -> ERROR processing {filename}: {e}", flush=True)
+        metrics.inc("task_errors_total")
+        span["error"] = type(e).__name__
+        import traceback
+        traceback.print_exc()
+    finally:
+        clear_current_task()
+        if stage:
+            metrics.observe("task_stage_seconds", time.monotonic() - started, stage=stage)
+            tracing.record(trace_id, stage, started_at, time.time(), task=filename, **span)
+
+def defer_task(tasks_dir, user_id, filename, run_after_dt, reason, text):
+    """Parks a task in recurrent/ until run_after_dt (the heartbeat moves it back) and tells the user.
+
+    reason is "quota" (Gemini quota) or "usage" (the user's daily limit); the status becomes deferred_<reason>.
+    """
+    filepath = os.path.join(tasks_dir, filename)
+    run_after = run_after_dt.isoformat()
+    # Revert any in-progress [/] steps back to [ ]
+    doc = task_store.modify(filepath, lambda meta, body: (
+        dict(meta, run_after=run_after, status=f'deferred_{reason}'),
+        body.replace("- [/]", "- [ ]"),
+    ))
+    metadata = doc.metadata if doc else {}
+
+    # Move to recurrent/
+    recurrent_dir = os.path.join(tasks_dir, "recurrent")
+    os.makedirs(recurrent_dir, exist_ok=True)
+    dest = os.path.join(recurrent_dir, filename)
+    task_store.move(filepath, dest)
+    print(f"  -> Moved {filename} to recurrent/ (run_after: {run_after_dt.strftime('%H:%M')})", flush=True)
+
+    # Queue notification for user
+    chat_id = metadata.get('chat_id')
+    if chat_id:
+        notification_spool.enqueue(chat_id, text, key=f"deferred:{user_id}:{filename}:{run_after}")
+    events.publish(events.DEFERRED, user_id, dest, run_after=run_after)
+    metrics.inc("tasks_deferred_total", reason=reason)
+    tracing.record(metadata.get('trace_id'), f"deferred ({reason})", time.time(), run_after_dt.timestamp(),
+                   task=filename)
+
+def task_finished(metadata, outcome):
+    """Counts a finished task and the time from the user's message to its end."""
+    metrics.inc("tasks_finished_total", outcome=outcome)
+    try:
+        created = datetime.fromisoformat(str(metadata.get('created_at')))
+    except ValueError:
+        return
+    metrics.observe("task_latency_seconds", (datetime.now() - created).total_seconds(), outcome=outcome)
+
+def finish_cancelled(user_dir, user_id, filename):
+    """Marks a cancelled task, skips its remaining steps and archives it."""
+    tasks_dir = os.path.join(user_dir, "tasks")
+    archive_dir = os.path.join(tasks_dir, "archive")
+    filepath = os.path.join(tasks_dir, filename)
+    if inbox:
+        inbox.cancelled.discard((str(user_id), filename))
+    marker = f"\n\n{CANCELLED_MARKER} ({datetime.now().strftime('%H:%M')}) ---\nCancelled by the user.\n"
+    try:
+        doc = task_store.modify(filepath, lambda metadata, body: (
+            dict(metadata, status='cancelled'),
+            body.replace("- [/]", "- [!]").replace("- [ ]", "- [-]") + marker,
+        ))
+    except FileNotFoundError:
+        return
+
+    os.makedirs(archive_dir, exist_ok=True)
+    task_store.move(filepath, os.path.join(archive_dir, filename))
+    events.publish(events.ANSWER_READY, user_id, os.path.join(archive_dir, filename))
+    if doc:
+        task_finished(doc.metadata, "cancelled")
+        tracing.record(doc.metadata.get('trace_id'), "cancelled", time.time(), task=filename)
+    print(f"  -> Cancelled and archived {filename}.", flush=True)
+    commit_user_repo(user_id, f"Task {filename} cancelled")
+
+def commit_user_repo(user_id, message):
+    git_dir = os.path.join(USERS_ROOT, f"user_{user_id}", ".git")
+    metrics.set_gauge("git_syncs_in_progress", 1)
+    try:
+        if not os.path.isdir(git_dir):
+            subprocess.run([sys.executable, GIT_MANAGER, "commit", user_id, message], check=False)
+            return
+        # Runners holding leases on different tasks of the same user would race on .git/index.lock
+        with open(os.path.join(git_dir, "runner_commit.lock"), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            subprocess.run([sys.executable, GIT_MANAGER, "commit", user_id, message], check=False)
+    finally:
+        metrics.set_gauge("git_syncs_in_progress", 0)
+
+def task_priority(filename):
+    """Sort key: interactive tasks before spawned recurrent ones, then by name (age)."""
+    return (filename.startswith("recurrent_"), filename)
+
+def process_user_tasks(user_dir):
+    user_id = os.path.basename(user_dir).replace("user_", "")
+    tasks_dir = os.path.join(user_dir, "tasks")
+    
+    if not os.path.exists(tasks_dir): return
+
+    files = [f for f in os.listdir(tasks_dir) if f.endswith(".md") and os.path.isfile(os.path.join(tasks_dir, f))]
+    files.sort(key=task_priority)
+    
+    if not files: return
+
+    # One runner per user at a time: the user's tasks share its working tree and Gemini settings
+    if not leases.acquire_user(user_id):
+        return
+    try:
+        user_ctx = get_context(user_dir)
+        over_hard_limit = usage.state(user_id) == "hard"
+
+        for filename in files:
+            # Another runner may be working on it (see task_lease.py)
+            if not leases.acquire(user_id, filename):
+                continue
+            try:
+                if not os.path.exists(os.path.join(tasks_dir, filename)):
+                    continue  # finished by another runner since the listing
+                if over_hard_limit and defer_over_limit(tasks_dir, user_id, filename):
+                    continue
+                process_task(user_dir, user_id, filename, user_ctx)
             finally:
-                clear_current_task()
+                leases.release(user_id, filename)
+    finally:
+        leases.release_user(user_id)
+
+def defer_over_limit(tasks_dir, user_id, filename):
+    """Defers a runnable task to tomorrow once the user is over a hard usage limit (see usage.py)."""
+    doc = task_parser.load(os.path.join(tasks_dir, filename))
+    if doc is None or doc.awaiting_confirmation or doc.status in ('needs_user_input', 'blocked', 'cancelled'):
+        return False  # waiting for the user anyway; cancellations are finished normally
+    tomorrow = (datetime.now() + timedelta(days=1)).replace(hour=0, minute=5, second=0, microsecond=0)
+    print(f"  -> User {user_id} is over the daily usage limit. Deferring {filename}.", flush=True)
+    try:
+        defer_task(tasks_dir, user_id, filename, tomorrow, "usage",
+                   f"⏸ <b>Daily usage limit reached.</b> Your task is deferred.\n\nI'll continue automatically tomorrow ({tomorrow.strftime('%d.%m %H:%M')}).")
+    except Exception as e:
+        print(f"  -> ERROR deferring task: {e}", flush=True)
+    return True
+
+def process_tasks(inbox=None, woken=()):
+    """
+    One pass over all users. Users in `woken` (ids from runner_wakeup) go
+    first; wake-ups that arrive during the pass jump the remaining queue.
+    Users over a soft usage limit (see usage.py) always come last.
+    """
+    user_dirs = [d for d in glob.glob(os.path.join(USERS_ROOT, "user_*"))
+                 if leases.owns(os.path.basename(d).replace("user_", ""))]
+    woken = [str(u) for u in woken]
+    over_limit = {uid for uid in (os.path.basename(d).replace("user_", "") for d in user_dirs) if usage.state(uid) != "ok"}
+    user_dirs.sort(key=lambda d: (os.path.basename(d).replace("user_", "") in over_limit,
+                                  os.path.basename(d).replace("user_", "") not in woken))
+    
+    while user_dirs:
+        process_user_tasks(user_dirs.pop(0))
+        
+        if inbox:
+            for uid in inbox.drain():
+                user_dir = os.path.join(USERS_ROOT, f"user_{uid}")
+                if user_dir in user_dirs: user_dirs.remove(user_dir)
+                if os.path.isdir(user_dir) and leases.owns(uid):
+                    user_dirs.insert(len(user_dirs) if uid in over_limit else 0, user_dir)
 
 if __name__ == "__main__":
-    print(f"[{datetime.now().strftime('%H:%M:%S')}] Task runner started.", flush=True)
+    print(f"[{datetime.now().strftime('%H:%M:%S')}] Task runner {leases.runner_id} started.", flush=True)
+    metrics.init(f"runner-{leases.runner_id}")
+    tracing.init("runner")
+    profiler = profiling.Profiler("runner", f"runner-{leases.runner_id}").install()
+    leases.start()
+    atexit.register(leases.shutdown)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        inbox = runner_wakeup.Inbox(name=leases.runner_id)
+        atexit.register(inbox.close)
+    except Exception as e:
+        print(f"Wake-up channel unavailable, polling only: {e}", flush=True)
+        inbox = None
+    woken = []
     while True:
         try:
-            process_tasks()
+            with profiler.iteration():
+                process_tasks(inbox, woken)
         except Exception as e:
             print(f"Runner Loop Error: {e}", flush=True)
-        time.sleep(2)
+        # Poll every 2s, or right away when the gateway enqueues a task
+        if inbox:
+            woken = inbox.wait(2)
+        else:
+            time.sleep(2)
@@ -0,0 +1,167 @@
+"""Versioned, atomic writes of task .md files shared by the runner and the gateway.
+
+The runner, notify_results and the gateway handlers all rewrite the same task
+files. Every write goes through this module:
+
+- the new content is written to a hidden temp file next to the task and
+  renamed over it, so a reader never sees a half-written file;
+- the frontmatter carries a `version` counter, bumped by every write;
+- a write is a compare-and-swap against the version it was computed from. The
+  check and the rename happen under an flock on the task's directory, held
+  for a few milliseconds and never across a Gemini call.
+
+On a conflict, modify() re-reads the file and applies its change again.
+save(), used for the runner's long read -> Gemini -> write cycles, merges
+instead: metadata keys the other writer changed are kept unless the runner
+changed the same key, and text appended to the body meanwhile (USER INPUT,
+USER DECISION, reactions) is carried over after the runner's new body. A body
+that was changed other than by appending raises VersionConflict.
+"""
+
+import os
+import uuid
+import fcntl
+from collections import namedtuple
+from contextlib import contextmanager
+
+import yaml
+
+import task_parser
+
+MAX_RETRIES = 20
+
+TaskDoc = namedtuple("TaskDoc", "metadata body version")
+
+stats = {"writes": 0, "conflicts": 0, "merges": 0}
+
+
+class VersionConflict(Exception):
+    """The file changed since it was read and the change cannot be merged."""
+
+
+def parse(content):
+    """TaskDoc for the text of a task file, or None if it has no frontmatter."""
+    parsed = task_parser.split(content)
+    if parsed is None:
+        return None
+    metadata, body = parsed
+    return TaskDoc(metadata, body, int(metadata.get("version") or 0))
+
+
+def render(metadata, body):
+    return f"--- \n{yaml.dump(metadata, allow_unicode=True)}---{body}"
+
+
+def read(path):
+    """TaskDoc of the file, or None without frontmatter. Raises FileNotFoundError."""
+    with open(path, 'r') as f:
+        return parse(f.read())
+
+
+@contextmanager
+def _dir_lock(path):
+    fd = os.open(os.path.dirname(path) or ".", os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)  # drops the lock
+
+
+def _replace(path, text):
+    tmp = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.{uuid.uuid4().hex[:8]}.tmp")
+    try:
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def _commit(path, base_version, metadata, body):
+    """Writes if the file is still at base_version. Returns (True, new doc) or (False, current doc)."""
+    with _dir_lock(path):
+        current = read(path)
+        if (current.version if current else 0) != base_version:
+            stats["conflicts"] += 1
+            return False, current
+        metadata = dict(metadata, version=base_version + 1)
+        _replace(path, render(metadata, body))
+    stats["writes"] += 1
+    return True, TaskDoc(metadata, body, base_version + 1)
+
+
+def create(path, metadata, body):
+    """Writes a new task file (version 1) atomically."""
+    metadata = dict(metadata, version=1)
+    _replace(path, render(metadata, body))
+    stats["writes"] += 1
+    return TaskDoc(metadata, body, 1)
+
+
+def modify(path, fn):
+    """
+    Read-modify-write with retries. fn(metadata, body) returns the new
+    (metadata, body), or None to leave the file alone; it runs again on the
+    fresh content after a conflict, so it must not have side effects.
+    Returns the written TaskDoc, or None if fn declined or the file has no
+    frontmatter. Raises FileNotFoundError if the file is gone.
+    """
+    for _ in range(MAX_RETRIES):
+        doc = read(path)
+        if doc is None:
+            return None
+        change = fn(dict(doc.metadata), doc.body)
+        if change is None:
+            return None
+        ok, new = _commit(path, doc.version, *change)
+        if ok:
+            return new
+    raise VersionConflict(f"{os.path.basename(path)}: gave up after {MAX_RETRIES} conflicting writes")
+
+
+def append(path, text, **metadata_updates):
+    """Appends text to the body (and sets metadata keys) without losing concurrent writes."""
+    return modify(path, lambda metadata, body: ({**metadata, **metadata_updates}, body + text))
+
+
+def _merge_metadata(base, ours, theirs):
+    merged = dict(theirs)
+    for key in set(base) | set(ours):
+        if key == "version" or ours.get(key) == base.get(key):
+            continue
+        if key in ours:
+            merged[key] = ours[key]
+        else:
+            merged.pop(key, None)
+    return merged
+
+
+def save(path, base, metadata, body):
+    """
+    Writes (metadata, body) computed from `base`, a TaskDoc read earlier. If
+    another writer got in between, merges its metadata changes and appended
+    text (see the module docstring) and tries again. Returns the written
+    TaskDoc, which is the base for the caller's next save().
+    """
+    for _ in range(MAX_RETRIES):
+        ok, current = _commit(path, base.version, metadata, body)
+        if ok:
+            return current
+        if current is None or not current.body.startswith(base.body):
+            raise VersionConflict(f"{os.path.basename(path)} was rewritten since version {base.version}")
+        metadata = _merge_metadata(base.metadata, metadata, current.metadata)
+        body += current.body[len(base.body):]
+        base = current
+        stats["merges"] += 1
+    raise VersionConflict(f"{os.path.basename(path)}: gave up after {MAX_RETRIES} conflicting writes")
+
+
+def move(src, dst):
+    """Renames a task file (archive, recurrent/) without racing a write in progress."""
+    with _dir_lock(src):
+        os.rename(src, dst)
@@ -1,22 +1,38 @@
 import os
 import asyncio
-import yaml
 import time
 import hashlib
+import functools
 import re
 import sys
+import glob
 import traceback
 import qrcode
 import subprocess
 from io import BytesIO
 from datetime import datetime
-from aiogram import Bot, Dispatcher, types, F
+from aiogram import Dispatcher, types, F
 from aiogram.filters import Command
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.types import BufferedInputFile, InputMediaPhoto
 
 import state_inspector as state_inspector
 import git_manager as git_manager
+import runner_wakeup
+import config_cache
+from outbound import Outbox
+import notification_spool
+import msg_index
+import async_storage as storage
+from log_follower import LogFollower
+import webhook
+import burst
+import task_store
+import task_parser
+import metrics
+import tracing
+import profiling
+import usage
 from utils import strip_ansi
 
 import json
@@ -25,11 +41,12 @@ TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 ADMIN_ID = os.getenv("TELEGRAM_ADMIN_ID")
 USERS_ROOT = "/app/users"
 BRIDGE_LOG = "/app/data/logs/whatsapp_bridge.log"
-ALLOWED_USERS_FILE = "/app/config/allowed_users.json"
-USER_REGISTRY_FILE = "/app/config/user_registry.json"
+ALLOWED_USERS_FILE = config_cache.ALLOWED_USERS_FILE
+USER_REGISTRY_FILE = config_cache.USER_REGISTRY_FILE
 
-bot = Bot(token=TOKEN)
+bot = webhook.make_bot(TOKEN)
 dp = Dispatcher()
+outbox = Outbox(bot)
 start_time = time.time()
 
 # Global storage for active auth processes: user_id -> subprocess.Process
@@ -38,25 +55,26 @@ pending_auth_sessions = {}
 # Onboarding state: user_id -> { 'state': 'URL'|'TOKEN', 'data': {} }
 pending_onboarding = {}
 
+# Burst coalescing: chat_id -> (path of the newest task still open for appends, window end)
+burst_tasks = {}
+
+# /perf auto-refresh: chat_id -> asyncio task editing the dashboard message
+PERF_REFRESH = 10       # seconds between edits
+PERF_DURATION = 300     # seconds a /perf message keeps refreshing
+perf_refreshers = {}
+
 def log_tg(msg):
     print(f"--- [TG GATEWAY] {datetime.now().strftime('%H:%M:%S')} - {msg}", flush=True)
 
 # strip_ansi is imported from utils.py
 
 def is_user_allowed(user_id):
-    """Checks if the user_id is in the whitelist."""
-    if not os.path.exists(ALLOWED_USERS_FILE):
+    """Checks if the user_id is in the whitelist (cached in memory, see config_cache.py)."""
+    allowed = config_cache.is_user_allowed(user_id)
+    if allowed is None:
         log_tg(f"⚠️ Warning: {ALLOWED_USERS_FILE} not found. Allowing everyone (DEBUG mode).")
         return True
-        
-    try:
-        with open(ALLOWED_USERS_FILE, 'r') as f:
-            data = json.load(f)
-            allowed = data.get("allowed_ids", [])
-            return int(user_id) in allowed
-    except Exception as e:
-        log_tg(f"Error reading allowed users: {e}")
-        return False
+    return allowed
 
 async def check_access(message: types.Message):
     user_id = str(message.from_user.id)
@@ -78,7 +96,7 @@ async def check_access(message: types.Message):
         
     # 3. Check Registration
     paths = get_user_paths(user_id)
-    if not os.path.exists(paths["tasks"]):
+    if not await storage.exists(paths["tasks"]):
         # Allowed but no folder -> Start Onboarding
         log_tg(f"User {user_id} allowed but not initialized. Starting onboarding.")
         pending_onboarding[user_id] = {'state': 'URL'}
@@ -128,10 +146,7 @@ async def handle_onboarding_message(message: types.Message):
         
         # Save to registry
         try:
-            registry = {}
-            if os.path.exists(USER_REGISTRY_FILE):
-                with open(USER_REGISTRY_FILE, 'r') as f:
-                    registry = json.load(f)
+            registry = dict(await storage.run(config_cache.load_registry))
             
             registry[user_id] = {
                 "repo_url": repo_url,
@@ -141,8 +156,8 @@ async def handle_onboarding_message(message: types.Message):
                 "git_email": f"{user_id}@assistant.bot"
             }
             
-            with open(USER_REGISTRY_FILE, 'w') as f:
-                json.dump(registry, f, indent=4)
+            await storage.write_text_atomic(USER_REGISTRY_FILE, json.dumps(registry, indent=4))
+            config_cache.registry.invalidate()
                 
             # Trigger setup via Git Manager
             # Run in executor to avoid blocking loop
@@ -203,11 +218,14 @@ async def handle_onboarding_message(message: types.Message):
             f"# History\n"
         )
         
-        metadata = {"message_id": message.message_id, "chat_id": message.chat.id, "user_id": user_id}
+        metadata = {"message_id": message.message_id, "chat_id": message.chat.id, "user_id": user_id,
+                    "created_at": datetime.now().isoformat(), "trace_id": tracing.new_trace_id()}
         
         try:
-            with open(os.path.join(paths["tasks"], task_filename), "w") as f:
-                f.write(f"--- \n{yaml.dump(metadata, allow_unicode=True)}--- \n\n{task_content}\n")
+            await storage.run(task_store.create, os.path.join(paths["tasks"], task_filename), metadata,
+                              f" \n\n{task_content}\n")
+            await storage.run(msg_index.add, user_id, task_filename, message.message_id)
+            runner_wakeup.task_enqueued(user_id, task_filename)
             
             del pending_onboarding[user_id]
             await message.answer("👍 Спасибо! Я анализирую ваш ответ и сейчас вернусь с рекомендациями...")
@@ -239,27 +257,8 @@ def ensure_user_structure(user_id):
     return paths
 
 def find_task_by_msg_id(user_id, msg_id):
-    if not msg_id: return None
-    paths = get_user_paths(user_id)
-    # Use regex with word boundaries to avoid matching 123 in 123456
-    patterns = [
-        re.compile(rf"message_id:\s*{msg_id}\b"),
-        re.compile(rf"last_ai_message_id:\s*{msg_id}\b"),
-        re.compile(rf"status_message_id:\s*{msg_id}\b")
-    ]
-    
-    for folder in [paths["tasks"], paths["archive"]]:
-        if not os.path.exists(folder): continue
-        for f in sorted(os.listdir(folder), reverse=True):
-            if not f.endswith(".md"): continue
-            path = os.path.join(folder, f)
-            try:
-                with open(path, 'r') as file:
-                    header = file.read(2000)
-                    if any(p.search(header) for p in patterns): return path
-            except Exception:
-                pass
-    return None
+    """O(1) lookup through the per-user message index (see msg_index.py)."""
+    return msg_index.lookup(user_id, msg_id)
 
 async def send_smart_message(chat_id, text, reply_to=None, reply_markup=None, parse_mode="HTML"):
     parts = [text[i:i+4000] for i in range(0, len(text), 4000)]
@@ -267,8 +266,8 @@ async def send_smart_message(chat_id, text, reply_to=None, reply_markup=None, pa
     for i, part in enumerate(parts):
         current_markup = reply_markup if i == len(parts) - 1 else None
         try:
-            last_sent = await bot.send_message(
-                chat_id=chat_id,
+            last_sent = await outbox.send(
+                chat_id,
                 text=part,
                 reply_to_message_id=reply_to if i == 0 else None,
                 reply_markup=current_markup,
@@ -279,8 +278,8 @@ async def send_smart_message(chat_id, text, reply_to=None, reply_markup=None, pa
             clean_part = re.sub(r'<[^>]+>', '', part).replace("---FINAL_ANSWER---", "")
             try:
                 # Попытка 2: Без HTML и БЕЗ reply_to (так как он мог вызвать ошибку)
-                last_sent = await bot.send_message(
-                    chat_id=chat_id,
+                last_sent = await outbox.send(
+                    chat_id,
                     text=clean_part,
                     reply_to_message_id=None, 
                     reply_markup=current_markup
@@ -289,89 +288,77 @@ async def send_smart_message(chat_id, text, reply_to=None, reply_markup=None, pa
                 log_tg(f"Retry failed too: {e2}")
     return last_sent
 
+# Only lines matching this are decoded and parsed; everything else in the bridge log is skipped
+QR_LOG_PATTERN = r"Emitting QR code|Scan this QR code|Device logged out|device_removed|Waiting|[█▀▄║╔╗]"
+
+@functools.lru_cache(maxsize=8)
+def _render_qr_png(data):
+    qr_img = qrcode.QRCode(version=None, error_correction=qrcode.constants.ERROR_CORRECT_M, box_size=12, border=4)
+    qr_img.add_data(data); qr_img.make(fit=True)
+    img = qr_img.make_image(fill_color="black", back_color="white")
+    bio = BytesIO(); img.save(bio, 'PNG'); bio.seek(0)
+    return bio.read()
+
 async def monitor_qr_code():
     log_tg("QR code monitor started.")
-    last_pos = 0
-    if os.path.exists(BRIDGE_LOG):
-        last_pos = os.path.getsize(BRIDGE_LOG)
-    
-    sent_qr_info = {"hash": None, "timestamp": 0, "message_id": None} 
+    follower = LogFollower(BRIDGE_LOG, QR_LOG_PATTERN, log=log_tg)
+    sent_qr_info = {"hash": None, "message_id": None}
+    qr_ascii_block = []
+    start_ascii_block = False
 
-    while True:
+    async for lines in follower.batches():
         try:
-            if not os.path.exists(BRIDGE_LOG):
-                await asyncio.sleep(3)
+            qr_data_string = None
+
+            for line in lines:
+                line_clean = strip_ansi(line)
+                if "Device logged out" in line_clean or "device_removed" in line_clean:
+                    await bot.send_message(ADMIN_ID, "❌ WhatsApp разлогинен. Используй /qr для нового кода.")
+                if "Emitting QR code" in line_clean:
+                    qr_data_string = line_clean.split("Emitting QR code")[-1].strip()
+                    log_tg(f"Clean QR data detected: {qr_data_string[:30]}...")
+                if "Scan this QR code" in line_clean:
+                    start_ascii_block = True; qr_ascii_block = []
+                elif start_ascii_block:
+                    if any(c in line_clean for c in ["█", "▀", "▄", "║", "╔", "╗"]): qr_ascii_block.append(line_clean + "\n")
+                    elif "Waiting" in line_clean or "▀▀▀▀" in line_clean: start_ascii_block = False
+
+            qr_payload = qr_data_string or ("".join(qr_ascii_block) if qr_ascii_block else None)
+            if not qr_payload:
                 continue
+            qr_hash = hashlib.md5(qr_payload.encode()).hexdigest()
+            if qr_hash == sent_qr_info["hash"]:
+                continue  # same code already on the admin's screen
+
+            if qr_data_string:
+                log_tg(f"Generating high-quality PNG for: {qr_data_string[:20]}...")
+                qr_bytes = await storage.run(_render_qr_png, qr_data_string)
+                caption = f"🆕 <b>Свежий QR-код (PNG)</b>\nДанные: <code>{qr_data_string[:15]}...</code>"
+
+                sent = False
+                if sent_qr_info.get("message_id"):
+                    try:
+                        await bot.edit_message_media(
+                            chat_id=ADMIN_ID,
+                            message_id=sent_qr_info["message_id"],
+                            media=InputMediaPhoto(media=BufferedInputFile(qr_bytes, filename="qr.png"), caption=caption, parse_mode="HTML")
+                        )
+                        log_tg("QR updated (edited).")
+                        sent = True
+                    except Exception as edit_err:
+                        log_tg(f"Edit failed ({edit_err}), sending new...")
+
+                if not sent:
+                    msg = await bot.send_photo(chat_id=ADMIN_ID, photo=BufferedInputFile(qr_bytes, filename="qr.png"), caption=caption, parse_mode="HTML")
+                    sent_qr_info["message_id"] = msg.message_id
+                    log_tg("QR sent (new).")
+            else:
+                log_tg("Sending ASCII fallback...")
+                await bot.send_message(chat_id=ADMIN_ID, text=f"⚠️ <b>QR-код (ASCII):</b>\n<pre>{''.join(qr_ascii_block)}</pre>", parse_mode="HTML")
 
-            with open(BRIDGE_LOG, 'r', encoding='utf-8', errors='ignore') as f:
-                f.seek(last_pos)
-                lines = f.readlines()
-                current_log_pos = f.tell()
-
-                qr_data_string = None
-                qr_ascii_block = []
-                start_ascii_block = False
-
-                for line in lines:
-                    line_clean = strip_ansi(line)
-                    if "Device logged out" in line_clean or "device_removed" in line_clean:
-                        await bot.send_message(ADMIN_ID, "❌ WhatsApp разлогинен. Используй /qr для нового кода.")
-                    if "Emitting QR code" in line_clean:
-                        qr_data_string = line_clean.split("Emitting QR code")[-1].strip()
-                        log_tg(f"Clean QR data detected: {qr_data_string[:30]}...")
-                    if "Scan this QR code" in line_clean:
-                        start_ascii_block = True; qr_ascii_block = []
-                    elif start_ascii_block:
-                        if any(c in line_clean for c in ["█", "▀", "▄", "║", "╔", "╗"]): qr_ascii_block.append(line_clean)
-                        elif "Waiting" in line_clean or "▀▀▀▀" in line_clean: start_ascii_block = False
-
-                qr_payload = qr_data_string or ("".join(qr_ascii_block) if qr_ascii_block else None)
-                if qr_payload:
-                    qr_hash = hashlib.md5(qr_payload.encode()).hexdigest()
-                    # Check if hash changed or if it's been a while (to ensure freshness on screen)
-                    if qr_hash != sent_qr_info["hash"] or (time.time() - sent_qr_info["timestamp"] > 5):
-                        if qr_data_string:
-                            log_tg(f"Generating high-quality PNG for: {qr_data_string[:20]}...")
-                            qr_img = qrcode.QRCode(version=None, error_correction=qrcode.constants.ERROR_CORRECT_M, box_size=12, border=4)
-                            qr_img.add_data(qr_data_string); qr_img.make(fit=True)
-                            img = qr_img.make_image(fill_color="black", back_color="white")
-                            bio = BytesIO(); img.save(bio, 'PNG'); bio.seek(0)
-                            qr_bytes = bio.read()
-                            
-                            media_file = BufferedInputFile(qr_bytes, filename="qr.png")
-                            caption = f"🆕 <b>Свежий QR-код (PNG)</b>\nДанные: <code>{qr_data_string[:15]}...</code>"
-                            
-                            sent = False
-                            if sent_qr_info.get("message_id"):
-                                try:
-                                    await bot.edit_message_media(
-                                        chat_id=ADMIN_ID,
-                                        message_id=sent_qr_info["message_id"],
-                                        media=InputMediaPhoto(media=media_file, caption=caption, parse_mode="HTML")
-                                    )
-                                    log_tg("QR updated (edited).")
-                                    sent = True
-                                except Exception as edit_err:
-                                    log_tg(f"Edit failed ({edit_err}), sending new...")
-                            
-                            if not sent:
-                                # Re-create file object for new send
-                                media_file = BufferedInputFile(qr_bytes, filename="qr.png")
-                                msg = await bot.send_photo(chat_id=ADMIN_ID, photo=media_file, caption=caption, parse_mode="HTML")
-                                sent_qr_info["message_id"] = msg.message_id
-                                log_tg("QR sent (new).")
-
-                        elif qr_ascii_block:
-                            log_tg("Sending ASCII fallback...")
-                            await bot.send_message(chat_id=ADMIN_ID, text=f"⚠️ <b>QR-код (ASCII):</b>\n<pre>{''.join(qr_ascii_block)}</pre>", parse_mode="HTML")
-                        
-                        sent_qr_info["hash"] = qr_hash
-                        sent_qr_info["timestamp"] = time.time()
-                        
-                last_pos = current_log_pos
+            sent_qr_info["hash"] = qr_hash
         except Exception as e:
             log_tg(f"QR Monitor error: {e}"); traceback.print_exc()
-        await asyncio.sleep(3)
 
 # Alias map: user-friendly names → actual MCP server/tool names
 TOOL_ALIASES = {
@@ -617,26 +604,181 @@ async def cmd_auth_code(message: types.Message, command: Command):
 @dp.message(Command("status"))
 async def cmd_status(message: types.Message):
     if not await check_access(message): return
-    await send_smart_message(message.chat.id, state_inspector.get_full_state(message.from_user.id))
+    text = await storage.run(state_inspector.get_full_state, message.from_user.id)
+    if str(message.from_user.id) == str(ADMIN_ID):
+        st = outbox.stats()
+        text += (
+            f"\n\n📤 <b>Outbox:</b> {st['queued']} queued in {st['chats']} chats (max {st['max_chat_depth']}), "
+            f"latency p50 {st['latency_p50']:.1f}s / p95 {st['latency_p95']:.1f}s, "
+            f"sent {st['sent']}, failed {st['failed']}, coalesced {st['coalesced']}, retry-after {st['retry_after']}"
+        )
+        spool = await storage.run(notification_spool.stats)
+        text += f"\n📬 <b>Spool:</b> {spool.get('pending', 0)} pending, {spool.get('dead', 0)} dead-lettered"
+        heavy = await storage.run(usage.top_users)
+        if heavy:
+            text += "\n📊 <b>Heaviest users today:</b> " + ", ".join(
+                f"{uid} CPU {used['cpu_seconds']:.0f}s / wall {used['wall_seconds']:.0f}s / {used['peak_rss_mb']} MB"
+                for uid, used in heavy)
+        lag = storage.lag_summary()
+        text += (
+            f"\n🧩 <b>Burst merging:</b> {burst.stats['merged_messages']} messages merged, "
+            f"≥{burst.stats['gemini_calls_saved']} Gemini calls saved"
+        )
+        text += f"\n⏱ <b>Event loop lag:</b> {lag['last']*1000:.0f}ms now, p95 {lag['p95']*1000:.0f}ms, max {lag['max']*1000:.0f}ms, {lag['stalls']} stalls"
+    await send_smart_message(message.chat.id, text)
+
+@dp.message(Command("cancel"))
+async def cmd_cancel(message: types.Message):
+    """Cancels the replied-to task, else the running one, else the newest queued one."""
+    if not await check_access(message): return
+    user_id = str(message.from_user.id)
+    paths = get_user_paths(user_id)
+    filename = None
+    if message.reply_to_message:
+        target = await storage.run(find_task_by_msg_id, user_id, message.reply_to_message.message_id)
+        if target and os.path.dirname(target) == paths["tasks"]:
+            filename = os.path.basename(target)
+    if not filename:
+        filename = await storage.run(state_inspector.get_running_task, user_id)
+    if not filename and await storage.exists(paths["tasks"]):
+        queued = sorted(f for f in await storage.listdir(paths["tasks"]) if f.endswith(".md"))
+        filename = queued[-1] if queued else None
+    if filename and await cancel_task(user_id, filename):
+        await message.answer(f"🚫 Cancelling <code>{filename}</code>...", parse_mode="HTML")
+    else:
+        await message.answer("Nothing to cancel.")
+
+@dp.message(Command("burst"))
+async def cmd_burst(message: types.Message, command: Command):
+    if not await check_access(message): return
+    user_id = str(message.from_user.id)
+    if command.args:
+        try:
+            seconds = float(command.args.strip())
+        except ValueError:
+            await message.answer("Usage: <code>/burst 3</code> (seconds, 0 = off)", parse_mode="HTML")
+            return
+        await storage.run(burst.set_window, user_id, seconds)
+    window = burst.window_for(user_id)
+    if window:
+        await message.answer(
+            f"🧩 Messages sent within <b>{window:g}s</b> of each other are merged into one task.\n"
+            f"Change with <code>/burst &lt;seconds&gt;</code>, turn off with <code>/burst 0</code>.",
+            parse_mode="HTML"
+        )
+    else:
+        await message.answer("🧩 Burst merging is <b>off</b>: every message becomes its own task.", parse_mode="HTML")
+
+def find_trace_id(name):
+    """Trace id of a task (by filename, any user, active, archived or deferred), or name itself."""
+    filename = name if name.endswith(".md") else f"{name}.md"
+    for user_dir in glob.glob(os.path.join(USERS_ROOT, "user_*")):
+        for sub in ("", "archive", "recurrent"):
+            path = os.path.join(user_dir, "tasks", sub, filename)
+            if os.path.isfile(path):
+                task = task_parser.load(path)
+                return task.metadata.get('trace_id') if task else None
+    return name
+
+@dp.message(Command("trace"))
+async def cmd_trace(message: types.Message, command: Command):
+    """Admin: waterfall of where a task's time went (see tracing.py)."""
+    if not await check_access(message): return
+    if str(message.from_user.id) != str(ADMIN_ID): return
+    name = (command.args or "").strip()
+    if not name and message.reply_to_message:
+        path = await storage.run(find_task_by_msg_id, message.from_user.id, message.reply_to_message.message_id)
+        name = os.path.basename(path) if path else ""
+    if not name:
+        await message.answer("Usage: <code>/trace task_20250101_120000_abcd</code> (or a trace id), "
+                             "or reply to a task's message with /trace", parse_mode="HTML")
+        return
+    trace_id = await storage.run(find_trace_id, name)
+    if not trace_id:
+        await message.answer("This task has no trace (created before tracing was enabled).")
+        return
+    spans = await storage.run(tracing.load, trace_id)
+    await send_smart_message(message.chat.id, tracing.waterfall(spans))
+
+@dp.message(Command("profile"))
+async def cmd_profile(message: types.Message, command: Command):
+    """Admin: on-demand profiling of the services (see profiling.py)."""
+    if not await check_access(message): return
+    if str(message.from_user.id) != str(ADMIN_ID): return
+    args = (command.args or "").split()
+    if len(args) == 1 and args[0].endswith(".txt"):
+        path = os.path.join(profiling.PROFILE_DIR, os.path.basename(args[0]))
+        if not await storage.exists(path):
+            await message.answer("No such profile.")
+            return
+        data = (await storage.read_text(path)).encode()
+        await message.answer_document(BufferedInputFile(data, filename=os.path.basename(path)))
+        return
+    services = ("runner", "heartbeat", "gateway", "all")
+    if not args or args[0] not in services or (len(args) > 1 and args[1] not in profiling.KINDS):
+        recent = await storage.run(profiling.recent)
+        listing = "\n".join(f"<code>{name}</code>" for name in recent) or "none yet"
+        await message.answer(
+            "Usage: <code>/profile runner|heartbeat|gateway|all [cpu|memory|tasks] [N]</code>\n"
+            f"N = loop iterations (runner, heartbeat; default {profiling.ITERATIONS}) "
+            f"or seconds (gateway; default {profiling.SECONDS}). "
+            "<code>/profile &lt;file.txt&gt;</code> sends a summary.\n\n"
+            f"<b>Recent profiles:</b>\n{listing}",
+            parse_mode="HTML"
+        )
+        return
+    service, kind = args[0], args[1] if len(args) > 1 else "cpu"
+    n = int(args[2]) if len(args) > 2 and args[2].isdigit() else None
+    await storage.run(profiling.request, service, kind, n, n)
+    await message.answer(
+        f"🔬 Requested a <b>{kind}</b> profile of <b>{service}</b>. "
+        f"Results appear in <code>{profiling.PROFILE_DIR}</code>; <code>/profile</code> lists them.",
+        parse_mode="HTML"
+    )
+
+async def refresh_perf(chat_id, message_id):
+    """Edits the /perf message every PERF_REFRESH seconds for PERF_DURATION seconds."""
+    deadline = time.monotonic() + PERF_DURATION
+    while time.monotonic() < deadline:
+        await asyncio.sleep(PERF_REFRESH)
+        text = await storage.run(state_inspector.get_perf_report, storage.lag_summary(), outbox.stats())
+        if time.monotonic() >= deadline:
+            text += "\n\n<i>Auto-refresh stopped, /perf to restart.</i>"
+        try:
+            await outbox.edit(chat_id, message_id, text=text, parse_mode="HTML")
+        except Exception as e:
+            log_tg(f"/perf refresh stopped: {e}")
+            return
+
+@dp.message(Command("perf"))
+async def cmd_perf(message: types.Message):
+    """Admin: live performance numbers in one message that refreshes itself."""
+    if not await check_access(message): return
+    if str(message.from_user.id) != str(ADMIN_ID): return
+    text = await storage.run(state_inspector.get_perf_report, storage.lag_summary(), outbox.stats())
+    sent = await message.answer(text, parse_mode="HTML")
+    previous = perf_refreshers.pop(message.chat.id, None)
+    if previous: previous.cancel()
+    perf_refreshers[message.chat.id] = asyncio.create_task(refresh_perf(message.chat.id, sent.message_id))
 
 @dp.message(Command("tasks"))
 async def cmd_tasks(message: types.Message):
     if not await check_access(message): return
-    await send_smart_message(message.chat.id, state_inspector.get_current_tasks(message.from_user.id))
+    await send_smart_message(message.chat.id, await storage.run(state_inspector.get_current_tasks, message.from_user.id))
 
 @dp.message(Command("memories"))
 async def cmd_memories(message: types.Message):
     if not await check_access(message): return
-    await send_smart_message(message.chat.id, state_inspector.get_memories_summary(message.from_user.id))
+    await send_smart_message(message.chat.id, await storage.run(state_inspector.get_memories_summary, message.from_user.id))
 
 @dp.message_reaction()
 async def handle_reaction(reaction: types.MessageReactionUpdated):
     if not is_user_allowed(reaction.user.id): return
     user_id = reaction.user.id
-    task_path = find_task_by_msg_id(user_id, reaction.message_id)
+    task_path = await storage.run(find_task_by_msg_id, user_id, reaction.message_id)
     if task_path:
         emoji = reaction.new_reaction[-1].emoji if reaction.new_reaction else "removed"
-        with open(task_path, 'a') as f: f.write(f"\n\n--- USER REACTION ({datetime.now()}) ---\nEmoji: {emoji}\n")
+        await storage.append_text(task_path, f"\n\n--- USER REACTION ({datetime.now()}) ---\nEmoji: {emoji}\n")
 
 @dp.callback_query(F.data.startswith("conf_"))
 async def handle_confirmation(callback: types.CallbackQuery):
@@ -649,27 +791,62 @@ async def handle_confirmation(callback: types.CallbackQuery):
     
     # Try finding in tasks first, then archive
     filepath = os.path.join(paths["tasks"], filename)
-    if not os.path.exists(filepath):
+    if not await storage.exists(filepath):
         filepath = os.path.join(paths["archive"], filename)
 
-    if os.path.exists(filepath):
+    if await storage.exists(filepath):
         res_text = "✅ Да" if decision == "yes" else "❌ Нет"
-        with open(filepath, 'a') as f: f.write(f"\n\n--- USER DECISION ---\n{res_text}\n")
+        await storage.append_text(filepath, f"\n\n--- USER DECISION ---\n{res_text}\n")
         # Move back to active tasks if it was archived
         if paths["archive"] in filepath:
             new_path = os.path.join(paths["tasks"], os.path.basename(filepath))
-            os.rename(filepath, new_path)
+            await storage.run(task_store.move, filepath, new_path)
+        runner_wakeup.task_enqueued(user_id, filename)
         
         await callback.message.edit_reply_markup(reply_markup=None)
         await callback.answer()
         try: await callback.message.react(reaction=[types.ReactionTypeEmoji(emoji="✍️")])
         except Exception: pass
 
+async def cancel_task(user_id, filename):
+    """Marks an active task cancelled and tells the runner to kill it if it is running."""
+    filepath = os.path.join(get_user_paths(user_id)["tasks"], filename)
+    try:
+        doc = await storage.run(task_store.read, filepath)
+    except FileNotFoundError:
+        return False  # finished (archived) or gone
+    if doc is None: return False
+    if doc.metadata.get('status') != 'cancelled':
+        try:
+            await storage.run(task_store.modify, filepath, lambda metadata, body: (dict(metadata, status='cancelled'), body))
+        except FileNotFoundError:
+            return False
+    runner_wakeup.task_cancelled(user_id, filename)
+    log_tg(f"Task {filename} of user {user_id} cancelled.")
+    return True
+
+@dp.callback_query(F.data.startswith("cancel_"))
+async def handle_cancel_button(callback: types.CallbackQuery):
+    if not is_user_allowed(callback.from_user.id):
+        await callback.answer("⛔ Нет доступа", show_alert=True)
+        return
+    filename = callback.data[len("cancel_"):]
+    if await cancel_task(callback.from_user.id, filename):
+        await callback.answer("🚫 Cancelling...")
+    else:
+        await callback.answer("This task has already finished.")
+
+def schedule_wakeup(user_id, task_filename, delay):
+    """Wakes the runner once the task's coalescing window has passed."""
+    asyncio.get_running_loop().call_later(delay + 0.1, runner_wakeup.task_enqueued, user_id, task_filename)
+
 @dp.message()
 async def handle_message(message: types.Message):
     if not await check_access(message): return
+    metrics.inc("messages_received_total")
+    received = time.time()
     user_id = str(message.from_user.id)
-    paths = ensure_user_structure(message.from_user.id)
+    paths = await storage.run(ensure_user_structure, message.from_user.id)
     
     # Defaults
     parent_task_id = None
@@ -677,20 +854,14 @@ async def handle_message(message: types.Message):
     # Check for Reply -> Parent Task logic
     if message.reply_to_message:
         target_msg_id = message.reply_to_message.message_id
-        parent_path = find_task_by_msg_id(user_id, target_msg_id)
+        parent_path = await storage.run(find_task_by_msg_id, user_id, target_msg_id)
         if parent_path:
             # Check if the target task is blocked/waiting for input
             try:
-                with open(parent_path, 'r') as f:
-                    parent_content = f.read()
-                parent_parts = parent_content.split('---', 2)
-                if len(parent_parts) >= 3:
-                    parent_meta = yaml.safe_load(parent_parts[1]) or {}
-                    parent_status = parent_meta.get('status', '')
-                    has_pending_confirm = (
-                        "<confirm>" in parent_content and 
-                        "--- USER DECISION ---" not in parent_content.split("<confirm>")[-1]
-                    )
+                parent = await storage.run(task_parser.load, parent_path)
+                if parent:
+                    parent_status = parent.status
+                    has_pending_confirm = parent.awaiting_confirmation
                     
                     if parent_status in ('needs_user_input', 'blocked') or has_pending_confirm:
                         # Append user input to the blocked task and unblock it
@@ -699,10 +870,10 @@ async def handle_message(message: types.Message):
                         else:
                             user_input_section = f"\n\n--- USER INPUT ---\n{message.text}\n"
                         
-                        parent_meta['status'] = 'planning'
-                        new_content = f"--- \n{yaml.dump(parent_meta, allow_unicode=True)}--- {parent_parts[2]}{user_input_section}"
-                        with open(parent_path, 'w') as f:
-                            f.write(new_content)
+                        await storage.run(task_store.append, parent_path, user_input_section, status='planning')
+                        await storage.run(tracing.record, parent.metadata.get('trace_id'), "user input", received,
+                                          task=os.path.basename(parent_path))
+                        runner_wakeup.task_enqueued(user_id, os.path.basename(parent_path))
                         
                         try: await message.react(reaction=[types.ReactionTypeEmoji(emoji="👍")])
                         except: pass
@@ -712,6 +883,22 @@ async def handle_message(message: types.Message):
             
             parent_task_id = os.path.basename(parent_path)
     
+    # Burst coalescing: fold follow-up messages into the still-unplanned task
+    window = burst.window_for(user_id)
+    if window and not message.reply_to_message:
+        now = time.time()
+        for chat_id in [c for c, (_, until) in burst_tasks.items() if until <= now]:
+            del burst_tasks[chat_id]  # window closed: the task is being planned or done
+        open_task, _ = burst_tasks.pop(message.chat.id, (None, 0))
+        if open_task and await storage.run(burst.try_append, open_task, message.text, window):
+            burst_tasks[message.chat.id] = (open_task, time.time() + window)
+            task_filename = os.path.basename(open_task)
+            await storage.run(msg_index.add, user_id, task_filename, message.message_id)
+            schedule_wakeup(user_id, task_filename, window)
+            try: await message.react(reaction=[types.ReactionTypeEmoji(emoji="👀")])
+            except: pass
+            return
+
     # Always create a NEW task
     task_filename = f"task_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{hashlib.md5(message.text.encode()).hexdigest()[:4]}.md"
     
@@ -722,19 +909,31 @@ async def handle_message(message: types.Message):
         "trigger_message_id": message.message_id,
         "parent_task_id": parent_task_id,
         "status": "planning", # Start in planning mode
-        "created_at": datetime.now().isoformat()
+        "created_at": datetime.now().isoformat(),
+        "trace_id": tracing.new_trace_id(),
     }
+    hold = window and not message.reply_to_message
+    if hold:
+        metadata["coalesce_until"] = time.time() + window
     
     # Initial Content Structure
-    file_content = (
-        f"--- \n{yaml.dump(metadata, allow_unicode=True)}--- \n\n"
+    body = (
+        "\n\n"
         f"# Request\n{message.text}\n\n"
         f"# Plan\n\n" # Empty plan signals the runner to generate one
         f"# History\n"
     )
 
-    with open(os.path.join(paths["tasks"], task_filename), "w") as f:
-        f.write(file_content)
+    task_path = os.path.join(paths["tasks"], task_filename)
+    await storage.run(task_store.create, task_path, metadata, body)
+    await storage.run(msg_index.add, user_id, task_filename, message.message_id)
+    if hold:
+        burst_tasks[message.chat.id] = (task_path, metadata["coalesce_until"])
+        schedule_wakeup(user_id, task_filename, window)
+    else:
+        runner_wakeup.task_enqueued(user_id, task_filename)
+    await storage.run(tracing.record, metadata["trace_id"], "message", received, time.time(),
+                      task=task_filename, held=window if hold else 0)
     
     # React to confirm receipt
     try: await message.react(reaction=[types.ReactionTypeEmoji(emoji="👀")])
@@ -742,10 +941,21 @@ async def handle_message(message: types.Message):
 
 async def main():
     log_tg("Bot starting (Multi-user mode ready)...")
+    metrics.init("gateway")
+    tracing.init("gateway")
+    profiler = profiling.Profiler("gateway").install(asyncio.get_running_loop())
+    asyncio.create_task(profiler.watch())
+    config_cache.install_sighup_handler()
+    asyncio.create_task(storage.monitor_loop_lag(log_tg))
     # Start notifying results separately
-    asyncio.create_task(state_inspector.notify_results(bot, send_smart_message))
+    asyncio.create_task(state_inspector.notify_results(outbox, send_smart_message))
     asyncio.create_task(monitor_qr_code())
-    await dp.start_polling(bot)
+    if webhook.enabled():
+        await webhook.serve(dp, bot, log=log_tg)
+    else:
+        # getUpdates is refused while a webhook is registered
+        await bot.delete_webhook()
+        await dp.start_polling(bot)
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,153 @@
+"""Per-task trace spans: where the time between a message and its answer went.
+
+handle_message gives every new task a trace id, stored as `trace_id` in the
+task metadata (the heartbeat gives one to each spawned recurrent task). The
+gateway, runner, heartbeat and notifier record timed spans under that id:
+the message handling, the wait until a runner picks the task up, planning,
+each step and each Gemini attempt (model, outcome), quota deferral and
+resumption, finalizing, the git commit, and every dashboard delivery.
+
+Spans are appended as JSON lines to /app/data/traces/<date>.jsonl, one
+write() per span, so concurrent processes do not interleave. Files older
+than RETENTION_DAYS are removed by the heartbeat. Recording never raises.
+
+    tracing.init("runner")
+    with tracing.span(trace_id, "step 2", task=filename) as attrs:
+        attrs["ok"] = True
+
+/trace <task> (admin) renders a trace as a waterfall with waterfall().
+"""
+
+import os
+import json
+import time
+import uuid
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+
+TRACE_DIR = "/app/data/traces"
+RETENTION_DAYS = int(os.getenv("TRACE_RETENTION_DAYS", "7"))
+WATERFALL_WIDTH = 20
+
+service = None
+
+
+def init(name):
+    global service
+    service = name
+
+
+def new_trace_id():
+    return uuid.uuid4().hex[:16]
+
+
+def record(trace_id, name, start, end=None, **attrs):
+    """Appends one span (end defaults to start: an instant event). No-op without a trace id."""
+    if not trace_id:
+        return
+    end = start if end is None else end
+    line = {"trace": trace_id, "name": name, "service": service, "start": round(start, 3),
+            "duration": round(max(0.0, end - start), 3)}
+    line.update(attrs)
+    path = os.path.join(TRACE_DIR, f"{datetime.fromtimestamp(start):%Y-%m-%d}.jsonl")
+    try:
+        os.makedirs(TRACE_DIR, exist_ok=True)
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, (json.dumps(line, ensure_ascii=False, default=str) + "\n").encode())
+        finally:
+            os.close(fd)
+    except OSError as e:
+        print(f"Trace write failed: {e}", flush=True)
+
+
+@contextmanager
+def span(trace_id, name, **attrs):
+    """Times the block as a span; yields its attributes for the block to add to ("error" set if it raises)."""
+    start = time.time()
+    try:
+        yield attrs
+    except BaseException as e:
+        attrs.setdefault("error", type(e).__name__)
+        raise
+    finally:
+        record(trace_id, name, start, time.time(), **attrs)
+
+
+def load(trace_id, days=RETENTION_DAYS):
+    """Spans of a trace from the last `days` daily files, by start time."""
+    spans = []
+    today = datetime.now().date()
+    needle = f'"trace": "{trace_id}"'
+    for n in range(days + 1):
+        path = os.path.join(TRACE_DIR, f"{today - timedelta(days=n):%Y-%m-%d}.jsonl")
+        try:
+            with open(path, 'r') as f:
+                for line in f:
+                    if needle in line:
+                        try:
+                            spans.append(json.loads(line))
+                        except ValueError:
+                            pass
+        except FileNotFoundError:
+            continue
+    spans.sort(key=lambda s: (s["start"], -s["duration"]))
+    return spans
+
+
+def prune(now=None):
+    """Removes daily files older than RETENTION_DAYS."""
+    cutoff = f"{(now or datetime.now()).date() - timedelta(days=RETENTION_DAYS):%Y-%m-%d}"
+    try:
+        names = os.listdir(TRACE_DIR)
+    except FileNotFoundError:
+        return
+    for name in names:
+        if name.endswith(".jsonl") and name[:-6] < cutoff:
+            try:
+                os.remove(os.path.join(TRACE_DIR, name))
+            except OSError:
+                pass
+
+
+def _duration(seconds):
+    if seconds < 60:
+        return f"{seconds:.1f}s"
+    minutes, seconds = divmod(int(seconds), 60)
+    return f"{minutes}m{seconds:02d}s" if minutes < 60 else f"{minutes // 60}h{minutes % 60:02d}m"
+
+
+def _escape(text):
+    return str(text).replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def waterfall(spans, limit=3500):
+    """Telegram HTML of a trace: one line per span with offset, duration and a bar."""
+    if not spans:
+        return "No spans recorded for this trace."
+    origin = spans[0]["start"]
+    total = max(s["start"] + s["duration"] for s in spans) - origin or 1.0
+    lines = []
+    for s in spans:
+        offset = s["start"] - origin
+        left = int(offset / total * WATERFALL_WIDTH)
+        width = max(1, round(s["duration"] / total * WATERFALL_WIDTH)) if s["duration"] else 0
+        bar = (" " * left + ("█" * width if width else "│")).ljust(WATERFALL_WIDTH)[:WATERFALL_WIDTH]
+        details = " ".join(f"{k}={v}" for k, v in s.items()
+                           if k not in ("trace", "name", "service", "start", "duration", "task", "user"))
+        label = f"{s.get('service') or '?'}: {s['name']}" + (f" ({details})" if details else "")
+        lines.append(f"{_duration(offset):>7} {_duration(s['duration']):>7} {bar} {label[:60]}")
+
+    header = f"🔎 <b>Trace</b> <code>{spans[0]['trace']}</code>, {_duration(total)} total\n"
+    task = next((s["task"] for s in spans if s.get("task")), None)
+    if task:
+        header += f"Task: <code>{_escape(task)}</code>\n"
+    body, shown = "", 0
+    for line in lines:
+        if len(header) + len(body) + len(line) > limit:
+            break
+        body += _escape(line) + "\n"
+        shown += 1
+    if shown < len(lines):
+        body += f"… {len(lines) - shown} more spans\n"
+    return f"{header}<pre>   start    took {'timeline':<{WATERFALL_WIDTH}} span\n{body}</pre>"
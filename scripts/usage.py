@@ -0,0 +1,276 @@
+"""Per-user resource accounting and limits for Gemini calls and init.sh.
+
+Every Gemini CLI call of the runner and every user's init.sh is metered:
+- CPU seconds of the child processes (getrusage(RUSAGE_CHILDREN) deltas in the
+  single-threaded runner, wait4() for init.sh);
+- peak RSS (VmHWM of the Gemini process, sampled while it runs, or a new
+  RUSAGE_CHILDREN maximum; ru_maxrss of init.sh);
+- wall time.
+Totals are kept per user and per day in /app/data/usage/<date>.json.
+
+Limits come from /app/config/usage_limits.json (no file: accounting only):
+
+    {"default": {"soft": {"cpu_seconds": 1800, "wall_seconds": 7200},
+                 "hard": {"cpu_seconds": 3600, "wall_seconds": 14400},
+                 "memory_max_mb": 2048, "cpu_max": 1.0},
+     "users": {"123456": {"hard": {"cpu_seconds": 7200}}}}
+
+Over a soft limit, the runner serves the user after everyone else. Over a hard
+limit, their queued tasks are deferred to the next day (like a quota deferral).
+
+With USAGE_CGROUP set to a writable cgroup v2 directory (e.g.
+/sys/fs/cgroup/assistant), each user's processes also run in their own child
+cgroup user_<id>. memory_max_mb and cpu_max (CPUs) are applied there as
+memory.max and cpu.max. CPU time of processes Gemini did not wait for (MCP
+servers) is then counted from cpu.stat. Without cgroups, MCP servers kept warm
+by mcp_broker are not attributed to users.
+
+init.sh runs through the wrapper, from entrypoint.sh:
+
+    python3 usage.py run <user_id> -- bash init.sh
+"""
+
+import os
+import sys
+import json
+import time
+import fcntl
+import resource
+import subprocess
+from datetime import datetime, timedelta
+import config_cache
+
+USAGE_DIR = "/app/data/usage"
+CGROUP_ROOT = os.getenv("USAGE_CGROUP", "")
+KEEP_DAYS = 31
+FIELDS = ("calls", "cpu_seconds", "wall_seconds")
+
+limits_file = config_cache.CachedJSONFile(config_cache.USAGE_LIMITS_FILE, default={})
+
+# date -> (mtime_ns, totals) of the day files read by today()
+_cache = {}
+
+
+def _day_path(day=None):
+    return os.path.join(USAGE_DIR, f"{day or datetime.now():%Y-%m-%d}.json")
+
+
+def add(user_id, kind, cpu_seconds, wall_seconds, peak_rss_mb):
+    """Adds one metered run to the user's totals for today. Never raises."""
+    path = _day_path()
+    try:
+        os.makedirs(USAGE_DIR, exist_ok=True)
+        new_day = not os.path.exists(path)
+        with open(f"{path}.lock", 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(path, 'r') as f:
+                    totals = json.load(f)
+            except (OSError, ValueError):
+                totals = {}
+            entry = totals.setdefault(str(user_id), {}).setdefault(kind, {"calls": 0, "cpu_seconds": 0.0,
+                                                                          "wall_seconds": 0.0, "peak_rss_mb": 0})
+            entry["calls"] += 1
+            entry["cpu_seconds"] = round(entry["cpu_seconds"] + cpu_seconds, 3)
+            entry["wall_seconds"] = round(entry["wall_seconds"] + wall_seconds, 3)
+            entry["peak_rss_mb"] = max(entry["peak_rss_mb"], round(peak_rss_mb))
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, 'w') as f:
+                json.dump(totals, f)
+            os.replace(tmp, path)
+        if new_day:
+            _prune()
+    except Exception as e:
+        print(f"Usage accounting failed for user {user_id}: {e}", flush=True)
+
+
+def _prune():
+    cutoff = f"{datetime.now() - timedelta(days=KEEP_DAYS):%Y-%m-%d}"
+    for name in os.listdir(USAGE_DIR):
+        if name[:10] < cutoff:
+            try:
+                os.remove(os.path.join(USAGE_DIR, name))
+            except OSError:
+                pass
+
+
+def today(user_id):
+    """{kind: {calls, cpu_seconds, wall_seconds, peak_rss_mb}} of the user for today."""
+    path = _day_path()
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return {}
+    cached = _cache.get(path)
+    if not cached or cached[0] != mtime:
+        try:
+            with open(path, 'r') as f:
+                cached = _cache[path] = (mtime, json.load(f))
+        except (OSError, ValueError):
+            return {}
+    return cached[1].get(str(user_id), {})
+
+
+def totals(user_id):
+    """Today's usage of the user summed over all kinds."""
+    usage = today(user_id)
+    summed = {field: sum(kind.get(field, 0) for kind in usage.values()) for field in FIELDS}
+    summed["peak_rss_mb"] = max((kind.get("peak_rss_mb", 0) for kind in usage.values()), default=0)
+    return summed
+
+
+def top_users(limit=5):
+    """[(user_id, totals)] of today's heaviest users by CPU seconds."""
+    path = _day_path()
+    try:
+        with open(path, 'r') as f:
+            users = json.load(f)
+    except (OSError, ValueError):
+        return []
+    ranked = sorted(users, key=lambda u: -sum(k.get("cpu_seconds", 0) for k in users[u].values()))
+    return [(user_id, totals(user_id)) for user_id in ranked[:limit]]
+
+
+def limits(user_id):
+    """The user's limits: the file's defaults with their overrides applied."""
+    config = limits_file.get() or {}
+    merged = json.loads(json.dumps(config.get("default", {})))
+    for key, value in config.get("users", {}).get(str(user_id), {}).items():
+        if isinstance(value, dict):
+            merged.setdefault(key, {}).update(value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def state(user_id):
+    """"hard", "soft" or "ok": the strictest limit today's usage has reached."""
+    used = totals(user_id)
+    user_limits = limits(user_id)
+    for level in ("hard", "soft"):
+        for field, limit in user_limits.get(level, {}).items():
+            if limit and used.get(field, 0) >= limit:
+                return level
+    return "ok"
+
+
+# --- cgroup v2 (optional) ---
+
+def _cgroup(user_id):
+    """The user's cgroup directory with limits applied, or None if cgroups are off or unavailable."""
+    if not CGROUP_ROOT:
+        return None
+    path = os.path.join(CGROUP_ROOT, f"user_{user_id}")
+    try:
+        if not os.path.isdir(path):
+            os.makedirs(path)
+            try:
+                with open(os.path.join(CGROUP_ROOT, "cgroup.subtree_control"), 'w') as f:
+                    f.write("+cpu +memory")
+            except OSError:
+                pass
+        user_limits = limits(user_id)
+        settings = {}
+        if user_limits.get("memory_max_mb"):
+            settings["memory.max"] = str(int(user_limits["memory_max_mb"]) * 1024 * 1024)
+        if user_limits.get("cpu_max"):
+            settings["cpu.max"] = f"{int(float(user_limits['cpu_max']) * 100000)} 100000"
+        for name, value in settings.items():
+            try:
+                with open(os.path.join(path, name), 'w') as f:
+                    f.write(value)
+            except OSError:
+                pass
+        return path
+    except OSError as e:
+        print(f"cgroup unavailable for user {user_id}: {e}", flush=True)
+        return None
+
+
+def _cgroup_cpu(path):
+    try:
+        with open(os.path.join(path, "cpu.stat"), 'r') as f:
+            for line in f:
+                if line.startswith("usage_usec"):
+                    return int(line.split()[1]) / 1e6
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def _children():
+    """(CPU seconds, max RSS KiB) of all reaped children so far."""
+    ru = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return ru.ru_utime + ru.ru_stime, ru.ru_maxrss
+
+
+class Meter:
+    """Meters one child process of the calling (single-threaded) process: start(pid), sample(), finish()."""
+
+    def __init__(self, user_id, kind):
+        self.user_id = str(user_id)
+        self.kind = kind
+        self.pid = None
+        self.peak_kb = 0
+
+    def start(self, pid):
+        self.pid = pid
+        self.started = time.monotonic()
+        self.cpu_before, self.maxrss_before = _children()
+        self.cgroup = _cgroup(self.user_id)
+        self.cgroup_before = None
+        if self.cgroup:
+            try:
+                with open(os.path.join(self.cgroup, "cgroup.procs"), 'w') as f:
+                    f.write(str(pid))
+                self.cgroup_before = _cgroup_cpu(self.cgroup)
+            except OSError as e:
+                print(f"Could not move {pid} into {self.cgroup}: {e}", flush=True)
+        return self
+
+    def sample(self):
+        """Reads the process's peak RSS so far (call while it runs)."""
+        try:
+            with open(f"/proc/{self.pid}/status", 'r') as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        self.peak_kb = max(self.peak_kb, int(line.split()[1]))
+                        break
+        except (OSError, ValueError, IndexError):
+            pass
+
+    def finish(self, cpu_seconds=None, peak_kb=None):
+        """Records the run (after the process was reaped). Pass wait4() numbers when known."""
+        if self.pid is None:
+            return
+        if cpu_seconds is None:
+            cpu_after, maxrss_after = _children()
+            cpu_seconds = max(0.0, cpu_after - self.cpu_before)
+            if maxrss_after > self.maxrss_before:
+                # A new high among all children: this one's peak (exited before it was sampled)
+                peak_kb = max(peak_kb or 0, maxrss_after)
+        if self.cgroup_before is not None:
+            after = _cgroup_cpu(self.cgroup)
+            if after is not None:
+                cpu_seconds = max(cpu_seconds, after - self.cgroup_before)
+        peak_kb = max(self.peak_kb, peak_kb or 0)
+        add(self.user_id, self.kind, cpu_seconds, time.monotonic() - self.started, peak_kb / 1024)
+        self.pid = None
+
+
+def run(user_id, kind, args):
+    """Runs args to completion, metered for user_id; returns its exit status."""
+    proc = subprocess.Popen(args)
+    meter = Meter(user_id, kind).start(proc.pid)
+    _, status, ru = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    meter.finish(ru.ru_utime + ru.ru_stime, ru.ru_maxrss)
+    return proc.returncode
+
+
+if __name__ == "__main__":
+    # usage.py run <user_id> -- <command...>
+    if len(sys.argv) < 5 or sys.argv[1] != "run" or sys.argv[3] != "--":
+        print("Usage: python usage.py run <user_id> -- <command> [args...]")
+        sys.exit(2)
+    sys.exit(run(sys.argv[2], "init", sys.argv[4:]))
@@ -21,3 +21,7 @@ def strip_ansi(text: str) -> str:
     text = ansi_escape.sub('', text)
     # Also remove carriage returns which can mess up formatting in Telegram
     return text.replace('\r', '')
+
+
+# Appended to a task file by the runner when the user cancels it (see /cancel)
+CANCELLED_MARKER = "--- CANCELLED"
@@ -0,0 +1,72 @@
+"""Webhook ingestion for the Telegram gateway, as an alternative to long polling.
+
+Enabled by setting TELEGRAM_WEBHOOK_URL (the public HTTPS URL Telegram should
+POST to; a reverse proxy forwards it to WEBHOOK_LISTEN_HOST:WEBHOOK_LISTEN_PORT).
+Requests without the right X-Telegram-Bot-Api-Secret-Token header are
+rejected. Updates are acknowledged before their handlers run, so a slow
+handler never holds up Telegram's next delivery.
+
+TELEGRAM_API_BASE points the bot at another Bot API server: a self-hosted
+telegram-bot-api, or bench/fake_bot_api.py for offline testing.
+"""
+
+import os
+import asyncio
+import secrets
+from urllib.parse import urlparse
+
+from aiohttp import web
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+API_BASE = os.getenv("TELEGRAM_API_BASE")
+WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET")
+LISTEN_HOST = os.getenv("WEBHOOK_LISTEN_HOST", "0.0.0.0")
+LISTEN_PORT = int(os.getenv("WEBHOOK_LISTEN_PORT", "8080"))
+LISTEN_PATH = os.getenv("WEBHOOK_LISTEN_PATH") or urlparse(WEBHOOK_URL or "").path or "/webhook"
+
+
+def make_bot(token, api_base=None):
+    """Bot bound to the official API, or to `api_base` / TELEGRAM_API_BASE if set."""
+    api_base = api_base or API_BASE
+    if api_base:
+        return Bot(token=token, session=AiohttpSession(api=TelegramAPIServer.from_base(api_base)))
+    return Bot(token=token)
+
+
+def enabled():
+    return bool(WEBHOOK_URL)
+
+
+async def serve(dp, bot, url=None, secret=None, host=None, port=None, path=None, background=True, log=print):
+    """Registers the webhook with Telegram and serves updates until cancelled.
+
+    background=True answers Telegram's POST immediately and feeds the update
+    to the dispatcher afterwards; False waits for the handlers first.
+    """
+    url = url or WEBHOOK_URL
+    # Telegram echoes the secret back on every request; a random one per start is fine
+    # because set_webhook below re-registers it.
+    secret = secret or WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    host = host or LISTEN_HOST
+    port = port or LISTEN_PORT
+    path = path or LISTEN_PATH
+
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp, bot=bot, handle_in_background=background, secret_token=secret
+    ).register(app, path=path)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    try:
+        await bot.set_webhook(url, secret_token=secret, allowed_updates=dp.resolve_used_update_types())
+        log(f"Webhook mode: listening on {host}:{port}{path}, registered {url}")
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()